@@ -0,0 +1,172 @@
+"""
+Контроль допуска запросов к API
+Ограничивает частоту записей по пользователям и общее число одновременных запросов
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict
+
+# Приоритеты запросов: меньше значение - выше приоритет
+PRIORITY_CRITICAL = 0  # авторизация и покупки
+PRIORITY_WRITE = 1     # прочие изменения состояния
+PRIORITY_POLL = 2      # опрос данных (GET)
+
+PRIORITY_NAMES = {
+    PRIORITY_CRITICAL: "critical",
+    PRIORITY_WRITE: "write",
+    PRIORITY_POLL: "poll",
+}
+
+# Доля общего лимита одновременных запросов, доступная каждому приоритету
+PRIORITY_SHARES = {
+    PRIORITY_CRITICAL: 1.0,
+    PRIORITY_WRITE: 0.85,
+    PRIORITY_POLL: 0.6,
+}
+
+# Пауза (сек) перед повтором, которую предлагаем клиенту при перегрузке
+OVERLOAD_RETRY_AFTER = 1
+
+
+class TokenBucket:
+    """Корзина токенов для ограничения частоты запросов одного пользователя"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def take(self, now: float, cost: float = 1.0) -> float:
+        """Забрать токены; возвращает 0 или сколько секунд ждать до следующей попытки"""
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """Контроль допуска: корзины токенов для записей и лимит одновременных запросов"""
+
+    def __init__(self, max_concurrency: int = 32, rate: float = 10.0, burst: float = 20.0,
+                 queue_timeout: float = 0.25, max_buckets: int = 50000):
+        self.max_concurrency = max(1, max_concurrency)
+        self.rate = rate
+        self.burst = burst
+        self.queue_timeout = queue_timeout
+        self.max_buckets = max_buckets
+
+        # Порог одновременных запросов для каждого приоритета
+        self.limits = {
+            priority: max(1, int(self.max_concurrency * share))
+            for priority, share in PRIORITY_SHARES.items()
+        }
+
+        self._buckets: "OrderedDict[object, TokenBucket]" = OrderedDict()
+        self._buckets_lock = threading.Lock()
+        self._slots = threading.Condition()
+        self._in_flight = 0
+
+        # Счетчики для мониторинга
+        self._admitted = {priority: 0 for priority in PRIORITY_NAMES}
+        self._shed_overload = {priority: 0 for priority in PRIORITY_NAMES}
+        self._shed_rate_limited = 0
+
+    # === ОГРАНИЧЕНИЕ ЧАСТОТЫ ===
+
+    def check_rate(self, key, cost: float = 1.0) -> float:
+        """Проверить корзину токенов ключа; возвращает 0 или Retry-After в секундах"""
+        now = time.monotonic()
+        with self._buckets_lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst, now)
+                self._buckets[key] = bucket
+                # Вытесняем самые давние корзины, чтобы память не росла без предела
+                while len(self._buckets) > self.max_buckets:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+
+            wait = bucket.take(now, cost)
+            if wait > 0:
+                self._shed_rate_limited += 1
+            return wait
+
+    # === ЛИМИТ ОДНОВРЕМЕННЫХ ЗАПРОСОВ ===
+
+    def acquire(self, priority: int) -> bool:
+        """Занять слот обработки; критичные запросы могут недолго подождать"""
+        limit = self.limits[priority]
+        with self._slots:
+            if self._in_flight >= limit and priority == PRIORITY_CRITICAL:
+                deadline = time.monotonic() + self.queue_timeout
+                while self._in_flight >= limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._slots.wait(remaining)
+
+            if self._in_flight >= limit:
+                self._shed_overload[priority] += 1
+                return False
+
+            self._in_flight += 1
+            self._admitted[priority] += 1
+            return True
+
+    def release(self):
+        """Освободить слот обработки"""
+        with self._slots:
+            self._in_flight -= 1
+            self._slots.notify_all()
+
+    def wait_idle(self, timeout: float) -> bool:
+        """Дождаться завершения всех запросов в обработке (для плавной остановки)"""
+        deadline = time.monotonic() + timeout
+        with self._slots:
+            while self._in_flight > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._slots.wait(remaining)
+            return True
+
+    def utilization(self) -> float:
+        """Доля занятых слотов обработки (для фоновых задач, без блокировки)"""
+        return self._in_flight / self.max_concurrency
+
+    @staticmethod
+    def retry_after_seconds(wait: float) -> int:
+        """Перевести время ожидания в целое значение заголовка Retry-After"""
+        return max(1, math.ceil(wait))
+
+    def stats(self) -> Dict:
+        """Счетчики допуска и отказов"""
+        with self._slots:
+            in_flight = self._in_flight
+            admitted = {PRIORITY_NAMES[p]: n for p, n in self._admitted.items()}
+            shed = {PRIORITY_NAMES[p]: n for p, n in self._shed_overload.items()}
+        with self._buckets_lock:
+            tracked = len(self._buckets)
+            rate_limited = self._shed_rate_limited
+
+        return {
+            "in_flight": in_flight,
+            "max_concurrency": self.max_concurrency,
+            "limits": {PRIORITY_NAMES[p]: n for p, n in self.limits.items()},
+            "admitted": admitted,
+            "shed_overload": shed,
+            "shed_rate_limited": rate_limited,
+            "tracked_buckets": tracked,
+        }
@@ -1,5 +1,6 @@
 import os
 import asyncio
+import logging
 from pathlib import Path
 
 from aiogram import Bot, Dispatcher, F
@@ -11,7 +12,8 @@ from aiogram.types import (
 from dotenv import load_dotenv, find_dotenv
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from db.database import DatabaseManager
+from db.engine import create_client_database_manager
+from tracing import configure_logging, traced
 
 
 # Load .env from current dir (bot folder) or project root
@@ -20,9 +22,14 @@ _ = load_dotenv(env_path) or load_dotenv(find_dotenv(usecwd=True))
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 WEBAPP_URL = os.getenv("WEBAPP_URL", "")  # e.g. https://your-domain.example
+API_URL = os.getenv("API_URL", "http://localhost:8080")  # процесс API (для DB_ENGINE=memory)
 
-# Инициализируем базу данных
-db_manager = DatabaseManager()
+# Журнал пишется из отдельного потока (LOG_LEVEL, LOG_FORMAT, TRACE_SLOW_MS)
+configure_logging()
+log = logging.getLogger('bot')
+
+# Инициализируем базу данных тем же движком, что и API (DB_ENGINE, DB_SHARDS)
+db_manager = create_client_database_manager(API_URL, BOT_TOKEN)
 
 
 if not BOT_TOKEN:
@@ -30,7 +37,19 @@ if not BOT_TOKEN:
 
 if not WEBAPP_URL:
     # Not critical for start, but warn
-    print("[WARN] WEBAPP_URL is not set. Set WEBAPP_URL to your deployed site to enable the WebApp button.")
+    log.warning("WEBAPP_URL is not set. Set WEBAPP_URL to your deployed site to enable the WebApp button.")
+
+
+async def trace_updates(handler, event: Message, data):
+    """Трасса на каждое сообщение: запросы к БД попадают в нее интервалами"""
+    # В имя трассы попадает только команда, не текст сообщения
+    command = (event.text or '').split(' ', 1)[0][:32] if (event.text or '').startswith('/') else 'message'
+    with traced(f"bot {command}"):
+        try:
+            return await handler(event, data)
+        except Exception:
+            log.exception("Ошибка обработки сообщения %s", command)
+            raise
 
 
 async def on_start_command(message: Message):
@@ -110,12 +129,13 @@ async def main() -> None:
     dp = Dispatcher()
 
     # Регистрируем обработчики сообщений
+    dp.message.outer_middleware(trace_updates)
     dp.message.register(on_start_command, F.text == "/start")
     dp.message.register(show_balance, F.text == "/balance")
 
-    print("🤖 Bot is starting…")
-    print(f"🌐 WebApp URL: {WEBAPP_URL or '❌ Not set'}")
-    print("💡 Покупка монет и весь геймплей доступны в веб-приложении")
+    log.info("🤖 Bot is starting…")
+    log.info("🌐 WebApp URL: %s", WEBAPP_URL or '❌ Not set')
+    log.info("💡 Покупка монет и весь геймплей доступны в веб-приложении")
     
     await dp.start_polling(bot)
 
@@ -0,0 +1,120 @@
+"""
+Достижения: декларативные пороги по статистике игрока
+Правила сгруппированы по статистике, которую они отслеживают, а для каждого игрока
+заранее посчитан ближайший неоткрытый порог: обычное изменение статистики - одно
+сравнение, к базе обращаемся только при пересечении порога
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Set
+
+# Сколько игроков держим в кэше порогов
+ACHIEVEMENT_CACHE_SIZE = 50000
+
+# Порог, который нельзя достичь (все правила статистики открыты)
+NO_THRESHOLD = float('inf')
+
+
+class Achievement(NamedTuple):
+    """Правило достижения: открывается, когда stat >= threshold"""
+    id: str
+    title: str
+    description: str
+    stat: str
+    threshold: int
+    reward: int
+
+
+# Отслеживаемые статистики:
+#   total_clicks, total_earned - из game_state
+#   referrals - приглашенные напрямую, team_size - вся команда (referral_team_stats)
+#   upgrade_levels - сумма уровней всех улучшений
+ACHIEVEMENTS = [
+    Achievement('clicks_100', "Разминка", "Сделать 100 кликов", 'total_clicks', 100, 50),
+    Achievement('clicks_1000', "Кликер", "Сделать 1 000 кликов", 'total_clicks', 1000, 300),
+    Achievement('clicks_10000', "Стальной палец", "Сделать 10 000 кликов", 'total_clicks', 10000, 2000),
+    Achievement('earned_1000', "Первая тысяча", "Заработать 1 000 монет", 'total_earned', 1000, 100),
+    Achievement('earned_10000', "Копилка", "Заработать 10 000 монет", 'total_earned', 10000, 1000),
+    Achievement('earned_100000', "Магнат", "Заработать 100 000 монет", 'total_earned', 100000, 5000),
+    Achievement('referrals_1', "Первый друг", "Пригласить друга", 'referrals', 1, 100),
+    Achievement('referrals_5', "Компания", "Пригласить 5 друзей", 'referrals', 5, 500),
+    Achievement('referrals_25', "Лидер", "Пригласить 25 друзей", 'referrals', 25, 2500),
+    Achievement('team_100', "Сеть", "Собрать команду из 100 игроков", 'team_size', 100, 5000),
+    Achievement('upgrades_10', "Мастер", "Набрать 10 уровней улучшений", 'upgrade_levels', 10, 200),
+    Achievement('upgrades_50', "Инженер", "Набрать 50 уровней улучшений", 'upgrade_levels', 50, 1000),
+]
+
+ACHIEVEMENTS_BY_ID: Dict[str, Achievement] = {rule.id: rule for rule in ACHIEVEMENTS}
+
+# Статистика -> правила по возрастанию порога
+RULES_BY_STAT: Dict[str, List[Achievement]] = {}
+for _rule in sorted(ACHIEVEMENTS, key=lambda rule: rule.threshold):
+    RULES_BY_STAT.setdefault(_rule.stat, []).append(_rule)
+
+
+def next_thresholds(unlocked: Set[str]) -> Dict[str, float]:
+    """Ближайший неоткрытый порог по каждой статистике"""
+    return {
+        stat: next((rule.threshold for rule in rules if rule.id not in unlocked), NO_THRESHOLD)
+        for stat, rules in RULES_BY_STAT.items()
+    }
+
+
+class AchievementTracker:
+    """Кэш ближайших порогов игроков и открытие достижений пачкой"""
+
+    def __init__(self, cache_size: int = ACHIEVEMENT_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._thresholds: "OrderedDict[int, Dict[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def needs_check(self, user_id: int, stats: Dict[str, int]) -> bool:
+        """Достигнут ли хотя бы один порог (или пороги игрока еще не загружены)"""
+        with self._lock:
+            thresholds = self._thresholds.get(user_id)
+            if thresholds is None:
+                return True
+            self._thresholds.move_to_end(user_id)
+        return any(value >= thresholds.get(stat, NO_THRESHOLD) for stat, value in stats.items())
+
+    def unlock(self, conn, user_id: int, stats: Dict[str, int], now: float) -> List[Achievement]:
+        """Открыть достижения с достигнутыми порогами в текущей транзакции; вернуть новые"""
+        cursor = conn.execute("""
+            SELECT achievement_id FROM user_achievements
+            WHERE user_id = ? AND unlocked_at IS NOT NULL
+        """, (user_id,))
+        unlocked = {row[0] for row in cursor.fetchall()}
+
+        new_rules = [
+            rule for stat, value in stats.items() for rule in RULES_BY_STAT.get(stat, ())
+            if rule.threshold <= value and rule.id not in unlocked
+        ]
+        if not new_rules:
+            self._remember(user_id, next_thresholds(unlocked))
+            return []
+
+        # Строка могла быть создана заранее без unlocked_at - дополняем ее
+        conn.executemany("""
+            INSERT INTO user_achievements (user_id, achievement_id, unlocked_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id, achievement_id) DO UPDATE SET unlocked_at = excluded.unlocked_at
+            WHERE user_achievements.unlocked_at IS NULL
+        """, [(user_id, rule.id, now) for rule in new_rules])
+        # Транзакция еще может откатиться - пороги перечитаем при следующей проверке
+        self.forget([user_id])
+        return new_rules
+
+    def forget(self, user_ids: Iterable[int]):
+        """Сбросить кэш порогов игроков"""
+        with self._lock:
+            for user_id in user_ids:
+                self._thresholds.pop(user_id, None)
+
+    def _remember(self, user_id: int, thresholds: Dict[str, float]):
+        """Запомнить пороги, вытесняя самых давних игроков"""
+        with self._lock:
+            self._thresholds[user_id] = thresholds
+            self._thresholds.move_to_end(user_id)
+            while len(self._thresholds) > self.cache_size:
+                self._thresholds.popitem(last=False)
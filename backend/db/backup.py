@@ -0,0 +1,332 @@
+"""
+Онлайн-резервные копии баз SQLite
+Копия снимается через backup API SQLite порциями страниц с паузами между шагами, поэтому
+API продолжает писать во время копирования. На все время копирования держится одна
+транзакция чтения источника: в режиме WAL она не мешает писателям, а копия получается
+согласованной (без нее каждая запись другим подключением перезапускает копирование).
+Копия сжимается gzip, контрольные суммы и число строк по таблицам пишутся в manifest.json
+
+Набор копий - папка с именем по времени; наборы старше последних BACKUP_KEEP удаляются.
+По расписанию копии снимает планировщик обслуживания (maintenance.py), если задан BACKUP_DIR.
+
+Запуск вручную (из папки backend):
+    python -m db.backup create --source db/clicker_game.db --dir backups
+    python -m db.backup list --dir backups
+    python -m db.backup verify backups/20260101-030000
+    python -m db.backup restore backups/20260101-030000 --target db
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+# Сколько страниц копировать за шаг и сколько ждать между шагами
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP = 0.005
+
+# Сколько последних наборов хранить
+BACKUP_KEEP = 7
+
+# Порция чтения при сжатии и проверке
+CHUNK_SIZE = 1024 * 1024
+
+MANIFEST_NAME = 'manifest.json'
+PARTIAL_PREFIX = '.partial-'
+
+
+class BackupAborted(Exception):
+    """Копирование прервано: не уложилось в отведенное время"""
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def table_counts(conn: sqlite3.Connection) -> Dict[str, int]:
+    """Число строк в каждой таблице базы"""
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    )]
+    return {table: conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for table in tables}
+
+
+class BackupManager:
+    """Создание, ротация, проверка и восстановление наборов копий"""
+
+    def __init__(self, directory: Path, keep: int = BACKUP_KEEP,
+                 pages_per_step: int = BACKUP_PAGES_PER_STEP, step_sleep: float = BACKUP_STEP_SLEEP,
+                 is_busy: Callable[[], bool] = None):
+        self.directory = Path(directory)
+        self.keep = keep
+        self.pages_per_step = pages_per_step
+        self.step_sleep = step_sleep
+        self.is_busy = is_busy or (lambda: False)
+
+    def list_sets(self) -> List[Path]:
+        """Завершенные наборы, от старых к новым"""
+        if not self.directory.exists():
+            return []
+        return sorted(path for path in self.directory.iterdir()
+                      if path.is_dir() and (path / MANIFEST_NAME).exists())
+
+    def create(self, sources: List[Path], deadline: float = None) -> Path:
+        """Снять копии всех баз в новый набор; BackupAborted, если не успели до deadline"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for stale in self.directory.glob(f'{PARTIAL_PREFIX}*'):
+            shutil.rmtree(stale, ignore_errors=True)
+
+        name = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+        partial = self.directory / f'{PARTIAL_PREFIX}{name}'
+        partial.mkdir()
+        started = time.time()
+        try:
+            files = [self._backup_file(Path(source), partial, deadline) for source in sources]
+            manifest = {
+                'name': name,
+                'created_at': started,
+                'duration': round(time.time() - started, 3),
+                'files': files,
+            }
+            with open(partial / MANIFEST_NAME, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            target = self.directory / name
+            os.replace(partial, target)
+        except BaseException:
+            shutil.rmtree(partial, ignore_errors=True)
+            raise
+
+        self.prune()
+        return target
+
+    def prune(self) -> List[Path]:
+        """Удалить наборы сверх последних keep"""
+        removed = self.list_sets()[:-self.keep] if self.keep > 0 else []
+        for path in removed:
+            shutil.rmtree(path, ignore_errors=True)
+        return removed
+
+    def _backup_file(self, source: Path, partial: Path, deadline: Optional[float]) -> Dict:
+        """Скопировать одну базу порциями и сжать копию"""
+        raw_path = partial / source.name
+        src = sqlite3.connect(source, isolation_level=None)
+        dst = sqlite3.connect(raw_path)
+        try:
+            # Снимок чтения на все копирование: шаги видят одно и то же состояние
+            src.execute("BEGIN")
+            src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            src.backup(dst, pages=self.pages_per_step, progress=lambda *_: self._pause(deadline))
+            src.execute("COMMIT")
+            pages = dst.execute("PRAGMA page_count").fetchone()[0]
+            counts = table_counts(dst)
+        finally:
+            dst.close()
+            src.close()
+
+        gz_path = partial / f'{source.name}.gz'
+        raw_digest = hashlib.sha256()
+        with open(raw_path, 'rb') as raw, gzip.open(gz_path, 'wb', compresslevel=6) as gz:
+            for chunk in iter(lambda: raw.read(CHUNK_SIZE), b''):
+                raw_digest.update(chunk)
+                gz.write(chunk)
+                self._pause(deadline)
+        size = raw_path.stat().st_size
+        raw_path.unlink()
+
+        return {
+            'source': source.name,
+            'file': gz_path.name,
+            'size': size,
+            'sha256': raw_digest.hexdigest(),
+            'gz_size': gz_path.stat().st_size,
+            'gz_sha256': file_sha256(gz_path),
+            'pages': pages,
+            'tables': counts,
+        }
+
+    def _pause(self, deadline: Optional[float]):
+        """Пауза между шагами; пока API занят - дольше, но не дольше deadline"""
+        if deadline is not None and time.monotonic() >= deadline:
+            raise BackupAborted("копирование не уложилось в отведенное время")
+        time.sleep(self.step_sleep)
+        while self.is_busy() and (deadline is None or time.monotonic() < deadline):
+            time.sleep(max(self.step_sleep, 0.05))
+
+    # === ПРОВЕРКА И ВОССТАНОВЛЕНИЕ ===
+
+    def verify(self, backup_set: Path, extract_to: Path = None) -> List[str]:
+        """Проверить набор: контрольные суммы, integrity_check и число строк
+
+        Возвращает список ошибок (пустой - набор цел). С extract_to проверенные базы
+        остаются там с суффиксом .restoring.
+        """
+        backup_set = Path(backup_set)
+        with open(backup_set / MANIFEST_NAME, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+
+        errors = []
+        workdir = Path(extract_to) if extract_to else backup_set
+        for entry in manifest['files']:
+            gz_path = backup_set / entry['file']
+            if not gz_path.exists():
+                errors.append(f"{entry['file']}: файл отсутствует")
+                continue
+            if file_sha256(gz_path) != entry['gz_sha256']:
+                errors.append(f"{entry['file']}: контрольная сумма архива не совпадает")
+                continue
+
+            raw_path = workdir / f"{entry['source']}.restoring"
+            try:
+                digest = hashlib.sha256()
+                with gzip.open(gz_path, 'rb') as gz, open(raw_path, 'wb') as raw:
+                    for chunk in iter(lambda: gz.read(CHUNK_SIZE), b''):
+                        digest.update(chunk)
+                        raw.write(chunk)
+                if digest.hexdigest() != entry['sha256']:
+                    errors.append(f"{entry['source']}: контрольная сумма базы не совпадает")
+                    continue
+
+                # immutable: копия в режиме WAL иначе создаст рядом -wal и -shm
+                conn = sqlite3.connect(f"file:{raw_path}?mode=ro&immutable=1", uri=True)
+                try:
+                    integrity = conn.execute("PRAGMA integrity_check").fetchone()[0]
+                    counts = table_counts(conn)
+                finally:
+                    conn.close()
+                if integrity != 'ok':
+                    errors.append(f"{entry['source']}: integrity_check - {integrity}")
+                elif counts != entry['tables']:
+                    errors.append(f"{entry['source']}: число строк не совпадает с манифестом")
+            except (OSError, EOFError, sqlite3.Error) as e:
+                errors.append(f"{entry['source']}: {e}")
+            finally:
+                if not extract_to or errors:
+                    raw_path.unlink(missing_ok=True)
+
+        if errors and extract_to:
+            for entry in manifest['files']:
+                (workdir / f"{entry['source']}.restoring").unlink(missing_ok=True)
+        return errors
+
+    def restore(self, backup_set: Path, target_dir: Path, force: bool = False) -> List[Path]:
+        """Проверить набор и положить базы в target_dir (при остановленном API)"""
+        backup_set, target_dir = Path(backup_set), Path(target_dir)
+        with open(backup_set / MANIFEST_NAME, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+
+        targets = [target_dir / entry['source'] for entry in manifest['files']]
+        existing = [path for path in targets if path.exists()]
+        if existing and not force:
+            raise ValueError(f"файлы уже существуют: {', '.join(map(str, existing))} (используйте --force)")
+
+        target_dir.mkdir(parents=True, exist_ok=True)
+        errors = self.verify(backup_set, extract_to=target_dir)
+        if errors:
+            raise ValueError('; '.join(errors))
+
+        for path in targets:
+            # WAL старой базы нельзя применять к восстановленной
+            for suffix in ('-wal', '-shm'):
+                Path(f"{path}{suffix}").unlink(missing_ok=True)
+            os.replace(target_dir / f"{path.name}.restoring", path)
+        return targets
+
+
+def find_sources(source: Path) -> List[Path]:
+    """Исходные файлы: одна база или все шарды в папке"""
+    if source.is_dir():
+        return sorted(source.glob('shard_*.db'))
+    return [source]
+
+
+def create_backup_manager(is_busy: Callable[[], bool] = None) -> Optional[BackupManager]:
+    """Менеджер копий по расписанию (None, если BACKUP_DIR не задан)"""
+    directory = os.getenv("BACKUP_DIR")
+    if not directory:
+        return None
+    return BackupManager(
+        Path(directory),
+        keep=int(os.getenv("BACKUP_KEEP", str(BACKUP_KEEP))),
+        pages_per_step=int(os.getenv("BACKUP_PAGES_PER_STEP", str(BACKUP_PAGES_PER_STEP))),
+        step_sleep=float(os.getenv("BACKUP_STEP_SLEEP_MS", str(BACKUP_STEP_SLEEP * 1000))) / 1000,
+        is_busy=is_busy,
+    )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Резервные копии базы данных игры")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    create_parser = commands.add_parser('create', help="снять копию (API может работать)")
+    create_parser.add_argument('--source', required=True, type=Path, help="файл базы или папка с шардами")
+    create_parser.add_argument('--dir', required=True, type=Path, help="папка наборов копий")
+    create_parser.add_argument('--keep', type=int, default=BACKUP_KEEP, help="сколько последних наборов хранить")
+
+    list_parser = commands.add_parser('list', help="показать наборы")
+    list_parser.add_argument('--dir', required=True, type=Path, help="папка наборов копий")
+
+    verify_parser = commands.add_parser('verify', help="проверить набор")
+    verify_parser.add_argument('set', type=Path, help="папка набора")
+
+    restore_parser = commands.add_parser('restore', help="проверить и восстановить набор (API остановлен)")
+    restore_parser.add_argument('set', type=Path, help="папка набора")
+    restore_parser.add_argument('--target', required=True, type=Path, help="папка для восстановленных баз")
+    restore_parser.add_argument('--force', action='store_true', help="заменить существующие файлы")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'create':
+        sources = find_sources(args.source)
+        if not sources:
+            print(f"[ERROR] Не найдено исходных баз: {args.source}")
+            return 1
+        try:
+            backup_set = BackupManager(args.dir, keep=args.keep).create(sources)
+        except (OSError, sqlite3.Error) as e:
+            print(f"[ERROR] Копия не создана: {e}")
+            return 1
+        print(f"[OK] Копия создана: {backup_set}")
+        return 0
+
+    if args.command == 'list':
+        for backup_set in BackupManager(args.dir).list_sets():
+            with open(backup_set / MANIFEST_NAME, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            size = sum(entry['gz_size'] for entry in manifest['files'])
+            print(f"   {backup_set.name}: баз {len(manifest['files'])}, {size // 1024} КБ, "
+                  f"{manifest['duration']} с")
+        return 0
+
+    manager = BackupManager(args.set.parent)
+    try:
+        if args.command == 'verify':
+            errors = manager.verify(args.set)
+            if errors:
+                for error in errors:
+                    print(f"[ERROR] {error}")
+                return 1
+            print(f"[OK] Набор {args.set} цел")
+            return 0
+
+        restored = manager.restore(args.set, args.target, args.force)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[ERROR] Восстановление не выполнено: {e}")
+        return 1
+    print(f"[OK] Восстановлено: {', '.join(map(str, restored))}")
+    print("[TIP] Для движка memory очистите папку журнала: иначе он применится поверх копии")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
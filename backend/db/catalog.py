@@ -0,0 +1,164 @@
+"""
+Каталог магазина улучшений
+Описание предметов лежит в версионированном файле shop_catalog.json; при загрузке
+цены и эффекты всех уровней считаются заранее, так что запрос к магазину - это
+поиск по словарю и чтение из массива. Файл перечитывается, когда меняется на диске:
+новый каталог собирается целиком и подменяется одной ссылкой
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from array import array
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional, Tuple
+
+log = logging.getLogger('db.catalog')
+
+# Путь к файлу каталога
+CATALOG_PATH = Path(__file__).parent / "shop_catalog.json"
+
+# Как часто проверять, не изменился ли файл (сек)
+CATALOG_CHECK_INTERVAL = 1.0
+
+# Рост цены с каждым уровнем, если в файле не указан свой
+DEFAULT_PRICE_GROWTH = 1.1
+
+
+class CatalogItem:
+    """Предмет магазина с ценами и эффектами всех уровней"""
+
+    __slots__ = ('id', 'name', 'description', 'effect_type', 'effect_value',
+                 'category', 'max_level', 'prices', 'effects')
+
+    def __init__(self, data: Dict, price_growth: float):
+        self.id = str(data['id'])
+        self.name = data['name']
+        self.description = data.get('description', '')
+        self.effect_type = data.get('effect_type')
+        self.effect_value = data.get('effect_value', 0)
+        self.category = data.get('category', '')
+        self.max_level = int(data['max_level'])
+        if self.max_level < 1:
+            raise ValueError(f"max_level of {self.id} must be positive")
+
+        # prices[level] - цена покупки следующего уровня при текущем level (0..max_level)
+        growth = data.get('price_growth', price_growth)
+        self.prices = array('q', (int(data['price'] * (growth ** level)) for level in range(self.max_level + 1)))
+
+        # effects[level] - прибавка эффекта при покупке уровня level + 1
+        effects = data.get('effects') or [self.effect_value] * self.max_level
+        if len(effects) != self.max_level:
+            raise ValueError(f"effects of {self.id} must have max_level values")
+        self.effects = array('q', effects)
+
+    def as_dict(self, current_level: int) -> Dict:
+        """Предмет для API с учетом уровня игрока"""
+        level = min(current_level, self.max_level)
+        return {
+            "id": self.id,
+            "name": self.name,
+            "description": self.description,
+            "price": self.prices[level],
+            "effect_type": self.effect_type,
+            "effect_value": self.effects[level] if level < self.max_level else self.effects[-1],
+            "category": self.category,
+            "max_level": self.max_level,
+            "current_level": current_level,
+            "available": current_level < self.max_level
+        }
+
+
+class CatalogSnapshot(NamedTuple):
+    """Загруженная версия каталога"""
+    version: str
+    items: Tuple[CatalogItem, ...]
+    by_id: Dict[str, CatalogItem]
+
+
+def load_catalog(path: Path) -> CatalogSnapshot:
+    """Прочитать файл каталога; ValueError, если он некорректен"""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    try:
+        data = json.loads(raw)
+        price_growth = data.get('price_growth', DEFAULT_PRICE_GROWTH)
+        items = tuple(CatalogItem(item, price_growth) for item in data['items'])
+    except (KeyError, TypeError, OverflowError, json.JSONDecodeError) as e:
+        raise ValueError(f"Invalid shop catalog {path}: {e}")
+
+    by_id = {item.id: item for item in items}
+    if len(by_id) != len(items):
+        raise ValueError(f"Invalid shop catalog {path}: duplicate item id")
+
+    # Версия из файла плюс хэш содержимого: правка без смены version тоже меняет ключ кэша
+    version = f"{data.get('version', 0)}-{hashlib.sha256(raw).hexdigest()[:8]}"
+    return CatalogSnapshot(version, items, by_id)
+
+
+class ShopCatalog:
+    """Каталог, который перечитывается при изменении файла"""
+
+    def __init__(self, path: Path = CATALOG_PATH, check_interval: float = CATALOG_CHECK_INTERVAL):
+        self.path = Path(path)
+        self.check_interval = check_interval
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._file_key = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def current(self) -> CatalogSnapshot:
+        """Актуальная версия каталога (проверка файла - не чаще check_interval)"""
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return snapshot
+
+        with self._lock:
+            if self._snapshot is None or time.monotonic() - self._checked_at >= self.check_interval:
+                self._reload_if_changed()
+            return self._snapshot
+
+    @property
+    def version(self) -> str:
+        return self.current().version
+
+    def get(self, item_id: str) -> Optional[CatalogItem]:
+        """Предмет по id"""
+        return self.current().by_id.get(item_id)
+
+    def _reload_if_changed(self):
+        """Перечитать файл, если изменились его размер или время записи (вызывается под self._lock)"""
+        self._checked_at = time.monotonic()
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            if self._snapshot is None:
+                raise
+            log.warning("Файл каталога недоступен, остается версия %s: %s", self._snapshot.version, e)
+            return
+
+        file_key = (stat.st_mtime_ns, stat.st_size)
+        if file_key == self._file_key:
+            return
+
+        try:
+            snapshot = load_catalog(self.path)
+        except (OSError, ValueError) as e:
+            if self._snapshot is None:
+                raise
+            # Файл мог быть записан не до конца - перечитаем, когда он снова изменится
+            self._file_key = file_key
+            log.warning("Каталог не перезагружен, остается версия %s: %s", self._snapshot.version, e)
+            return
+
+        if self._snapshot is not None and snapshot.version != self._snapshot.version:
+            log.info("Каталог магазина обновлен: %s -> %s", self._snapshot.version, snapshot.version)
+        self._snapshot = snapshot
+        self._file_key = file_key
+
+
+# Общий каталог процесса
+shop_catalog = ShopCatalog()
@@ -4,21 +4,262 @@
 """
 
 import sqlite3
+import base64
+import binascii
 import json
+import logging
 import time
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
 from contextlib import contextmanager
 
+from db.achievements import ACHIEVEMENTS, ACHIEVEMENTS_BY_ID, Achievement, AchievementTracker
+from db.catalog import shop_catalog
+from db.rows import LeaderRow, ReferralRow, UserProfileRow, WindowLeaderRow, fetch_dicts, fetch_models
+from tracing import current_trace
+
+log = logging.getLogger('db')
+
 # Путь к базе данных
 DB_PATH = Path(__file__).parent / "clicker_game.db"
 SCHEMA_PATH = Path(__file__).parent / "schema.sql"
 
+# Сколько ждать освобождения блокировки записи другим процессом (сек)
+BUSY_TIMEOUT = 5.0
+
+# Бонусы за приглашенных второго и следующих уровней (первый уровень - параметр bonus)
+REFERRAL_UPPER_LEVEL_BONUSES = (20, 5)
+
+# Глубина, до которой хранится замыкание реферального дерева
+REFERRAL_TREE_DEPTH = 10
+
+# Окна лидербордов по заработку; сезон - несколько недель подряд
+LEADERBOARD_WINDOWS = ('day', 'week', 'season')
+SEASON_WEEKS = 4
+
+# Сколько прошлых дневных корзин хранить (недельные - за текущий и прошлый сезон)
+EARNING_DAYS_KEPT = 7
+
+# Сколько трат клиент может прислать одним запросом
+SPEND_BATCH_LIMIT = 100
+
+# Сколько хранить сессии клиентского журнала трат без активности (сек)
+SPEND_SESSION_TTL = 7 * 86400
+
+# Ключ engine_meta: последняя транзакция, учтенная сверкой журнала с балансами
+LEDGER_CHECKED_KEY = 'ledger_checked_tx_id'
+
+# Сколько расхождений перечислять в отчете сверки
+RECONCILE_SAMPLE_LIMIT = 20
+
+# Сколько транзакций проверяет один вызов сверки (остаток - следующим вызовом)
+RECONCILE_BATCH = 50000
+
+# Разделы состояния для дельта-синхронизации; версия каждого улучшения - в разделе upgrade:<id>
+SYNC_SECTIONS = ('coins', 'stats', 'upgrades', 'referrals')
+UPGRADE_SECTION_PREFIX = 'upgrade:'
+
+# Поля game_state в разделах coins и stats (баланс клиент досчитывает по passive_income)
+SYNC_COIN_FIELDS = ('coins', 'last_passive_collection')
+SYNC_STAT_FIELDS = ('total_earned', 'total_spent', 'total_clicks', 'click_power', 'passive_income')
+
+
+def encode_cursor(*values) -> str:
+    """Непрозрачный курсор для keyset-пагинации"""
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    """Разобрать курсор (время, id); ValueError, если он поврежден"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError("Invalid cursor")
+    created_at, last_id = values
+    # bool - подкласс int, но в курсоре его быть не может
+    if (isinstance(created_at, bool) or not isinstance(created_at, (int, float))
+            or isinstance(last_id, bool) or not isinstance(last_id, int)):
+        raise ValueError("Invalid cursor")
+    return created_at, last_id
+
+
+def transactions_page(rows: List[Dict], limit: int) -> Dict:
+    """Страница истории из строк, отсортированных от новых к старым (их на одну больше limit)"""
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id'])
+    return {
+        'transactions': rows,
+        'next_cursor': next_cursor
+    }
+
+
+def referral_rewards(ancestors: List[Tuple[int, int]], bonus: int) -> List[Tuple[int, int, int]]:
+    """Бонусы предкам нового реферала: [(user_id, уровень, сумма)]"""
+    rewards = []
+    for ancestor_id, depth in ancestors:
+        amount = bonus if depth == 0 else (
+            REFERRAL_UPPER_LEVEL_BONUSES[depth - 1] if depth <= len(REFERRAL_UPPER_LEVEL_BONUSES) else 0
+        )
+        if amount:
+            rewards.append((ancestor_id, depth + 1, amount))
+    return rewards
+
+
+def referral_description(referred_id: int, level: int) -> str:
+    """Описание транзакции реферального бонуса"""
+    if level == 1:
+        return f"Реферал {referred_id}"
+    return f"Реферал {referred_id} (уровень {level})"
+
+
+def earning_bucket_keys(timestamp: float) -> Tuple[int, int]:
+    """Номера дневной и недельной корзины для момента времени (UTC, неделя с понедельника)"""
+    day = int(timestamp // 86400)
+    return day, (day + 3) // 7
+
+
+def leaderboard_window(window: str, now: float) -> Tuple[str, int, int, float, float]:
+    """Корзины окна лидерборда: (period, первая, последняя, начало, конец)"""
+    day, week = earning_bucket_keys(now)
+    if window == 'day':
+        return 'day', day, day, day * 86400.0, (day + 1) * 86400.0
+    if window == 'week':
+        first_week = last_week = week
+    elif window == 'season':
+        first_week = week - week % SEASON_WEEKS
+        last_week = first_week + SEASON_WEEKS - 1
+    else:
+        raise ValueError(f"Unknown leaderboard window: {window}")
+    return ('week', first_week, last_week,
+            (first_week * 7 - 3) * 86400.0, ((last_week + 1) * 7 - 3) * 86400.0)
+
+
+def passive_accrual(passive_income: int, last_collection: float, now: float) -> Tuple[int, float]:
+    """Накопленный пассивный доход: (монеты, новое время сбора)
+
+    Время сбора сдвигается только на оплаченные секунды, поэтому дробный остаток
+    не теряется при частых сборах.
+    """
+    elapsed = max(now - (last_collection or 0.0), 0.0)
+    if not passive_income or passive_income <= 0:
+        return 0, now
+    coins = int(passive_income * elapsed)
+    return coins, now - (elapsed - coins / passive_income)
+
+
+def balance_view(coins: int, passive_income: int, last_collection: float, now: float) -> Dict:
+    """Баланс для API: монеты плюс еще не собранный пассивный доход"""
+    accrued, _ = passive_accrual(passive_income, last_collection, now)
+    return {
+        'balance': coins + accrued,
+        'accrued': accrued,
+        'passive_income': passive_income or 0,
+        'server_time': now
+    }
+
+
+def normalize_spends(spends) -> List[Tuple[int, int]]:
+    """Проверить пачку трат [{"seq", "amount"}]: номера возрастают, суммы положительные"""
+    if not isinstance(spends, list) or not spends:
+        raise ValueError("spends must be a non-empty list")
+    if len(spends) > SPEND_BATCH_LIMIT:
+        raise ValueError(f"Too many spends in one batch (max {SPEND_BATCH_LIMIT})")
+    
+    result, previous = [], 0
+    for spend in spends:
+        seq = spend.get('seq') if isinstance(spend, dict) else None
+        amount = spend.get('amount') if isinstance(spend, dict) else None
+        if type(seq) is not int or seq <= previous:
+            raise ValueError("seq must be increasing positive integers")
+        if type(amount) is not int or amount <= 0:
+            raise ValueError("amount must be a positive integer")
+        result.append((seq, amount))
+        previous = seq
+    return result
+
+
+def seq_ranges(seqs: List[int]) -> List[List[int]]:
+    """Возрастающие номера -> диапазоны [[первый, последний], ...]"""
+    ranges = []
+    for seq in seqs:
+        if ranges and ranges[-1][1] == seq - 1:
+            ranges[-1][1] = seq
+        else:
+            ranges.append([seq, seq])
+    return ranges
+
+
+def upgrade_section(upgrade_id: str) -> str:
+    """Раздел версии для уровня одного улучшения"""
+    return UPGRADE_SECTION_PREFIX + upgrade_id
+
+
+def spend_result(balance: Dict, session: Optional[str], last_seq: int, accepted: List[int],
+                 rejected: List[int], duplicate: List[int]) -> Dict:
+    """Ответ на пачку трат: подтвержденные, отклоненные и уже обработанные диапазоны"""
+    data = dict(balance, accepted=seq_ranges(accepted), rejected=seq_ranges(rejected),
+                duplicate=seq_ranges(duplicate))
+    if session:
+        data.update(session=session, last_seq=last_seq)
+    if rejected:
+        return {"success": False, "message": "Недостаточно монет", "data": data}
+    return {"success": True, "message": "Монеты списаны", "data": data}
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Курсор, добавляющий каждый запрос интервалом 'sql' в текущую трассу"""
+    
+    def execute(self, sql, parameters=()):
+        trace = current_trace()
+        if trace is None:
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            trace.add_span('sql', start, time.perf_counter(), sql)
+    
+    def executemany(self, sql, seq_of_parameters):
+        trace = current_trace()
+        if trace is None:
+            return super().executemany(sql, seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            trace.add_span('sql', start, time.perf_counter(), sql)
+
+
+class TracedConnection(sqlite3.Connection):
+    """Подключение, все запросы которого идут через TracedCursor"""
+    
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+    
+    # Connection.execute из C не вызывает переопределенный cursor()
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
 class DatabaseManager:
     """Менеджер для работы с SQLite базой данных"""
     
+    # Можно ли обслуживать одну базу из нескольких процессов (pre-fork воркеры)
+    supports_multiprocess = True
+    
     def __init__(self, db_path: Path = DB_PATH):
         self.db_path = db_path
+        self.achievements = AchievementTracker()
+        self.catalog = shop_catalog
         self.init_database()
     
     def init_database(self):
@@ -32,22 +273,56 @@ class DatabaseManager:
                 schema = f.read()
             
             with self.get_connection() as conn:
+                # Новые базы - с incremental_vacuum (у существующих режим меняет только VACUUM)
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                # WAL: читатели из разных процессов не блокируют писателя
+                conn.execute("PRAGMA journal_mode=WAL")
+                # До уникального индекса по referred_id гонка могла записать второго пригласившего
+                duplicate_referrals = conn.execute("""
+                    SELECT 1 FROM sqlite_master
+                    WHERE name = 'referrals'
+                      AND NOT EXISTS (SELECT 1 FROM sqlite_master WHERE name = 'idx_referrals_referred_id')
+                """).fetchone() and conn.execute("""
+                    SELECT 1 FROM referrals GROUP BY referred_id HAVING COUNT(*) > 1 LIMIT 1
+                """).fetchone()
                 conn.executescript(schema)
                 conn.commit()
                 print("[OK] База данных инициализирована")
+                
+                # Замыкание реферального дерева появилось позже самих рефералов
+                has_referrals = conn.execute("SELECT 1 FROM referrals LIMIT 1").fetchone()
+                has_tree = conn.execute("SELECT 1 FROM referral_team_stats LIMIT 1").fetchone()
+                # Корзины заработка появились позже журнала транзакций
+                has_transactions = conn.execute("SELECT 1 FROM transactions LIMIT 1").fetchone()
+                has_buckets = conn.execute("SELECT 1 FROM earning_buckets LIMIT 1").fetchone()
+            
+            if has_referrals and (not has_tree or duplicate_referrals):
+                self.rebuild_referral_tree()
+                print("[OK] Реферальное дерево построено")
+            if has_transactions and not has_buckets:
+                self.rebuild_earning_buckets()
         else:
             print("[ERROR] Файл схемы не найден!")
     
     @contextmanager
     def get_connection(self):
         """Контекстный менеджер для подключения к БД"""
-        conn = sqlite3.connect(self.db_path)
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT, factory=TracedConnection)
         conn.row_factory = sqlite3.Row  # Позволяет обращаться к колонкам по имени
+        conn.execute("PRAGMA synchronous=NORMAL")  # В режиме WAL безопасно и без fsync на каждый коммит
         try:
             yield conn
         finally:
             conn.close()
     
+    def connection_for(self, user_id: int):
+        """Подключение к базе, где хранятся данные пользователя"""
+        return self.get_connection()
+    
+    def shard_managers(self) -> List['DatabaseManager']:
+        """Все физические базы (для обслуживания и сводных запросов)"""
+        return [self]
+    
     # === МЕТОДЫ ДЛЯ ПОЛЬЗОВАТЕЛЕЙ ===
     
     def create_user(self, user_id: int, telegram_data: Dict = None) -> bool:
@@ -83,7 +358,7 @@ class DatabaseManager:
                 return True
                 
             except sqlite3.Error as e:
-                print(f"Ошибка создания пользователя: {e}")
+                log.error("Ошибка создания пользователя: %s", e, extra={'user_id': user_id})
                 return False
     
     def create_or_update_user(self, user_id: int, telegram_data: Dict = None) -> bool:
@@ -125,31 +400,32 @@ class DatabaseManager:
     
     def get_user_profile(self, user_id: int) -> Dict:
         """Получить профиль пользователя для API"""
-        user_data = self.get_user(user_id)
-        if not user_data:
+        profile = self._get_profile_row(user_id)
+        if profile is None:
             # Создаем пользователя если не существует
             self.create_user(user_id)
-            user_data = self.get_user(user_id)
-        
-        if user_data:
-            return {
-                "user_id": user_data.get("user_id", user_id),
-                "telegram_id": user_data.get("telegram_id", user_id),
-                "username": user_data.get("username", ""),
-                "first_name": user_data.get("first_name", ""),
-                "coins": user_data.get("coins", 0),
-                "total_earned": user_data.get("total_earned", 0),
-                "total_spent": user_data.get("total_spent", 0),
-                "total_clicks": user_data.get("total_clicks", 0),
-                "click_power": user_data.get("click_power", 1),
-                "passive_income": user_data.get("passive_income", 0),
-                "registration_date": user_data.get("registration_date", time.time()),
-                "last_active": user_data.get("last_active", time.time()),
-                "total_purchases": 0,  # TODO: подсчитать из транзакций
-                "referrals_count": self._get_referrals_count(user_id),
-                "referral_earnings": self._get_referral_earnings(user_id)
-            }
-        return {}
+            profile = self._get_profile_row(user_id)
+        return profile.as_dict() if profile else {}
+    
+    def _get_profile_row(self, user_id: int) -> Optional[UserProfileRow]:
+        """Профиль одним запросом: пользователь, игровое состояние и счетчики команды"""
+        with self.get_connection() as conn:
+            rows = fetch_models(conn, UserProfileRow, """
+                SELECT u.user_id, u.telegram_id, u.username, u.first_name,
+                       COALESCE(gs.coins, 0), COALESCE(gs.total_earned, 0),
+                       COALESCE(gs.total_spent, 0), COALESCE(gs.total_clicks, 0),
+                       COALESCE(gs.click_power, 1), COALESCE(gs.passive_income, 0),
+                       u.registration_date, u.last_active,
+                       0,  -- total_purchases, TODO: подсчитать из транзакций
+                       COALESCE((SELECT members FROM referral_team_stats
+                                 WHERE user_id = u.user_id AND depth = 1), 0),
+                       COALESCE((SELECT earnings FROM referral_team_stats
+                                 WHERE user_id = u.user_id AND depth = 0), 0)
+                FROM users u
+                LEFT JOIN game_state gs ON u.user_id = gs.user_id
+                WHERE u.user_id = ?
+            """, (user_id,))
+            return rows[0] if rows else None
     
     def update_user_activity(self, user_id: int):
         """Обновить время последней активности"""
@@ -168,30 +444,32 @@ class DatabaseManager:
             try:
                 # Обновляем баланс
                 if amount > 0:
-                    conn.execute("""
+                    cursor = conn.execute("""
                         UPDATE game_state 
                         SET coins = coins + ?, total_earned = total_earned + ?
                         WHERE user_id = ?
+                        RETURNING total_earned
                     """, (amount, amount, user_id))
+                    row = cursor.fetchone()
+                    if row:
+                        self._track_achievements(conn, user_id, {'total_earned': row['total_earned']})
                 else:
                     conn.execute("""
                         UPDATE game_state 
                         SET coins = coins + ?, total_spent = total_spent + ?
                         WHERE user_id = ?
                     """, (amount, abs(amount), user_id))
+                self._stamp_state(conn, user_id, 'coins', 'stats')
                 
                 # Записываем транзакцию
-                conn.execute("""
-                    INSERT INTO transactions 
-                    (user_id, transaction_type, amount, description, item_id, created_at)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (user_id, transaction_type, amount, description, item_id, time.time()))
+                self._insert_transaction(conn, user_id, transaction_type, amount,
+                                         description=description, item_id=item_id)
                 
                 conn.commit()
                 return True
                 
             except sqlite3.Error as e:
-                print(f"Ошибка обновления монет: {e}")
+                log.error("Ошибка обновления монет: %s", e, extra={'user_id': user_id})
                 return False
     
     def add_coins(self, user_id: int, amount: int, transaction_id: str = None, transaction_type: str = "purchase") -> int:
@@ -199,20 +477,22 @@ class DatabaseManager:
         success = self.update_coins(user_id, amount, transaction_type, f"Purchase: {transaction_id}")
         if success:
             # Возвращаем новый баланс
-            with self.get_connection() as conn:
-                cursor = conn.execute("SELECT coins FROM game_state WHERE user_id = ?", (user_id,))
-                row = cursor.fetchone()
-                return row['coins'] if row else 0
+            return self.get_user_balance(user_id)
         return 0
     
     def update_click_stats(self, user_id: int, clicks: int = 1):
         """Обновить статистику кликов"""
         with self.get_connection() as conn:
-            conn.execute("""
+            cursor = conn.execute("""
                 UPDATE game_state 
                 SET total_clicks = total_clicks + ?
                 WHERE user_id = ?
+                RETURNING total_clicks
             """, (clicks, user_id))
+            row = cursor.fetchone()
+            if row:
+                self._stamp_state(conn, user_id, 'stats')
+                self._track_achievements(conn, user_id, {'total_clicks': row['total_clicks']})
             conn.commit()
     
     def get_user_balance(self, user_id: int) -> int:
@@ -225,6 +505,184 @@ class DatabaseManager:
             row = cursor.fetchone()
             return row['coins'] if row else 0
     
+    def get_balance(self, user_id: int, now: float = None) -> Dict:
+        """Баланс с учетом пассивного дохода, накопленного с последнего сбора"""
+        now = now or time.time()
+        with self.get_connection() as conn:
+            row = conn.execute("""
+                SELECT coins, passive_income, last_passive_collection FROM game_state WHERE user_id = ?
+            """, (user_id,)).fetchone()
+        if not row:
+            return balance_view(0, 0, now, now)
+        return balance_view(row[0], row[1], row[2], now)
+    
+    def spend_coins(self, user_id: int, spends: List[Tuple[int, int]], session: str = None) -> Dict:
+        """Списать пачку трат [(seq, amount)] по порядку; каждая - только если хватает монет
+
+        С session номера seq <= последнего обработанного считаются повтором и не списываются.
+        """
+        now = time.time()
+        with self.get_connection() as conn:
+            try:
+                last_seq = 0
+                if session:
+                    # Запись в сессию сразу берет блокировку записи: повтор той же пачки ждет нас
+                    cursor = conn.execute("""
+                        INSERT INTO spend_sessions (user_id, session, last_seq, updated_at)
+                        VALUES (?, ?, 0, ?)
+                        ON CONFLICT(user_id, session) DO UPDATE SET updated_at = excluded.updated_at
+                        RETURNING last_seq
+                    """, (user_id, session, now))
+                    last_seq = cursor.fetchone()[0]
+                
+                accrued = self._collect_passive(conn, user_id, now)
+                
+                accepted, rejected, duplicate = [], [], []
+                for seq, amount in spends:
+                    if session and seq <= last_seq:
+                        duplicate.append(seq)
+                        continue
+                    cursor = conn.execute("""
+                        UPDATE game_state
+                        SET coins = coins - ?, total_spent = total_spent + ?
+                        WHERE user_id = ? AND coins >= ?
+                        RETURNING coins
+                    """, (amount, amount, user_id, amount))
+                    if cursor.fetchone():
+                        self._insert_transaction(conn, user_id, 'spend', -amount,
+                                                 description=f"Трата #{seq}", created_at=now)
+                        accepted.append(seq)
+                    else:
+                        rejected.append(seq)
+                
+                if session and spends[-1][0] > last_seq:
+                    last_seq = spends[-1][0]
+                    conn.execute("""
+                        UPDATE spend_sessions SET last_seq = ? WHERE user_id = ? AND session = ?
+                    """, (last_seq, user_id, session))
+                if accepted:
+                    self._stamp_state(conn, user_id, 'coins', 'stats')
+                
+                row = conn.execute("""
+                    SELECT coins, passive_income, last_passive_collection FROM game_state WHERE user_id = ?
+                """, (user_id,)).fetchone()
+                conn.commit()
+            except sqlite3.Error as e:
+                log.error("Ошибка списания монет: %s", e, extra={'user_id': user_id})
+                return {"success": False, "message": "Ошибка сервера"}
+        
+        balance = balance_view(row[0], row[1], row[2], now) if row else balance_view(0, 0, now, now)
+        return spend_result(balance, session, last_seq, accepted, rejected, duplicate)
+    
+    def _collect_passive(self, conn, user_id: int, now: float) -> int:
+        """Зачислить накопленный пассивный доход; возвращает сумму"""
+        row = conn.execute("""
+            SELECT passive_income, last_passive_collection FROM game_state WHERE user_id = ?
+        """, (user_id,)).fetchone()
+        if not row:
+            return 0
+        
+        accrued, collected_at = passive_accrual(row[0], row[1], now)
+        # Условие на прежнее время сбора: параллельный сбор не зачислит тот же доход дважды
+        cursor = conn.execute("""
+            UPDATE game_state
+            SET coins = coins + ?, total_earned = total_earned + ?, last_passive_collection = ?
+            WHERE user_id = ? AND last_passive_collection IS ?
+            RETURNING total_earned
+        """, (accrued, accrued, collected_at, user_id, row[1]))
+        updated = cursor.fetchone()
+        if not updated:
+            return 0
+        # Сдвиг времени сбора меняет баланс в разделе stats, даже если монет не набежало
+        if accrued or collected_at != row[1]:
+            self._stamp_state(conn, user_id, 'coins', 'stats')
+        if not accrued:
+            return 0
+        
+        self._insert_transaction(conn, user_id, 'passive_income', accrued, created_at=now)
+        self._track_achievements(conn, user_id, {'total_earned': updated[0]})
+        return accrued
+    
+    def expire_spend_sessions(self, now: float = None, limit: int = None) -> int:
+        """Удалить сессии журнала трат без активности дольше SPEND_SESSION_TTL (не больше limit строк)"""
+        with self.get_connection() as conn:
+            # Таблица WITHOUT ROWID: пачка выбирается по первичному ключу
+            cursor = conn.execute("""
+                DELETE FROM spend_sessions WHERE (user_id, session) IN (
+                    SELECT user_id, session FROM spend_sessions WHERE updated_at < ? LIMIT ?
+                )
+            """, ((now or time.time()) - SPEND_SESSION_TTL, -1 if limit is None else limit))
+            conn.commit()
+            return cursor.rowcount
+    
+    def _insert_transaction(self, conn, user_id: int, transaction_type: str, amount: int,
+                            description: str = None, item_id: str = None,
+                            transaction_id: str = None, created_at: float = None,
+                            achievement_id: str = None):
+        """Записать строку журнала транзакций и обновить агрегаты заработка"""
+        created_at = created_at if created_at is not None else time.time()
+        conn.execute("""
+            INSERT INTO transactions 
+            (user_id, transaction_type, amount, description, item_id, transaction_id, created_at,
+             achievement_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (user_id, transaction_type, amount, description, item_id, transaction_id, created_at,
+              achievement_id))
+        if amount > 0:
+            self._record_earnings(conn, [(user_id, amount, created_at)])
+    
+    def _record_earnings(self, conn, rows: List[Tuple[int, int, float]]):
+        """Добавить заработок [(user_id, сумма, время)] в дневные и недельные корзины"""
+        totals: Dict[Tuple[str, int, int], int] = {}
+        for user_id, amount, created_at in rows:
+            day, week = earning_bucket_keys(created_at)
+            for key in (('day', day, user_id), ('week', week, user_id)):
+                totals[key] = totals.get(key, 0) + amount
+        if not totals:
+            return
+        
+        conn.executemany("""
+            INSERT INTO earning_buckets (period, bucket, user_id, earned)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(period, bucket, user_id) DO UPDATE SET earned = earned + excluded.earned
+        """, [(*key, earned) for key, earned in totals.items()])
+    
+    def get_transactions(self, user_id: int, limit: int = 50, cursor: str = None,
+                         transaction_types: List[str] = None, since: float = None,
+                         until: float = None) -> Dict:
+        """Получить страницу истории транзакций (от новых к старым, курсор - с прошлой страницы)"""
+        with self.connection_for(user_id) as conn:
+            rows = self._query_transactions(conn, user_id, limit, cursor, transaction_types, since, until)
+        return transactions_page([dict(row) for row in rows], limit)
+    
+    def _query_transactions(self, conn, user_id: int, limit: int, cursor: str = None,
+                            transaction_types: List[str] = None, since: float = None,
+                            until: float = None) -> list:
+        """Строки страницы истории из SQLite (на одну больше limit - для курсора)"""
+        query = """
+            SELECT id, transaction_type, amount, description, item_id, transaction_id, created_at
+            FROM transactions
+            WHERE user_id = ?
+        """
+        params = [user_id]
+        if since is not None:
+            query += " AND created_at >= ?"
+            params.append(since)
+        if until is not None:
+            query += " AND created_at < ?"
+            params.append(until)
+        if cursor:
+            created_at, last_id = decode_cursor(cursor)
+            # Сравнение кортежей SQLite превращает в поиск по индексу, а не в сканирование
+            query += " AND (created_at, id) < (?, ?)"
+            params += [created_at, last_id]
+        if transaction_types:
+            query += f" AND transaction_type IN ({', '.join('?' for _ in transaction_types)})"
+            params += list(transaction_types)
+        query += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        params.append(limit + 1)
+        return conn.execute(query, params).fetchall()
+    
     # === МЕТОДЫ ДЛЯ УЛУЧШЕНИЙ ===
     
     def get_user_upgrades(self, user_id: int) -> List[Dict]:
@@ -247,25 +705,14 @@ class DatabaseManager:
     
     def buy_upgrade(self, user_id: int, item_id: str) -> Dict:
         """Купить улучшение (обновленная версия для API)"""
-        # Получаем информацию о предмете из магазина
-        shop_items = self.get_shop_items(user_id)
-        item = next((item for item in shop_items if item['id'] == item_id), None)
-        
-        if not item:
+        # Получаем информацию о предмете из каталога
+        catalog_item = self.catalog.get(item_id)
+        if not catalog_item:
             return {"success": False, "message": "Предмет не найден"}
         
-        if not item['available']:
-            return {"success": False, "message": "Предмет недоступен для покупки"}
-        
         with self.get_connection() as conn:
             try:
-                # Проверяем баланс
-                cursor = conn.execute("SELECT coins FROM game_state WHERE user_id = ?", (user_id,))
-                row = cursor.fetchone()
-                if not row or row['coins'] < item['price']:
-                    return {"success": False, "message": "Недостаточно монет"}
-                
-                # Получаем текущий уровень
+                # Получаем текущий уровень - от него зависит цена
                 cursor = conn.execute("""
                     SELECT level FROM user_upgrades WHERE user_id = ? AND upgrade_id = ?
                 """, (user_id, item_id))
@@ -274,6 +721,16 @@ class DatabaseManager:
                 current_level = current_row['level'] if current_row else 0
                 new_level = current_level + 1
                 
+                item = catalog_item.as_dict(current_level)
+                if not item['available']:
+                    return {"success": False, "message": "Предмет недоступен для покупки"}
+                
+                # Проверяем баланс
+                cursor = conn.execute("SELECT coins FROM game_state WHERE user_id = ?", (user_id,))
+                row = cursor.fetchone()
+                if not row or row['coins'] < item['price']:
+                    return {"success": False, "message": "Недостаточно монет"}
+                
                 # Обновляем или создаем запись об улучшении
                 if current_row:
                     conn.execute("""
@@ -310,11 +767,13 @@ class DatabaseManager:
                 """, (item['price'], item['price'], user_id))
                 
                 # Записываем транзакцию
-                conn.execute("""
-                    INSERT INTO transactions 
-                    (user_id, transaction_type, amount, item_id, created_at)
-                    VALUES (?, 'upgrade_purchase', ?, ?, ?)
-                """, (user_id, -item['price'], item_id, time.time()))
+                self._insert_transaction(conn, user_id, 'upgrade_purchase', -item['price'], item_id=item_id)
+                self._stamp_state(conn, user_id, 'coins', 'stats', upgrade_section(item_id))
+                
+                cursor = conn.execute("""
+                    SELECT COALESCE(SUM(level), 0) FROM user_upgrades WHERE user_id = ?
+                """, (user_id,))
+                achievements = self._track_achievements(conn, user_id, {'upgrade_levels': cursor.fetchone()[0]})
                 
                 conn.commit()
                 
@@ -332,156 +791,311 @@ class DatabaseManager:
                         "user_stats": {
                             "click_power": user_stats['click_power'],
                             "passive_income": user_stats['passive_income']
-                        }
+                        },
+                        "achievements": achievements
                     }
                 }
                 
             except sqlite3.Error as e:
-                print(f"Ошибка покупки улучшения: {e}")
+                log.error("Ошибка покупки улучшения: %s", e, extra={'user_id': user_id})
                 return {"success": False, "message": "Ошибка сервера"}
     
     def get_shop_items(self, user_id: int) -> List[Dict]:
         """Получить список предметов в магазине"""
-        # Получаем текущие улучшения пользователя
-        user_upgrades = {}
+        user_upgrades = self._get_upgrade_levels(user_id)
+        return [item.as_dict(user_upgrades.get(item.id, 0)) for item in self.catalog.current().items]
+    
+    def _get_upgrade_levels(self, user_id: int) -> Dict[str, int]:
+        """Получить уровни улучшений пользователя: upgrade_id -> level"""
         with self.get_connection() as conn:
             cursor = conn.execute("""
                 SELECT upgrade_id, level FROM user_upgrades WHERE user_id = ?
             """, (user_id,))
-            user_upgrades = {row['upgrade_id']: row['level'] for row in cursor.fetchall()}
-        
-        # Список доступных улучшений
-        shop_items = [
-            {
-                "id": "click_power_1",
-                "name": "Улучшенный клик",
-                "description": "+1 монета за клик",
-                "price": 50,
-                "effect_type": "click_power",
-                "effect_value": 1,
-                "category": "click",
-                "max_level": 50
-            },
-            {
-                "id": "click_power_5",
-                "name": "Мощный клик",
-                "description": "+5 монет за клик",
-                "price": 200,
-                "effect_type": "click_power",
-                "effect_value": 5,
-                "category": "click",
-                "max_level": 20
-            },
-            {
-                "id": "passive_income_1",
-                "name": "Пассивный доход",
-                "description": "+1 монета в секунду",
-                "price": 100,
-                "effect_type": "passive_income",
-                "effect_value": 1,
-                "category": "passive",
-                "max_level": 100
-            },
-            {
-                "id": "passive_income_10",
-                "name": "Мега-генератор",
-                "description": "+10 монет в секунду",
-                "price": 1000,
-                "effect_type": "passive_income",
-                "effect_value": 10,
-                "category": "passive",
-                "max_level": 50
-            }
-        ]
-        
-        # Обогащаем данные о предметах
-        for item in shop_items:
-            current_level = user_upgrades.get(item['id'], 0)
-            item['current_level'] = current_level
-            item['available'] = current_level < item['max_level']
-            item['price'] = int(item['price'] * (1.1 ** current_level))  # Цена растет с каждым уровнем
-        
-        return shop_items
-    
+            return {row['upgrade_id']: row['level'] for row in cursor.fetchall()}
     
     # === МЕТОДЫ ДЛЯ РЕФЕРАЛОВ ===
     
     def add_referral(self, referrer_id: int, referred_id: int, bonus: int = 100) -> bool:
-        """Добавить реферала"""
+        """Добавить реферала (бонусы получают все предки до REFERRAL_UPPER_LEVEL_BONUSES уровней)"""
         with self.get_connection() as conn:
             try:
-                # Проверяем, что реферал еще не добавлен
-                cursor = conn.execute("""
-                    SELECT id FROM referrals 
-                    WHERE referrer_id = ? AND referred_id = ?
-                """, (referrer_id, referred_id))
-                
-                if cursor.fetchone():
-                    return False  # Уже существует
-                
-                # Добавляем реферала
-                conn.execute("""
-                    INSERT INTO referrals (referrer_id, referred_id, created_at, bonus_paid)
-                    VALUES (?, ?, ?, ?)
-                """, (referrer_id, referred_id, time.time(), bonus))
-                
-                # Обновляем реферера в таблице пользователей
-                conn.execute("""
-                    UPDATE users SET referrer_id = ? WHERE user_id = ?
-                """, (referrer_id, referred_id))
+                # Проверки и запись - под одной блокировкой записи: параллельный запрос их не проскочит
+                conn.execute("BEGIN IMMEDIATE")
+                linked = self._insert_referral(conn, referrer_id, referred_id, bonus)
+                if linked is None:
+                    return False  # Уже есть пригласивший или получился бы цикл
+                team, rewards = linked
+                self._credit_referral_rewards(conn, referred_id, rewards)
                 
-                # Начисляем бонус рефереру
-                conn.execute("""
-                    UPDATE game_state 
-                    SET coins = coins + ?, total_earned = total_earned + ?
-                    WHERE user_id = ?
-                """, (bonus, bonus, referrer_id))
-                
-                # Записываем транзакцию
-                conn.execute("""
-                    INSERT INTO transactions 
-                    (user_id, transaction_type, amount, description, created_at)
-                    VALUES (?, 'referral_bonus', ?, ?, ?)
-                """, (referrer_id, bonus, f"Реферал {referred_id}", time.time()))
+                # У всех предков изменились счетчики команды
+                for user_id in team:
+                    self._stamp_state(conn, user_id, 'referrals')
                 
                 conn.commit()
                 return True
                 
             except sqlite3.Error as e:
-                print(f"Ошибка добавления реферала: {e}")
+                log.error("Ошибка добавления реферала: %s", e, extra={'user_id': referred_id, 'referrer_id': referrer_id})
+                return False
+    
+    def _credit_referral_rewards(self, conn, referred_id: int, rewards: List[Tuple[int, int, int]]):
+        """Начислить бонусы по уровням [(user_id, уровень, сумма)] в открытой транзакции"""
+        for ancestor_id, level, amount in rewards:
+            cursor = conn.execute("""
+                UPDATE game_state 
+                SET coins = coins + ?, total_earned = total_earned + ?
+                WHERE user_id = ?
+                RETURNING total_earned
+            """, (amount, amount, ancestor_id))
+            row = cursor.fetchone()
+            if row:
+                self._track_achievements(conn, ancestor_id, {'total_earned': row['total_earned']})
+            self._stamp_state(conn, ancestor_id, 'coins', 'stats')
+            
+            # Записываем транзакцию
+            self._insert_transaction(conn, ancestor_id, 'referral_bonus', amount,
+                                     description=referral_description(referred_id, level))
+    
+    def apply_referral_step(self, referred_id: int, ancestors: List[Tuple[int, int]],
+                            descendants: List[Tuple[int, int]], rewards: List[Tuple[int, int, int]],
+                            now: float) -> bool:
+        """Часть привязки реферала для предков из этой базы (шардированный режим)
+        
+        Замыкание, счетчики команд и бонусы пишутся одной транзакцией вместе с отметкой
+        в referral_steps: повтор после сбоя ничего не начисляет второй раз.
+        """
+        with self.get_connection() as conn:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                if self._referral_step_done(conn, referred_id):
+                    conn.rollback()
+                    return True
+                self._link_referral_step(conn, referred_id, ancestors, descendants, rewards, now)
+                self._credit_referral_rewards(conn, referred_id, rewards)
+                conn.commit()
+                return True
+            except sqlite3.Error as e:
+                log.error("Ошибка привязки реферала: %s", e, extra={'user_id': referred_id})
                 return False
     
-    def get_referral_stats(self, user_id: int) -> Dict:
-        """Получить статистику рефералов"""
+    def _referral_step_done(self, conn, referred_id: int) -> bool:
+        """Записана ли уже в этой базе часть привязки referred_id"""
+        cursor = conn.execute("SELECT 1 FROM referral_steps WHERE referred_id = ?", (referred_id,))
+        return cursor.fetchone() is not None
+    
+    def _link_referral_step(self, conn, referred_id: int, ancestors: List[Tuple[int, int]],
+                            descendants: List[Tuple[int, int]], rewards: List[Tuple[int, int, int]],
+                            now: float):
+        """Замыкание, счетчики команд и отметка шага (без начисления монет)"""
+        self._link_team(conn, ancestors, descendants, now)
+        self._bump_team_stats(conn, [(user_id, level, 0, amount) for user_id, level, amount in rewards])
+        conn.execute("""
+            INSERT INTO referral_steps (referred_id, created_at) VALUES (?, ?)
+        """, (referred_id, now))
+    
+    def _insert_referral(self, conn, referrer_id: int, referred_id: int,
+                         bonus: int) -> Optional[Tuple[List[int], List[Tuple[int, int, int]]]]:
+        """Записать связь и обновить замыкание дерева
+        
+        Возвращает предков, чьи команды выросли, и бонусы [(user_id, уровень, сумма)].
+        """
+        if referrer_id == referred_id:
+            return None
+        
+        # У пользователя может быть только один пригласивший (уникальный индекс по referred_id)
+        cursor = conn.execute("""
+            SELECT 1 FROM referrals WHERE referred_id = ?
+        """, (referred_id,))
+        if cursor.fetchone():
+            return None
+        
+        if self._is_referral_ancestor(conn, referred_id, referrer_id):
+            return None
+        ancestors = self._get_ancestors(conn, referrer_id)
+        descendants = self._get_descendants(conn, referred_id)
+        
+        now = time.time()
+        conn.execute("""
+            INSERT INTO referrals (referrer_id, referred_id, created_at, bonus_paid)
+            VALUES (?, ?, ?, ?)
+        """, (referrer_id, referred_id, now, bonus))
+        
+        # Обновляем реферера в таблице пользователей
+        conn.execute("""
+            UPDATE users SET referrer_id = ? WHERE user_id = ?
+        """, (referrer_id, referred_id))
+        
+        self._link_team(conn, ancestors, descendants, now)
+        
+        rewards = referral_rewards(ancestors, bonus)
+        self._bump_team_stats(conn, [(user_id, level, 0, amount) for user_id, level, amount in rewards])
+        return [ancestor_id for ancestor_id, _ in ancestors], rewards
+    
+    def _is_referral_ancestor(self, conn, ancestor_id: int, user_id: int) -> bool:
+        """Есть ли ancestor_id в цепочке пригласивших user_id (на любой глубине)"""
+        # Замыкание хранит только REFERRAL_TREE_DEPTH уровней, поэтому цикл ищем по users.referrer_id;
+        # UNION останавливает обход, даже если цикл уже есть в данных
+        cursor = conn.execute("""
+            WITH RECURSIVE chain(user_id) AS (
+                SELECT ?
+                UNION
+                SELECT u.referrer_id FROM users u JOIN chain c ON u.user_id = c.user_id
+                WHERE u.referrer_id IS NOT NULL
+            )
+            SELECT 1 FROM chain WHERE user_id = ? LIMIT 1
+        """, (user_id, ancestor_id))
+        return cursor.fetchone() is not None
+    
+    def _get_ancestors(self, conn, user_id: int) -> List[Tuple[int, int]]:
+        """Сам пользователь (глубина 0) и его предки с глубиной"""
+        cursor = conn.execute("""
+            SELECT ancestor_id, depth FROM referral_closure
+            WHERE descendant_id = ? AND depth < ?
+        """, (user_id, REFERRAL_TREE_DEPTH))
+        return [(user_id, 0)] + [(row['ancestor_id'], row['depth']) for row in cursor.fetchall()]
+    
+    def _get_descendants(self, conn, user_id: int) -> List[Tuple[int, int]]:
+        """Сам пользователь (глубина 0) и его команда с глубиной"""
+        cursor = conn.execute("""
+            SELECT descendant_id, depth FROM referral_closure
+            WHERE ancestor_id = ? AND depth < ?
+        """, (user_id, REFERRAL_TREE_DEPTH))
+        return [(user_id, 0)] + [(row['descendant_id'], row['depth']) for row in cursor.fetchall()]
+    
+    def _link_team(self, conn, ancestors: List[Tuple[int, int]],
+                   descendants: List[Tuple[int, int]], now: float):
+        """Добавить пары предок/потомок в замыкание и счетчики команд"""
+        pairs = [
+            (ancestor_id, descendant_id, ancestor_depth + descendant_depth + 1, now)
+            for ancestor_id, ancestor_depth in ancestors
+            for descendant_id, descendant_depth in descendants
+            if ancestor_depth + descendant_depth + 1 <= REFERRAL_TREE_DEPTH
+        ]
+        conn.executemany("""
+            INSERT OR IGNORE INTO referral_closure (ancestor_id, descendant_id, depth, created_at)
+            VALUES (?, ?, ?, ?)
+        """, pairs)
+        
+        members: Dict[Tuple[int, int], int] = {}
+        for ancestor_id, _, depth, _ in pairs:
+            members[(ancestor_id, depth)] = members.get((ancestor_id, depth), 0) + 1
+        self._bump_team_stats(conn, [(user_id, depth, count, 0) for (user_id, depth), count in members.items()])
+        
+        # Команды предков выросли - проверяем реферальные достижения
+        for user_id, _ in ancestors:
+            cursor = conn.execute("""
+                SELECT depth, members FROM referral_team_stats WHERE user_id = ? AND depth <= 1
+            """, (user_id,))
+            team = {row['depth']: row['members'] for row in cursor.fetchall()}
+            self._track_achievements(conn, user_id, {
+                'team_size': team.get(0, 0), 'referrals': team.get(1, 0)
+            })
+    
+    def _bump_team_stats(self, conn, rows: List[Tuple[int, int, int, int]]):
+        """Прибавить (user_id, глубина, участники, доход) к счетчикам уровня и итогу (глубина 0)"""
+        totals: Dict[Tuple[int, int], List[int]] = {}
+        for user_id, depth, members, earnings in rows:
+            for key in ((user_id, depth), (user_id, 0)):
+                total = totals.setdefault(key, [0, 0])
+                total[0] += members
+                total[1] += earnings
+        
+        conn.executemany("""
+            INSERT INTO referral_team_stats (user_id, depth, members, earnings)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, depth) DO UPDATE SET
+                members = members + excluded.members,
+                earnings = earnings + excluded.earnings
+        """, [(user_id, depth, members, earnings) for (user_id, depth), (members, earnings) in totals.items()])
+    
+    def rebuild_referral_tree(self):
+        """Пересобрать замыкание дерева и счетчики команд из таблицы referrals
+        
+        Доход восстанавливается только по первому уровню (bonus_paid): это миграция
+        данных, записанных до появления многоуровневых бонусов.
+        """
+        with self.get_connection() as conn:
+            conn.execute("DELETE FROM referral_closure")
+            conn.execute("DELETE FROM referral_team_stats")
+            
+            cursor = conn.execute("""
+                SELECT referrer_id, referred_id, created_at, bonus_paid FROM referrals
+                ORDER BY created_at, id
+            """)
+            for row in cursor.fetchall():
+                referrer_id, referred_id = row['referrer_id'], row['referred_id']
+                linked = conn.execute("""
+                    SELECT 1 FROM referral_closure WHERE descendant_id = ? AND depth = 1
+                """, (referred_id,)).fetchone()
+                ancestors = self._get_ancestors(conn, referrer_id)
+                if linked or referrer_id == referred_id or any(a == referred_id for a, _ in ancestors):
+                    continue
+                
+                self._link_team(conn, ancestors, self._get_descendants(conn, referred_id), row['created_at'])
+                self._bump_team_stats(conn, [(referrer_id, 1, 0, row['bonus_paid'] or 0)])
+            
+            conn.commit()
+    
+    def get_team_stats(self, user_id: int, depth: int = 0) -> Dict:
+        """Размер и доход команды на уровне depth (0 - все уровни)"""
         with self.get_connection() as conn:
-            # Получаем рефералов
             cursor = conn.execute("""
-                SELECT r.referred_id, r.created_at, r.bonus_paid,
-                       u.username, u.first_name, gs.total_earned
+                SELECT members, earnings FROM referral_team_stats WHERE user_id = ? AND depth = ?
+            """, (user_id, depth))
+            row = cursor.fetchone()
+            return {
+                'depth': depth,
+                'members': row['members'] if row else 0,
+                'earnings': row['earnings'] if row else 0
+            }
+    
+    def get_referral_stats(self, user_id: int, limit: int = 50, cursor: str = None) -> Dict:
+        """Получить статистику рефералов и страницу приглашенных (курсор - с прошлой страницы)"""
+        with self.get_connection() as conn:
+            # Страница приглашенных: от новых к старым по (created_at, id)
+            query = """
+                SELECT r.referred_id, COALESCE(u.username, ''), COALESCE(u.first_name, ''),
+                       r.created_at, COALESCE(gs.total_earned, 0), r.id
                 FROM referrals r
                 LEFT JOIN users u ON r.referred_id = u.user_id
                 LEFT JOIN game_state gs ON r.referred_id = gs.user_id
                 WHERE r.referrer_id = ?
-                ORDER BY r.created_at DESC
-            """, (user_id,))
+            """
+            params = [user_id]
+            if cursor:
+                created_at, last_id = decode_cursor(cursor)
+                query += " AND (r.created_at, r.id) < (?, ?)"
+                params += [created_at, last_id]
+            query += " ORDER BY r.created_at DESC, r.id DESC LIMIT ?"
+            params.append(limit + 1)
             
-            referrals = []
-            total_earnings = 0
+            rows = fetch_models(conn, ReferralRow, query, params)
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = encode_cursor(rows[-1].registration_date, rows[-1].id)
             
-            for row in cursor.fetchall():
-                referrals.append({
-                    'user_id': row['referred_id'],
-                    'username': row['username'] or '',
-                    'first_name': row['first_name'] or '',
-                    'registration_date': row['created_at'],
-                    'total_earned': row['total_earned'] or 0
-                })
-                total_earnings += row['bonus_paid'] or 0
+            # Счетчики команды - по одной строке на уровень
+            cursor = conn.execute("""
+                SELECT depth, members, earnings FROM referral_team_stats
+                WHERE user_id = ? ORDER BY depth
+            """, (user_id,))
+            levels = {row['depth']: (row['members'], row['earnings']) for row in cursor.fetchall()}
+            team_size, team_earnings = levels.pop(0, (0, 0))
             
             return {
-                'total_referrals': len(referrals),
-                'total_earnings': total_earnings,
-                'referrals': referrals
+                'total_referrals': levels.get(1, (0, 0))[0],
+                'total_earnings': team_earnings,
+                'team': {
+                    'size': team_size,
+                    'earnings': team_earnings,
+                    'levels': [
+                        {'depth': depth, 'members': members, 'earnings': earnings}
+                        for depth, (members, earnings) in sorted(levels.items())
+                    ]
+                },
+                'referrals': [row.as_dict() for row in rows],
+                'next_cursor': next_cursor
             }
     
     def generate_referral_link(self, user_id: int) -> str:
@@ -489,59 +1103,441 @@ class DatabaseManager:
         # Простая реализация - в реальном проекте может быть сложнее
         return f"https://t.me/your_bot_name?start=ref_{user_id}"
     
-    def _get_referrals_count(self, user_id: int) -> int:
-        """Получить количество рефералов пользователя"""
+    def _get_referral_totals(self, user_id: int) -> Tuple[int, int]:
+        """Число прямых рефералов и доход от рефералов со всех уровней"""
+        totals = self._get_team_totals(user_id)
+        return totals['referrals_count'], totals['referral_earnings']
+    
+    def _get_team_totals(self, user_id: int) -> Dict:
+        """Прямые рефералы, размер команды и доход со всех уровней"""
         with self.get_connection() as conn:
             cursor = conn.execute("""
-                SELECT COUNT(*) as count FROM referrals WHERE referrer_id = ?
+                SELECT depth, members, earnings FROM referral_team_stats
+                WHERE user_id = ? AND depth IN (0, 1)
             """, (user_id,))
-            row = cursor.fetchone()
-            return row['count'] if row else 0
+            levels = {depth: (members, earnings) for depth, members, earnings in cursor.fetchall()}
+        team_size, team_earnings = levels.get(0, (0, 0))
+        return {
+            'referrals_count': levels.get(1, (0, 0))[0],
+            'team_size': team_size,
+            'referral_earnings': team_earnings
+        }
+    
+    # === МЕТОДЫ ДЛЯ ДОСТИЖЕНИЙ ===
     
-    def _get_referral_earnings(self, user_id: int) -> int:
-        """Получить доходы от рефералов"""
+    def _track_achievements(self, conn, user_id: int, stats: Dict[str, int]) -> List[str]:
+        """Проверить пороги после изменения статистики; вернуть id открытых достижений"""
+        if not self.achievements.needs_check(user_id, stats):
+            return []
+        return [rule.id for rule in self.achievements.unlock(conn, user_id, stats, time.time())]
+    
+    def _get_achievement_stats(self, conn, user_id: int) -> Dict[str, int]:
+        """Текущие значения всех отслеживаемых статистик игрока"""
+        row = conn.execute("""
+            SELECT total_clicks, total_earned FROM game_state WHERE user_id = ?
+        """, (user_id,)).fetchone()
+        team = {
+            row['depth']: row['members'] for row in conn.execute("""
+                SELECT depth, members FROM referral_team_stats WHERE user_id = ? AND depth <= 1
+            """, (user_id,))
+        }
+        upgrade_levels = conn.execute("""
+            SELECT COALESCE(SUM(level), 0) FROM user_upgrades WHERE user_id = ?
+        """, (user_id,)).fetchone()[0]
+        return {
+            'total_clicks': row['total_clicks'] if row else 0,
+            'total_earned': row['total_earned'] if row else 0,
+            'referrals': team.get(1, 0),
+            'team_size': team.get(0, 0),
+            'upgrade_levels': upgrade_levels
+        }
+    
+    def get_achievements(self, user_id: int) -> List[Dict]:
+        """Получить список достижений с прогрессом игрока"""
         with self.get_connection() as conn:
+            stats = self._get_achievement_stats(conn, user_id)
             cursor = conn.execute("""
-                SELECT SUM(bonus_paid) as total FROM referrals WHERE referrer_id = ?
+                SELECT achievement_id, unlocked_at, claimed_at FROM user_achievements WHERE user_id = ?
             """, (user_id,))
-            row = cursor.fetchone()
-            return row['total'] if row and row['total'] else 0
+            rows = {row['achievement_id']: row for row in cursor.fetchall()}
+        
+        achievements = []
+        for rule in ACHIEVEMENTS:
+            row = rows.get(rule.id)
+            achievements.append({
+                'id': rule.id,
+                'title': rule.title,
+                'description': rule.description,
+                'reward': rule.reward,
+                'threshold': rule.threshold,
+                'progress': min(stats.get(rule.stat, 0), rule.threshold),
+                'unlocked_at': row['unlocked_at'] if row else None,
+                'claimed_at': row['claimed_at'] if row else None
+            })
+        return achievements
+    
+    def claim_achievements(self, user_id: int, achievement_id: str = None) -> Dict:
+        """Забрать награду за открытое достижение (без achievement_id - за все сразу)"""
+        if achievement_id is not None and achievement_id not in ACHIEVEMENTS_BY_ID:
+            return {"success": False, "message": "Достижение не найдено"}
+        
+        with self.get_connection() as conn:
+            try:
+                now = time.time()
+                rules = self._mark_claimed(conn, user_id, achievement_id, now)
+                if not rules:
+                    conn.rollback()
+                    return {"success": False, "message": "Нет наград, которые можно получить"}
+                
+                reward = sum(rule.reward for rule in rules)
+                cursor = conn.execute("""
+                    UPDATE game_state 
+                    SET coins = coins + ?, total_earned = total_earned + ?
+                    WHERE user_id = ?
+                    RETURNING coins, total_earned
+                """, (reward, reward, user_id))
+                row = cursor.fetchone()
+                self._stamp_state(conn, user_id, 'coins', 'stats')
+                for rule in rules:
+                    self._insert_transaction(conn, user_id, 'achievement_reward', rule.reward,
+                                             description=f"Достижение «{rule.title}»",
+                                             achievement_id=rule.id, created_at=now)
+                unlocked = self._track_achievements(conn, user_id, {'total_earned': row['total_earned']}) if row else []
+                
+                conn.commit()
+                return {
+                    "success": True,
+                    "message": f"Получено монет: {reward}",
+                    "data": {
+                        "claimed": [rule.id for rule in rules],
+                        "reward": reward,
+                        "new_balance": row['coins'] if row else 0,
+                        "achievements": unlocked
+                    }
+                }
+                
+            except sqlite3.Error as e:
+                log.error("Ошибка получения награды за достижение: %s", e, extra={'user_id': user_id})
+                return {"success": False, "message": "Ошибка сервера"}
+    
+    def _mark_claimed(self, conn, user_id: int, achievement_id: Optional[str], now: float) -> List[Achievement]:
+        """Отметить награды полученными; вернуть правила, награду за которые нужно начислить"""
+        # Отметка claimed_at и есть блокировка: повторный запрос ничего не найдет
+        cursor = conn.execute("""
+            UPDATE user_achievements SET claimed_at = ?
+            WHERE user_id = ? AND unlocked_at IS NOT NULL AND claimed_at IS NULL
+              AND (? IS NULL OR achievement_id = ?)
+            RETURNING achievement_id
+        """, (now, user_id, achievement_id, achievement_id))
+        return [ACHIEVEMENTS_BY_ID[row[0]] for row in cursor.fetchall() if row[0] in ACHIEVEMENTS_BY_ID]
     
     # === МЕТОДЫ ДЛЯ ЛИДЕРБОРДА ===
     
     def get_leaderboard(self, limit: int = 10) -> List[Dict]:
         """Получить таблицу лидеров"""
         with self.get_connection() as conn:
-            cursor = conn.execute("""
-                SELECT u.user_id, u.username, u.first_name,
-                       gs.total_earned, gs.total_clicks, gs.coins
+            return fetch_dicts(conn, LeaderRow, """
+                SELECT u.user_id, COALESCE(u.username, ''), COALESCE(u.first_name, ''),
+                       COALESCE(gs.total_earned, 0), COALESCE(gs.total_clicks, 0), COALESCE(gs.coins, 0)
                 FROM users u
                 LEFT JOIN game_state gs ON u.user_id = gs.user_id
                 ORDER BY gs.total_earned DESC
                 LIMIT ?
-            """, (limit,))
+            """, (limit,), ranked=True)
+    
+    def get_windowed_leaderboard(self, window: str = 'week', limit: int = 10,
+                                 now: float = None) -> Dict:
+        """Получить таблицу лидеров по заработку за день, неделю или сезон"""
+        period, first, last, starts_at, ends_at = leaderboard_window(window, now or time.time())
+        with self.get_connection() as conn:
+            if first == last:
+                # Одна корзина: первые строки индекса (period, bucket, earned DESC)
+                leaders = fetch_dicts(conn, WindowLeaderRow, """
+                    SELECT eb.user_id, COALESCE(u.username, ''), COALESCE(u.first_name, ''), eb.earned
+                    FROM earning_buckets eb
+                    LEFT JOIN users u ON u.user_id = eb.user_id
+                    WHERE eb.period = ? AND eb.bucket = ?
+                    ORDER BY eb.earned DESC, eb.user_id
+                    LIMIT ?
+                """, (period, first, limit), ranked=True)
+            else:
+                # Сезон: сумма нескольких недельных корзин
+                leaders = fetch_dicts(conn, WindowLeaderRow, """
+                    SELECT t.user_id, COALESCE(u.username, ''), COALESCE(u.first_name, ''), t.earned
+                    FROM (
+                        SELECT user_id, SUM(earned) AS earned
+                        FROM earning_buckets
+                        WHERE period = ? AND bucket BETWEEN ? AND ?
+                        GROUP BY user_id
+                    ) t
+                    LEFT JOIN users u ON u.user_id = t.user_id
+                    ORDER BY t.earned DESC, t.user_id
+                    LIMIT ?
+                """, (period, first, last, limit), ranked=True)
             
-            leaderboard = []
-            for i, row in enumerate(cursor.fetchall(), 1):
-                leaderboard.append({
-                    'position': i,
-                    'user_id': row['user_id'],
-                    'username': row['username'] or '',
-                    'first_name': row['first_name'] or '',
-                    'total_earned': row['total_earned'] or 0,
-                    'total_clicks': row['total_clicks'] or 0,
-                    'coins': row['coins'] or 0
-                })
+            return {
+                'window': window,
+                'starts_at': starts_at,
+                'ends_at': ends_at,
+                'leaders': leaders
+            }
+    
+    def expire_earning_buckets(self, now: float = None, limit: int = None) -> int:
+        """Удалить корзины заработка за пределами всех окон (не больше limit строк); возвращает число строк"""
+        with self.get_connection() as conn:
+            deleted = self._expire_earning_buckets(conn, now or time.time(), limit)
+            conn.commit()
+            return deleted
+    
+    def _expire_earning_buckets(self, conn, now: float, limit: int = None) -> int:
+        """Удалить старые корзины в текущей транзакции"""
+        day, week = earning_bucket_keys(now)
+        season_start = week - week % SEASON_WEEKS
+        deleted = 0
+        for period, oldest in (('day', day - EARNING_DAYS_KEPT), ('week', season_start - SEASON_WEEKS)):
+            if limit is not None and deleted >= limit:
+                break
+            # LIMIT -1 - без ограничения
+            deleted += conn.execute("""
+                DELETE FROM earning_buckets WHERE period = ? AND (bucket, user_id) IN (
+                    SELECT bucket, user_id FROM earning_buckets WHERE period = ? AND bucket < ? LIMIT ?
+                )
+            """, (period, period, oldest, -1 if limit is None else limit - deleted)).rowcount
+        return deleted
+    
+    def rebuild_earning_buckets(self):
+        """Пересобрать корзины заработка из журнала транзакций за период хранения"""
+        now = time.time()
+        day, week = earning_bucket_keys(now)
+        first_week = week - week % SEASON_WEEKS - SEASON_WEEKS
+        since = min((day - EARNING_DAYS_KEPT) * 86400.0, (first_week * 7 - 3) * 86400.0)
+        
+        with self.get_connection() as conn:
+            conn.execute("DELETE FROM earning_buckets")
+            cursor = conn.execute("""
+                SELECT user_id, amount, created_at FROM transactions
+                WHERE created_at >= ? AND amount > 0
+            """, (since,))
+            while True:
+                rows = cursor.fetchmany(5000)
+                if not rows:
+                    break
+                self._record_earnings(conn, [tuple(row) for row in rows])
+            self._expire_earning_buckets(conn, now)
+            conn.commit()
+        print("[OK] Корзины заработка для лидербордов построены")
+    
+    # === СВЕРКА ЖУРНАЛА ТРАНЗАКЦИЙ ===
+    
+    def reconcile_ledger(self, repair: bool = False, limit: int = RECONCILE_BATCH) -> Dict:
+        """Сверить балансы с транзакциями, появившимися после прошлой сверки
+        
+        Итоги по уже проверенным транзакциям хранятся в ledger_checkpoints, поэтому
+        проверяются только пользователи с новыми транзакциями, а их число строк читается
+        один раз. За вызов проверяется не больше limit транзакций; complete в отчете -
+        дошла ли сверка до конца журнала. repair=True сдвигает game_state на величину расхождения.
+        """
+        with self.get_connection() as conn:
+            # Журнал и балансы читаются из одного снимка: они меняются в одной транзакции
+            conn.execute("BEGIN")
+            row = conn.execute("SELECT value FROM engine_meta WHERE key = ?", (LEDGER_CHECKED_KEY,)).fetchone()
+            checked_tx_id = int(row[0]) if row else 0
+            # Граница пачки - id limit-й новой транзакции (по первичному ключу, без сканирования)
+            row = conn.execute("""
+                SELECT id FROM transactions WHERE id > ? ORDER BY id LIMIT 1 OFFSET ?
+            """, (checked_tx_id, limit - 1)).fetchone()
+            last_tx_id = row[0] if row else None
+            rows = conn.execute("""
+                SELECT d.user_id, d.last_tx_id, d.tx_count,
+                       COALESCE(c.coins, 0) + d.coins,
+                       COALESCE(c.total_earned, 0) + d.earned,
+                       COALESCE(c.total_spent, 0) + d.spent,
+                       gs.coins, gs.total_earned, gs.total_spent,
+                       -- Баланс уже учел транзакции за границей пачки - сравнивать рано
+                       ? IS NOT NULL AND EXISTS (
+                           SELECT 1 FROM transactions t WHERE t.user_id = d.user_id AND t.id > ?
+                       )
+                FROM (
+                    SELECT user_id, MAX(id) AS last_tx_id, COUNT(*) AS tx_count, SUM(amount) AS coins,
+                           SUM(MAX(amount, 0)) AS earned, SUM(MAX(-amount, 0)) AS spent
+                    -- Только диапазон по id: индекс (user_id, ...) ради GROUP BY обошел бы всю таблицу
+                    FROM transactions NOT INDEXED
+                    WHERE id > ? AND (? IS NULL OR id <= ?)
+                    GROUP BY user_id
+                ) d
+                LEFT JOIN ledger_checkpoints c ON c.user_id = d.user_id
+                LEFT JOIN game_state gs ON gs.user_id = d.user_id
+            """, (last_tx_id, last_tx_id, checked_tx_id, last_tx_id, last_tx_id)).fetchall()
+            conn.rollback()
+            
+            now = time.time()
+            mismatches = []
+            for user_id, _, _, coins, earned, spent, actual_coins, actual_earned, actual_spent, ahead in rows:
+                if ahead or actual_coins is None:
+                    continue
+                if (coins, earned, spent) != (actual_coins, actual_earned, actual_spent):
+                    mismatches.append({
+                        'user_id': user_id,
+                        'coins': [coins, actual_coins],
+                        'total_earned': [earned, actual_earned],
+                        'total_spent': [spent, actual_spent],
+                    })
             
-            return leaderboard
+            # Итоги по журналу запоминаются как есть: расхождение видно и при следующей сверке
+            conn.executemany("""
+                INSERT INTO ledger_checkpoints (user_id, last_tx_id, coins, total_earned, total_spent, checked_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    last_tx_id = excluded.last_tx_id, coins = excluded.coins,
+                    total_earned = excluded.total_earned, total_spent = excluded.total_spent,
+                    checked_at = excluded.checked_at
+            """, [(row[0], row[1], row[3], row[4], row[5], now) for row in rows])
+            if rows:
+                # Отметка - последняя проверенная транзакция, а не граница пачки
+                conn.execute("""
+                    INSERT INTO engine_meta (key, value) VALUES (?, ?)
+                    ON CONFLICT(key) DO UPDATE SET value = excluded.value
+                """, (LEDGER_CHECKED_KEY, str(max(row[1] for row in rows))))
+            conn.commit()
+        
+        if repair:
+            for mismatch in mismatches:
+                self._adjust_totals(mismatch['user_id'], *(
+                    expected - actual for expected, actual in
+                    (mismatch['coins'], mismatch['total_earned'], mismatch['total_spent'])
+                ))
+        
+        return {
+            'users_checked': len(rows),
+            'transactions_checked': sum(row[2] for row in rows),
+            'mismatches': len(mismatches),
+            'repaired': len(mismatches) if repair else 0,
+            'samples': mismatches[:RECONCILE_SAMPLE_LIMIT],
+            'complete': last_tx_id is None,
+        }
+    
+    def _adjust_totals(self, user_id: int, coins: int, total_earned: int, total_spent: int):
+        """Сдвинуть баланс и итоги игрока (сдвиг не зависит от изменений после сверки)"""
+        with self.get_connection() as conn:
+            conn.execute("""
+                UPDATE game_state
+                SET coins = coins + ?, total_earned = total_earned + ?, total_spent = total_spent + ?
+                WHERE user_id = ?
+            """, (coins, total_earned, total_spent, user_id))
+            self._stamp_state(conn, user_id, 'coins', 'stats')
+            conn.commit()
+    
+    # === ДЕЛЬТА-СИНХРОНИЗАЦИЯ СОСТОЯНИЯ ===
+    
+    def _stamp_state(self, conn, user_id: int, *sections: str) -> int:
+        """Отметить разделы состояния игрока следующим номером версии (в транзакции записи)"""
+        # Вызывается после записи в той же транзакции: блокировка уже взята, MAX не устареет
+        version = conn.execute("""
+            SELECT COALESCE(MAX(version), 0) + 1 FROM state_versions WHERE user_id = ?
+        """, (user_id,)).fetchone()[0]
+        conn.executemany("""
+            INSERT INTO state_versions (user_id, section, version) VALUES (?, ?, ?)
+            ON CONFLICT(user_id, section) DO UPDATE SET version = excluded.version
+        """, [(user_id, section, version) for section in sections])
+        return version
+    
+    def touch_state(self, user_ids: List[int], *sections: str):
+        """Отметить изменение разделов отдельной транзакцией (данные уже записаны)"""
+        with self.get_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for user_id in user_ids:
+                self._stamp_state(conn, user_id, *sections)
+            conn.commit()
+    
+    def _get_state_versions(self, user_id: int) -> Tuple[Dict[str, int], int]:
+        """Версии разделов игрока и нижняя граница: версии не старше нее не сохранились"""
+        with self.get_connection() as conn:
+            cursor = conn.execute("""
+                SELECT section, version FROM state_versions WHERE user_id = ?
+            """, (user_id,))
+            return {section: version for section, version in cursor.fetchall()}, 0
+    
+    def _get_game_state(self, user_id: int) -> Optional[Dict]:
+        """Строка game_state для синхронизации"""
+        with self.get_connection() as conn:
+            row = conn.execute(f"""
+                SELECT {', '.join(SYNC_COIN_FIELDS + SYNC_STAT_FIELDS)} FROM game_state WHERE user_id = ?
+            """, (user_id,)).fetchone()
+        return dict(row) if row else None
+    
+    def get_state_changes(self, user_id: int, since: int = None) -> Dict:
+        """Разделы состояния, изменившиеся после версии since
+        
+        Без since, с версией из будущего (база заменена) или старше сохраненных версий
+        клиент получает полный снимок. Если ничего не менялось, читаются только версии.
+        """
+        # Версии читаются раньше данных: данные могут оказаться новее версии, но не старше
+        versions, floor = self._get_state_versions(user_id)
+        version = max(versions.values(), default=floor)
+        full = since is None or since > version or since < floor
+        
+        if full:
+            sections, upgrade_ids = set(SYNC_SECTIONS), None
+        else:
+            changed = [section for section, stamp in versions.items() if stamp > since]
+            upgrade_ids = {section[len(UPGRADE_SECTION_PREFIX):] for section in changed
+                           if section.startswith(UPGRADE_SECTION_PREFIX)}
+            sections = {section for section in changed if section in SYNC_SECTIONS}
+            if upgrade_ids:
+                sections.add('upgrades')
+        
+        data = {}
+        if sections & {'coins', 'stats'}:
+            state = self._get_game_state(user_id)
+            if state is None and full:
+                # Как и профиль, полный снимок создает игрока при первом обращении
+                self.create_user(user_id)
+                state = self._get_game_state(user_id)
+            state = state or {}
+            for section, fields in (('coins', SYNC_COIN_FIELDS), ('stats', SYNC_STAT_FIELDS)):
+                if section in sections:
+                    data[section] = {field: state.get(field, 0) for field in fields}
+        if 'upgrades' in sections:
+            levels = self._get_upgrade_levels(user_id)
+            data['upgrades'] = levels if upgrade_ids is None else {
+                upgrade_id: levels.get(upgrade_id, 0) for upgrade_id in upgrade_ids
+            }
+        if 'referrals' in sections:
+            data['referrals'] = self._get_team_totals(user_id)
+        
+        return {'version': version, 'full': full, 'changed': data}
+    
+    # === ОБЩАЯ СТАТИСТИКА ===
+    
+    def get_global_stats(self) -> Dict:
+        """Получить общую статистику игры"""
+        with self.get_connection() as conn:
+            cursor = conn.execute("""
+                SELECT COUNT(*) as total_users,
+                       COALESCE(SUM(coins), 0) as total_coins,
+                       COALESCE(SUM(total_earned), 0) as total_earned,
+                       COALESCE(SUM(total_spent), 0) as total_spent,
+                       COALESCE(SUM(total_clicks), 0) as total_clicks
+                FROM game_state
+            """)
+            row = cursor.fetchone()
+            stats = dict(row)
+            
+            cursor = conn.execute("SELECT COUNT(*) as total_referrals FROM referrals")
+            stats['total_referrals'] = cursor.fetchone()['total_referrals']
+            return stats
     
     # === МЕТОДЫ ДЛЯ ПОКУПОК МОНЕТ ===
     
     def add_coin_purchase(self, user_id: int, amount: int, price_rub: int, 
                          telegram_payment_id: str) -> bool:
-        """Записать покупку монет за реальные деньги"""
+        """Записать покупку монет за реальные деньги (повтор того же платежа не начисляет монеты)"""
         with self.get_connection() as conn:
             try:
+                # Платеж уже учтен - возвращаем прежний результат
+                if self._coin_purchase_exists(conn, user_id, telegram_payment_id):
+                    return True
+                
                 # Записываем покупку
                 conn.execute("""
                     INSERT INTO coin_purchases 
@@ -550,25 +1546,41 @@ class DatabaseManager:
                 """, (user_id, amount, price_rub, telegram_payment_id, time.time()))
                 
                 # Начисляем монеты
-                conn.execute("""
+                cursor = conn.execute("""
                     UPDATE game_state 
                     SET coins = coins + ?, total_earned = total_earned + ?
                     WHERE user_id = ?
+                    RETURNING total_earned
                 """, (amount, amount, user_id))
+                row = cursor.fetchone()
+                if row:
+                    self._track_achievements(conn, user_id, {'total_earned': row['total_earned']})
+                self._stamp_state(conn, user_id, 'coins', 'stats')
                 
                 # Записываем транзакцию
-                conn.execute("""
-                    INSERT INTO transactions 
-                    (user_id, transaction_type, amount, description, transaction_id, created_at)
-                    VALUES (?, 'purchase', ?, ?, ?, ?)
-                """, (user_id, amount, f"Покупка за {price_rub}₽", telegram_payment_id, time.time()))
+                self._insert_transaction(conn, user_id, 'purchase', amount,
+                                         description=f"Покупка за {price_rub}₽",
+                                         transaction_id=telegram_payment_id)
                 
                 conn.commit()
                 return True
                 
+            except sqlite3.IntegrityError:
+                # Параллельный повтор успел записать этот платеж раньше нас
+                conn.rollback()
+                return self._coin_purchase_exists(conn, user_id, telegram_payment_id)
             except sqlite3.Error as e:
-                print(f"Ошибка записи покупки: {e}")
+                log.error("Ошибка записи покупки: %s", e, extra={'user_id': user_id})
                 return False
+    
+    def _coin_purchase_exists(self, conn, user_id: int, telegram_payment_id: str) -> bool:
+        """Проверить, учтен ли уже платеж этого пользователя"""
+        if not telegram_payment_id:
+            return False
+        cursor = conn.execute("""
+            SELECT 1 FROM coin_purchases WHERE telegram_payment_id = ? AND user_id = ?
+        """, (telegram_payment_id, user_id))
+        return cursor.fetchone() is not None
 
 # Глобальный экземпляр менеджера базы данных
 db_manager = DatabaseManager()
@@ -0,0 +1,66 @@
+"""
+Выбор движка хранения по конфигурации
+DB_ENGINE=sqlite (по умолчанию) - все операции напрямую через SQLite
+DB_ENGINE=memory - состояние игроков в памяти, журнал и снимки в SQLite
+DB_SHARDS=N (N > 1) - пользователи распределяются по N файлам в DB_SHARD_DIR
+DB_PATH - файл базы (по умолчанию db/clicker_game.db)
+"""
+
+import os
+from pathlib import Path
+
+from db.database import DatabaseManager, DB_PATH
+
+
+def configured_engine() -> str:
+    """Движок из DB_ENGINE: sqlite или memory"""
+    engine = os.getenv("DB_ENGINE", "sqlite").lower()
+    if engine not in ("sqlite", "memory"):
+        print(f"[WARN] Неизвестный DB_ENGINE={engine}, используется sqlite")
+        engine = "sqlite"
+    return engine
+
+
+def create_database_manager(db_path: Path = None):
+    """Создать менеджер базы данных для выбранного движка"""
+    db_path = db_path or Path(os.getenv("DB_PATH", str(DB_PATH)))
+    engine = configured_engine()
+
+    num_shards = int(os.getenv("DB_SHARDS", "1"))
+    if num_shards > 1:
+        from db.sharding import ShardedDatabaseManager
+        shard_dir = Path(os.getenv("DB_SHARD_DIR", str(Path(db_path).parent / "shards")))
+        return ShardedDatabaseManager(
+            shard_dir, num_shards,
+            shard_factory=lambda path, index: _create_engine(engine, path, f"journal_{index:02d}")
+        )
+
+    return _create_engine(engine, db_path, "journal")
+
+
+def _create_engine(engine: str, db_path: Path, journal_name: str) -> DatabaseManager:
+    """Создать менеджер одной физической базы"""
+    if engine == "memory":
+        from db.memory_engine import MemoryDatabaseManager
+        journal_dir = Path(os.getenv("MEMORY_JOURNAL_DIR", str(Path(db_path).parent)))
+        return MemoryDatabaseManager(
+            db_path,
+            journal_dir=journal_dir / journal_name,
+            flush_interval=float(os.getenv("MEMORY_JOURNAL_FLUSH_MS", "50")) / 1000,
+            snapshot_interval=float(os.getenv("MEMORY_SNAPSHOT_INTERVAL", "60")),
+            sync_writes=os.getenv("MEMORY_JOURNAL_SYNC", "0") == "1",
+        )
+
+    return DatabaseManager(db_path)
+
+
+def create_client_database_manager(api_url: str, bot_token: str, db_path: Path = None):
+    """Менеджер для процессов вне API (бот)
+
+    Состояние движка в памяти живет в процессе API, поэтому с DB_ENGINE=memory
+    запись идет через его эндпоинты; SQLite и шарды процессы делят напрямую.
+    """
+    if configured_engine() == "memory":
+        from db.remote import RemoteDatabaseManager
+        return RemoteDatabaseManager(api_url, bot_token)
+    return create_database_manager(db_path)
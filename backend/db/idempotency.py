@@ -0,0 +1,181 @@
+"""
+Хранилище ключей идемпотентности для операций записи
+Повтор запроса с тем же ключом возвращает сохраненный ответ без повторного выполнения
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+log = logging.getLogger('db.idempotency')
+
+# Время жизни ключа (сек)
+IDEMPOTENCY_TTL = 24 * 3600
+
+# Сколько держится резерв ключа, если воркер упал, не дописав ответ (сек)
+IDEMPOTENCY_PENDING_TTL = 60
+
+# Сколько последних ключей держим в памяти
+IDEMPOTENCY_CACHE_SIZE = 10000
+
+
+class IdempotencyConflict(Exception):
+    """Ключ уже используется другим запросом или другим телом запроса"""
+
+
+def request_fingerprint(endpoint: str, request_data: Dict) -> str:
+    """Отпечаток запроса, чтобы один ключ нельзя было переиспользовать с другим телом"""
+    payload = json.dumps(request_data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(f"{endpoint}\n{payload}".encode('utf-8')).hexdigest()
+
+
+class IdempotencyStore:
+    """Ограниченный кэш ключей в памяти поверх компактной таблицы SQLite с TTL"""
+
+    def __init__(self, db_manager, ttl: float = IDEMPOTENCY_TTL,
+                 cache_size: int = IDEMPOTENCY_CACHE_SIZE):
+        self.db_manager = db_manager
+        self.ttl = ttl
+        self.cache_size = cache_size
+        # (user_id, key) -> (expires_at, fingerprint, status_code, response_json)
+        self._cache: "OrderedDict[Tuple[int, str], Tuple[float, str, int, str]]" = OrderedDict()
+        self._in_progress = set()
+        self._lock = threading.Lock()
+
+    def begin(self, user_id: int, key: str, endpoint: str,
+              fingerprint: str) -> Optional[Tuple[int, Dict]]:
+        """Начать запрос: вернуть сохраненный ответ или зарезервировать ключ"""
+        cache_key = (user_id, key)
+        now = time.time()
+
+        with self._lock:
+            if cache_key in self._in_progress:
+                raise IdempotencyConflict("Request with this Idempotency-Key is in progress")
+
+            entry = self._cache.get(cache_key)
+            if entry and entry[0] <= now:
+                del self._cache[cache_key]
+                entry = None
+            if entry is None:
+                self._in_progress.add(cache_key)
+            else:
+                self._cache.move_to_end(cache_key)
+
+        if entry is None:
+            # Резерв через SQLite виден всем воркерам, а не только этому процессу
+            try:
+                entry = self._reserve(user_id, key, endpoint, fingerprint, now)
+            except Exception:
+                # Резерв не получен - чужую строку в SQLite не трогаем
+                with self._lock:
+                    self._in_progress.discard(cache_key)
+                raise
+            if entry is None:
+                return None
+            with self._lock:
+                self._in_progress.discard(cache_key)
+                self._remember(cache_key, entry)
+
+        _, stored_fingerprint, status_code, response_json = entry
+        if stored_fingerprint != fingerprint:
+            raise IdempotencyConflict("Idempotency-Key was already used with a different request")
+        return status_code, json.loads(response_json)
+
+    def complete(self, user_id: int, key: str, endpoint: str, fingerprint: str,
+                 status_code: int, response: Dict):
+        """Сохранить результат запроса и снять резерв с ключа"""
+        cache_key = (user_id, key)
+        now = time.time()
+        response_json = json.dumps(response, ensure_ascii=False)
+        entry = (now + self.ttl, fingerprint, status_code, response_json)
+
+        try:
+            with self.db_manager.connection_for(user_id) as conn:
+                conn.execute("""
+                    INSERT OR REPLACE INTO idempotency_keys
+                    (user_id, idempotency_key, endpoint, fingerprint, status_code, response, expires_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (user_id, key, endpoint, fingerprint, status_code, response_json, entry[0]))
+                conn.commit()
+        except sqlite3.Error as e:
+            log.error("Ошибка сохранения ключа идемпотентности: %s", e, extra={'user_id': user_id})
+
+        with self._lock:
+            self._in_progress.discard(cache_key)
+            self._remember(cache_key, entry)
+
+    def abandon(self, user_id: int, key: str):
+        """Снять резерв без сохранения (ошибка сервера - клиент может повторить)"""
+        try:
+            with self.db_manager.connection_for(user_id) as conn:
+                conn.execute("""
+                    DELETE FROM idempotency_keys
+                    WHERE user_id = ? AND idempotency_key = ? AND status_code = 0
+                """, (user_id, key))
+                conn.commit()
+        except sqlite3.Error as e:
+            log.error("Ошибка снятия резерва ключа идемпотентности: %s", e, extra={'user_id': user_id})
+
+        with self._lock:
+            self._in_progress.discard((user_id, key))
+
+    def expire(self, limit: int = None, shards: list = None) -> int:
+        """Удалить просроченные ключи (не больше limit строк в шарде); возвращает число удаленных строк"""
+        now = time.time()
+        with self._lock:
+            for cache_key in [k for k, v in self._cache.items() if v[0] <= now]:
+                del self._cache[cache_key]
+
+        deleted = 0
+        for shard in shards or self.db_manager.shard_managers():
+            with shard.get_connection() as conn:
+                # Таблица WITHOUT ROWID: пачка выбирается по первичному ключу
+                cursor = conn.execute("""
+                    DELETE FROM idempotency_keys WHERE (user_id, idempotency_key) IN (
+                        SELECT user_id, idempotency_key FROM idempotency_keys WHERE expires_at <= ? LIMIT ?
+                    )
+                """, (now, -1 if limit is None else limit))
+                conn.commit()
+                deleted += cursor.rowcount
+        return deleted
+
+    def _reserve(self, user_id: int, key: str, endpoint: str, fingerprint: str, now: float):
+        """Зарезервировать ключ в SQLite; вернуть None или уже сохраненную запись"""
+        with self.db_manager.connection_for(user_id) as conn:
+            # Строка со status_code = 0 - запрос в работе; просроченную можно занять заново
+            cursor = conn.execute("""
+                INSERT INTO idempotency_keys
+                (user_id, idempotency_key, endpoint, fingerprint, status_code, response, expires_at)
+                VALUES (?, ?, ?, ?, 0, '', ?)
+                ON CONFLICT(user_id, idempotency_key) DO UPDATE SET
+                    endpoint = excluded.endpoint,
+                    fingerprint = excluded.fingerprint,
+                    status_code = 0,
+                    response = '',
+                    expires_at = excluded.expires_at
+                WHERE idempotency_keys.expires_at <= ?
+            """, (user_id, key, endpoint, fingerprint, now + IDEMPOTENCY_PENDING_TTL, now))
+            conn.commit()
+            if cursor.rowcount:
+                return None
+
+            cursor = conn.execute("""
+                SELECT expires_at, fingerprint, status_code, response FROM idempotency_keys
+                WHERE user_id = ? AND idempotency_key = ?
+            """, (user_id, key))
+            row = cursor.fetchone()
+            if not row or row['status_code'] == 0:
+                raise IdempotencyConflict("Request with this Idempotency-Key is in progress")
+            return (row['expires_at'], row['fingerprint'], row['status_code'], row['response'])
+
+    def _remember(self, cache_key, entry):
+        """Положить ключ в кэш, вытесняя самые старые"""
+        self._cache[cache_key] = entry
+        self._cache.move_to_end(cache_key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
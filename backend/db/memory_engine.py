@@ -0,0 +1,1068 @@
+"""
+Движок хранения игрового состояния в памяти
+Состояние игроков (game_state, user_upgrades) живет в компактных структурах в памяти,
+изменения пачками пишутся в журнал только на дозапись, а периодические снимки
+сбрасываются в SQLite, которая остается источником для отчетов и точкой восстановления
+
+Восстановление: загрузить снимок из SQLite и проиграть журнал после его номера.
+Версии разделов для дельта-синхронизации - номера записей журнала; после перезапуска
+они начинаются с восстановленного номера, и отставшие клиенты получают полный снимок.
+Движок должен быть единственным писателем game_state: процессы, которые меняют
+баланс напрямую в SQLite (pre-fork воркеры), затираются следующим снимком;
+бот пишет через эндпоинты API (db/remote.py).
+"""
+
+import atexit
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from db.achievements import ACHIEVEMENTS_BY_ID
+from db.database import (
+    DatabaseManager, DB_PATH, RECONCILE_BATCH, SPEND_SESSION_TTL, balance_view, decode_cursor, encode_cursor,
+    passive_accrual, referral_description, spend_result, transactions_page, upgrade_section
+)
+from db.rows import UserProfileRow
+
+log = logging.getLogger('db.memory')
+
+# Интервал групповой записи журнала на диск (сек)
+JOURNAL_FLUSH_INTERVAL = 0.05
+
+# Интервал снимков состояния в SQLite (сек)
+SNAPSHOT_INTERVAL = 60.0
+
+# Колонки строки журнала транзакций в памяти:
+# user_id, transaction_type, amount, description, item_id, transaction_id, created_at, achievement_id
+LEDGER_WIDTH = 8
+
+# Временные id транзакций, еще не попавших в SQLite: больше любых настоящих,
+# поэтому в истории они идут первыми и курсор по (created_at, id) работает как обычно
+PENDING_TX_ID = 1 << 62
+
+
+class PlayerState:
+    """Игровое состояние пользователя (строка game_state)"""
+
+    __slots__ = ('coins', 'total_earned', 'total_spent', 'total_clicks',
+                 'click_power', 'passive_income', 'last_passive_collection')
+    FIELDS = __slots__
+
+    def __init__(self, coins=0, total_earned=0, total_spent=0, total_clicks=0,
+                 click_power=1, passive_income=0, last_passive_collection=0.0):
+        self.coins = coins
+        self.total_earned = total_earned
+        self.total_spent = total_spent
+        self.total_clicks = total_clicks
+        self.click_power = click_power
+        self.passive_income = passive_income
+        self.last_passive_collection = last_passive_collection
+
+    def as_list(self) -> list:
+        return [getattr(self, field) for field in self.FIELDS]
+
+    def as_dict(self) -> Dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+class Journal:
+    """Журнал изменений из сегментов journal-<seq>.log с групповым fsync"""
+
+    def __init__(self, directory: Path, flush_interval: float = JOURNAL_FLUSH_INTERVAL):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.flush_interval = flush_interval
+
+        self._buffer: List[str] = []
+        self._buffer_seq = 0
+        self._flushed_seq = 0
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._file = None
+        self._segment = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def segments(self) -> List[Path]:
+        """Сегменты журнала по порядку"""
+        return sorted(self.directory.glob('journal-*.log'))
+
+    def read(self):
+        """Прочитать все записи журнала по порядку"""
+        for segment in self.segments():
+            with open(segment, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # Оборванная при сбое последняя запись
+                        break
+
+    def open_segment(self, start_seq: int):
+        """Начать новый сегмент с номера start_seq"""
+        with self._write_lock:
+            self._open_segment_locked(start_seq)
+
+    def append(self, seq: int, entry: Dict):
+        """Добавить запись в буфер; на диск она попадет при следующем сбросе"""
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._cond:
+            self._buffer.append(line)
+            self._buffer_seq = seq
+
+    def wait_durable(self, seq: int):
+        """Дождаться, пока запись с номером seq окажется на диске"""
+        with self._cond:
+            while self._flushed_seq < seq and not self._stopped.is_set():
+                self._cond.wait(self.flush_interval * 4)
+
+    def flush(self):
+        """Записать накопленный буфер одним блоком и сделать fsync"""
+        with self._write_lock:
+            self._flush_locked()
+
+    def rotate(self, next_seq: int):
+        """Сбросить буфер в текущий сегмент и начать новый"""
+        with self._write_lock:
+            self._flush_locked()
+            self._open_segment_locked(next_seq)
+
+    def drop_old_segments(self):
+        """Удалить сегменты, целиком вошедшие в снимок"""
+        with self._write_lock:
+            for segment in self.segments():
+                if segment != self._segment:
+                    segment.unlink()
+
+    def start(self):
+        """Запустить фоновый сброс журнала"""
+        self._thread = threading.Thread(target=self._run, name='journal-flusher', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Остановить сброс и закрыть файл"""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        with self._write_lock:
+            self._flush_locked()
+            if self._file:
+                self._file.close()
+                self._file = None
+        with self._cond:
+            self._cond.notify_all()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError as e:
+                log.error("Ошибка записи журнала: %s", e)
+
+    def _open_segment_locked(self, start_seq: int):
+        if self._file:
+            self._file.close()
+        self._segment = self.directory / f'journal-{start_seq:020d}.log'
+        self._file = open(self._segment, 'a', encoding='utf-8')
+
+    def _flush_locked(self):
+        with self._cond:
+            lines, self._buffer = self._buffer, []
+            seq = self._buffer_seq
+        if lines and self._file:
+            self._file.write(''.join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        with self._cond:
+            self._flushed_seq = max(self._flushed_seq, seq)
+            self._cond.notify_all()
+
+
+class MemoryDatabaseManager(DatabaseManager):
+    """DatabaseManager с состоянием игроков в памяти, журналом и снимками в SQLite"""
+
+    # Состояние живет в памяти одного процесса
+    supports_multiprocess = False
+
+    def __init__(self, db_path: Path = DB_PATH, journal_dir: Path = None,
+                 flush_interval: float = JOURNAL_FLUSH_INTERVAL,
+                 snapshot_interval: float = SNAPSHOT_INTERVAL, sync_writes: bool = False):
+        self._lock = threading.RLock()
+        self._snapshot_lock = threading.Lock()  # снимки идут по одному: история различает их по номеру
+        self._users: Dict[int, tuple] = {}  # user_id -> (telegram_id, username, first_name, registration_date, last_active, referrer_id)
+        self._states: Dict[int, PlayerState] = {}
+        self._upgrades: Dict[int, Dict[str, tuple]] = {}  # user_id -> {upgrade_id: (level, purchased_at)}
+        self._ledger: List[tuple] = []  # строки transactions, ожидающие снимка
+        self._ledger_serial = 0
+        self._pending_tx: Dict[int, List[tuple]] = {}  # user_id -> [(временный id, строка _ledger)]
+        self._flushing_tx: Dict[int, List[tuple]] = {}  # то же для строк, которые пишет текущий снимок
+        self._flushing_seq = 0  # номер журнала, до которого их пишет снимок
+        # Настоящие id строк последних снимков: (первый, последний порядковый номер, первый id)
+        self._tx_id_moves = deque(maxlen=16)
+        self._spend_sessions: Dict[tuple, tuple] = {}  # (user_id, session) -> (last_seq, updated_at)
+        self._versions: Dict[int, Dict[str, int]] = {}  # user_id -> {раздел: номер записи журнала}
+        self._versions_floor = 0  # номер, с которого известны версии (восстановленный при запуске)
+        self._reconcile_started = False  # проход сверки идет: снимок для него уже сброшен
+        self._markers: List[Dict] = []  # строки-ключи начислений из журнала, ожидающие снимка
+        self._dirty_states = set()
+        self._dirty_upgrades = set()
+        self._dirty_sessions = set()
+        self._seq = 0
+        self.sync_writes = sync_writes
+        self.snapshot_interval = snapshot_interval
+
+        super().__init__(db_path)
+
+        self.journal = Journal(journal_dir or Path(db_path).parent / 'journal', flush_interval)
+        self._recover()
+
+        self._stop_snapshots = threading.Event()
+        self.journal.start()
+        self._snapshot_thread = threading.Thread(target=self._run_snapshots, name='state-snapshots', daemon=True)
+        self._snapshot_thread.start()
+        atexit.register(self.close)
+
+    # === ВОССТАНОВЛЕНИЕ, ЖУРНАЛ И СНИМКИ ===
+
+    def _recover(self):
+        """Загрузить снимок из SQLite и проиграть журнал после него"""
+        with self.get_connection() as conn:
+            for row in conn.execute("""
+                SELECT user_id, telegram_id, username, first_name, registration_date, last_active, referrer_id
+                FROM users
+            """):
+                self._users[row[0]] = tuple(row[1:])
+            for row in conn.execute("""
+                SELECT user_id, coins, total_earned, total_spent, total_clicks,
+                       click_power, passive_income, last_passive_collection
+                FROM game_state
+            """):
+                self._states[row[0]] = PlayerState(*row[1:])
+            for row in conn.execute("SELECT user_id, upgrade_id, level, purchased_at FROM user_upgrades"):
+                self._upgrades.setdefault(row[0], {})[row[1]] = (row[2], row[3])
+            for row in conn.execute("SELECT user_id, session, last_seq, updated_at FROM spend_sessions"):
+                self._spend_sessions[(row[0], row[1])] = (row[2], row[3])
+            cursor = conn.execute("SELECT value FROM engine_meta WHERE key = 'journal_seq'")
+            row = cursor.fetchone()
+            snapshot_seq = int(row[0]) if row else 0
+
+        self._seq = snapshot_seq
+        replayed = 0
+        for entry in self.journal.read():
+            if entry['q'] <= snapshot_seq:
+                continue
+            self._apply(entry)
+            self._seq = entry['q']
+            replayed += 1
+
+        self.journal.open_segment(self._seq + 1)
+        self._versions_floor = self._seq
+        print(f"[OK] Состояние загружено в память: {len(self._states)} игроков, "
+              f"проиграно записей журнала: {replayed}")
+        if replayed:
+            self.snapshot()
+        else:
+            self.journal.drop_old_segments()
+
+    def _apply(self, entry: Dict):
+        """Применить запись журнала при восстановлении"""
+        if 'm' in entry:
+            # Начисление с отметкой: ключ допишет в SQLite ближайший снимок
+            for change in entry['m']:
+                self._apply(change)
+            if entry.get('k'):
+                self._markers.append(entry['k'])
+            return
+        user_id = entry['u']
+        if 's' in entry:
+            self._states[user_id] = PlayerState(*entry['s'])
+            self._dirty_states.add(user_id)
+        if 'up' in entry:
+            upgrade_id, level, purchased_at = entry['up']
+            self._upgrades.setdefault(user_id, {})[upgrade_id] = (level, purchased_at)
+            self._dirty_upgrades.add((user_id, upgrade_id))
+        for tx in ([entry['tx']] if 'tx' in entry else []) + entry.get('txs', []):
+            # В записях старых журналов нет achievement_id
+            tx = tuple(tx)
+            self._append_ledger(tx + (None,) * (LEDGER_WIDTH - len(tx)))
+        if 'ss' in entry:
+            session, last_seq, updated_at = entry['ss']
+            self._spend_sessions[(user_id, session)] = (last_seq, updated_at)
+            self._dirty_sessions.add((user_id, session))
+
+    def _commit(self, user_id: int, state: Optional[PlayerState], upgrade: list = None,
+                tx: list = None, txs: List[list] = None, spend_session: list = None,
+                sections: tuple = ()) -> int:
+        """Записать изменение в журнал и отметить разделы его номером (вызывается под self._lock)"""
+        self._seq += 1
+        if sections:
+            self._versions.setdefault(user_id, {}).update(dict.fromkeys(sections, self._seq))
+        entry = {'q': self._seq, 'u': user_id}
+        if state is not None:
+            entry['s'] = state.as_list()
+            self._dirty_states.add(user_id)
+        if upgrade:
+            entry['up'] = upgrade
+            self._dirty_upgrades.add((user_id, upgrade[0]))
+        if tx:
+            entry['tx'] = tx
+            self._append_ledger(tuple(tx))
+        if txs:
+            entry['txs'] = txs
+            for row in txs:
+                self._append_ledger(tuple(row))
+        if spend_session:
+            entry['ss'] = spend_session
+            self._dirty_sessions.add((user_id, spend_session[0]))
+        self.journal.append(self._seq, entry)
+        return self._seq
+
+    def _append_ledger(self, tx: tuple):
+        """Добавить транзакцию в очередь снимка и в индекс истории игрока (под self._lock)"""
+        self._ledger.append(tx)
+        self._ledger_serial += 1
+        self._pending_tx.setdefault(tx[0], []).append((PENDING_TX_ID + self._ledger_serial, tx))
+
+    def _wait_durable(self, seq: int):
+        """В синхронном режиме дождаться fsync журнала"""
+        if self.sync_writes:
+            self.journal.wait_durable(seq)
+
+    def snapshot(self) -> bool:
+        """Сбросить измененное состояние и накопленные транзакции в SQLite"""
+        with self._snapshot_lock:
+            return self._snapshot_locked()
+
+    def _snapshot_locked(self) -> bool:
+        with self._lock:
+            seq = self._seq
+            states = [(user_id, *self._states[user_id].as_list())
+                      for user_id in self._dirty_states if user_id in self._states]
+            upgrades = [(user_id, upgrade_id, *self._upgrades[user_id][upgrade_id])
+                        for user_id, upgrade_id in self._dirty_upgrades]
+            sessions = [(*key, *self._spend_sessions[key])
+                        for key in self._dirty_sessions if key in self._spend_sessions]
+            ledger = self._ledger
+            last_serial = self._ledger_serial
+            markers, self._markers = self._markers, []
+            # До коммита снимка история берет эти строки из памяти
+            self._flushing_tx, self._flushing_seq, self._pending_tx = self._pending_tx, seq, {}
+            dirty_states, dirty_upgrades, dirty_sessions = self._dirty_states, self._dirty_upgrades, self._dirty_sessions
+            self._dirty_states, self._dirty_upgrades, self._dirty_sessions, self._ledger = set(), set(), set(), []
+            # Записи после снимка пойдут в новый сегмент
+            self.journal.rotate(seq + 1)
+
+        moved = None
+        try:
+            with self.get_connection() as conn:
+                # Блокировка записи сразу: id транзакций ниже выдаются подряд от sqlite_sequence
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("""
+                    INSERT INTO game_state
+                    (user_id, coins, total_earned, total_spent, total_clicks,
+                     click_power, passive_income, last_passive_collection)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        coins = excluded.coins,
+                        total_earned = excluded.total_earned,
+                        total_spent = excluded.total_spent,
+                        total_clicks = excluded.total_clicks,
+                        click_power = excluded.click_power,
+                        passive_income = excluded.passive_income,
+                        last_passive_collection = excluded.last_passive_collection
+                """, states)
+                conn.executemany("""
+                    INSERT INTO user_upgrades (user_id, upgrade_id, level, purchased_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(user_id, upgrade_id) DO UPDATE SET
+                        level = excluded.level, purchased_at = excluded.purchased_at
+                """, upgrades)
+                conn.executemany("""
+                    INSERT INTO spend_sessions (user_id, session, last_seq, updated_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(user_id, session) DO UPDATE SET
+                        last_seq = excluded.last_seq, updated_at = excluded.updated_at
+                """, sessions)
+                row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'transactions'").fetchone()
+                first_id = (row[0] if row else 0) + 1
+                conn.executemany("""
+                    INSERT INTO transactions
+                    (id, user_id, transaction_type, amount, description, item_id, transaction_id, created_at,
+                     achievement_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, [(first_id + i, *tx) for i, tx in enumerate(ledger)])
+                # Лидерборды за окно видят заработок с задержкой до интервала снимков
+                self._record_earnings(conn, [(tx[0], tx[2], tx[6]) for tx in ledger if tx[2] > 0])
+                self._apply_markers(conn, markers)
+                conn.execute("""
+                    INSERT INTO engine_meta (key, value) VALUES ('journal_seq', ?)
+                    ON CONFLICT(key) DO UPDATE SET value = excluded.value
+                """, (str(seq),))
+                if ledger:
+                    # Курсоры истории, выданные по временным id, переводятся в настоящие
+                    moved = (last_serial - len(ledger) + 1, last_serial, first_id)
+                    with self._lock:
+                        self._tx_id_moves.append(moved)
+                conn.commit()
+        except sqlite3.Error as e:
+            log.error("Ошибка снимка состояния: %s", e)
+            # Вернем изменения, чтобы записать их следующим снимком
+            with self._lock:
+                self._dirty_states |= dirty_states
+                self._dirty_upgrades |= dirty_upgrades
+                self._dirty_sessions |= dirty_sessions
+                self._ledger = ledger + self._ledger
+                self._markers = markers + self._markers
+                for user_id, rows in self._pending_tx.items():
+                    self._flushing_tx.setdefault(user_id, []).extend(rows)
+                self._pending_tx, self._flushing_tx = self._flushing_tx, {}
+                if moved in self._tx_id_moves:
+                    self._tx_id_moves.remove(moved)
+            return False
+
+        with self._lock:
+            self._flushing_tx = {}
+
+        self.journal.drop_old_segments()
+        for marker in markers:
+            if 'ref' in marker:
+                self._refresh_user(marker['ref'][1])
+        return True
+
+    def _apply_markers(self, conn, markers: List[Dict]):
+        """Дописать в SQLite строки-ключи начислений (уже записанные ключи не меняются)"""
+        for marker in markers:
+            if 'cp' in marker:
+                conn.execute("""
+                    INSERT OR IGNORE INTO coin_purchases
+                    (user_id, amount, price_rub, telegram_payment_id, created_at)
+                    VALUES (?, ?, ?, ?, ?)
+                """, marker['cp'])
+            elif 'ref' in marker:
+                # Уже записанную связь _insert_referral пропустит
+                self._insert_referral(conn, *marker['ref'])
+            elif 'rs' in marker:
+                if not self._referral_step_done(conn, marker['rs'][0]):
+                    self._link_referral_step(conn, *marker['rs'])
+            elif 'ach' in marker:
+                user_id, achievement_ids, claimed_at = marker['ach']
+                conn.executemany("""
+                    UPDATE user_achievements SET claimed_at = ?
+                    WHERE user_id = ? AND achievement_id = ? AND claimed_at IS NULL
+                """, [(claimed_at, user_id, achievement_id) for achievement_id in achievement_ids])
+
+    def _run_snapshots(self):
+        while not self._stop_snapshots.wait(self.snapshot_interval):
+            self.snapshot()
+
+    def close(self):
+        """Остановить фоновые потоки и записать финальный снимок"""
+        if self._stop_snapshots.is_set():
+            return
+        self._stop_snapshots.set()
+        self._snapshot_thread.join()
+        self.snapshot()
+        self.journal.close()
+
+    # === МЕТОДЫ ДЛЯ ПОЛЬЗОВАТЕЛЕЙ ===
+
+    def _refresh_user(self, user_id: int):
+        """Перечитать строку users из SQLite в память"""
+        with self.get_connection() as conn:
+            cursor = conn.execute("""
+                SELECT telegram_id, username, first_name, registration_date, last_active, referrer_id
+                FROM users WHERE user_id = ?
+            """, (user_id,))
+            row = cursor.fetchone()
+        if row:
+            with self._lock:
+                self._users[user_id] = tuple(row)
+
+    def create_user(self, user_id: int, telegram_data: Dict = None) -> bool:
+        """Создать нового пользователя"""
+        if not super().create_user(user_id, telegram_data):
+            return False
+        self._refresh_user(user_id)
+        with self._lock:
+            if user_id not in self._states:
+                self._states[user_id] = PlayerState(last_passive_collection=time.time())
+                self._dirty_states.add(user_id)
+        return True
+
+    def create_or_update_user(self, user_id: int, telegram_data: Dict = None) -> bool:
+        """Создать или обновить пользователя"""
+        result = super().create_or_update_user(user_id, telegram_data)
+        self._refresh_user(user_id)
+        return result
+
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        """Получить данные пользователя"""
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None:
+                return None
+            telegram_id, username, first_name, registration_date, last_active, referrer_id = user
+            data = {
+                "user_id": user_id,
+                "telegram_id": telegram_id,
+                "username": username,
+                "first_name": first_name,
+                "registration_date": registration_date,
+                "last_active": last_active,
+                "referrer_id": referrer_id,
+            }
+            state = self._states.get(user_id)
+            if state:
+                data.update(state.as_dict())
+            return data
+
+    def _get_profile_row(self, user_id: int) -> Optional[UserProfileRow]:
+        """Профиль: пользователь и игровое состояние - из памяти, счетчики команды - из SQLite"""
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None:
+                return None
+            telegram_id, username, first_name, registration_date, last_active, _ = user
+            state = self._states.get(user_id) or PlayerState()
+            game = (state.coins, state.total_earned, state.total_spent, state.total_clicks,
+                    state.click_power, state.passive_income)
+
+        referrals_count, referral_earnings = self._get_referral_totals(user_id)
+        return UserProfileRow(user_id, telegram_id, username, first_name, *game,
+                              registration_date, last_active, 0, referrals_count, referral_earnings)
+
+    def update_user_activity(self, user_id: int):
+        """Обновить время последней активности"""
+        super().update_user_activity(user_id)
+        self._refresh_user(user_id)
+
+    # === МЕТОДЫ ДЛЯ ИГРОВОГО СОСТОЯНИЯ ===
+
+    def update_coins(self, user_id: int, amount: int, transaction_type: str = 'manual',
+                     description: str = None, item_id: str = None) -> bool:
+        """Обновить количество монет пользователя"""
+        with self._lock:
+            state = self._states.get(user_id)
+            if state:
+                state.coins += amount
+                if amount > 0:
+                    state.total_earned += amount
+                else:
+                    state.total_spent += abs(amount)
+            total_earned = state.total_earned if state and amount > 0 else None
+            seq = self._commit(user_id, state, tx=[
+                user_id, transaction_type, amount, description, item_id, None, time.time(), None
+            ], sections=('coins', 'stats') if state else ())
+        self._wait_durable(seq)
+        if total_earned is not None:
+            self._observe_achievements(user_id, {'total_earned': total_earned})
+        return True
+
+    def update_click_stats(self, user_id: int, clicks: int = 1):
+        """Обновить статистику кликов"""
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is None:
+                return
+            state.total_clicks += clicks
+            total_clicks = state.total_clicks
+            seq = self._commit(user_id, state, sections=('stats',))
+        self._wait_durable(seq)
+        self._observe_achievements(user_id, {'total_clicks': total_clicks})
+
+    def get_user_balance(self, user_id: int) -> int:
+        """Получить баланс пользователя"""
+        with self._lock:
+            state = self._states.get(user_id)
+            return state.coins if state else 0
+
+    def get_balance(self, user_id: int, now: float = None) -> Dict:
+        """Баланс с учетом пассивного дохода, накопленного с последнего сбора"""
+        now = now or time.time()
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is None:
+                return balance_view(0, 0, now, now)
+            return balance_view(state.coins, state.passive_income, state.last_passive_collection, now)
+
+    def spend_coins(self, user_id: int, spends: List[tuple], session: str = None) -> Dict:
+        """Списать пачку трат [(seq, amount)] по порядку; каждая - только если хватает монет"""
+        now = time.time()
+        accepted, rejected, duplicate = [], [], []
+        with self._lock:
+            state = self._states.get(user_id)
+            last_seq = self._spend_sessions.get((user_id, session), (0, 0))[0] if session else 0
+            txs = []
+            collected_from = state.last_passive_collection if state else None
+            accrual = self._collect_passive(user_id, state, now) if state else None
+            # Сдвиг времени сбора меняет баланс в разделе stats, даже если монет не набежало
+            collected = state is not None and state.last_passive_collection != collected_from
+            if accrual:
+                txs.append(accrual)
+
+            for seq, amount in spends:
+                if session and seq <= last_seq:
+                    duplicate.append(seq)
+                elif state and state.coins >= amount:
+                    state.coins -= amount
+                    state.total_spent += amount
+                    txs.append([user_id, 'spend', -amount, f"Трата #{seq}", None, None, now, None])
+                    accepted.append(seq)
+                else:
+                    rejected.append(seq)
+
+            spend_session = None
+            if session:
+                last_seq = max(last_seq, spends[-1][0])
+                self._spend_sessions[(user_id, session)] = (last_seq, now)
+                spend_session = [session, last_seq, now]
+            seq = self._commit(user_id, state, txs=txs, spend_session=spend_session,
+                               sections=('coins', 'stats') if accepted or collected else ())
+            balance = (balance_view(state.coins, state.passive_income, state.last_passive_collection, now)
+                       if state else balance_view(0, 0, now, now))
+            total_earned = state.total_earned if accrual else None
+
+        self._wait_durable(seq)
+        if total_earned is not None:
+            self._observe_achievements(user_id, {'total_earned': total_earned})
+        return spend_result(balance, session, last_seq, accepted, rejected, duplicate)
+
+    def _collect_passive(self, user_id: int, state: PlayerState, now: float) -> Optional[list]:
+        """Зачислить накопленный пассивный доход (под self._lock); вернуть строку транзакции"""
+        accrued, state.last_passive_collection = passive_accrual(
+            state.passive_income, state.last_passive_collection, now
+        )
+        if not accrued:
+            return None
+        state.coins += accrued
+        state.total_earned += accrued
+        return [user_id, 'passive_income', accrued, None, None, None, now, None]
+
+    def expire_spend_sessions(self, now: float = None, limit: int = None) -> int:
+        """Удалить сессии журнала трат без активности (в памяти и в SQLite)"""
+        deleted = super().expire_spend_sessions(now, limit)
+        cutoff = (now or time.time()) - SPEND_SESSION_TTL
+        with self._lock:
+            for key in [key for key, (_, updated_at) in self._spend_sessions.items() if updated_at < cutoff]:
+                del self._spend_sessions[key]
+                self._dirty_sessions.discard(key)
+        return deleted
+
+    def reconcile_ledger(self, repair: bool = False, limit: int = RECONCILE_BATCH) -> Dict:
+        """Сверить балансы с журналом по последнему снимку
+
+        Снимок сбрасывается один раз в начале прохода, а не перед каждой пачкой: записи
+        после него сверятся следующим проходом. Исправления идут через _adjust_totals в память.
+        """
+        if not self._reconcile_started:
+            self.snapshot()
+        report = super().reconcile_ledger(repair, limit)
+        self._reconcile_started = not report['complete']
+        return report
+
+    def _adjust_totals(self, user_id: int, coins: int, total_earned: int, total_spent: int):
+        """Сдвинуть баланс и итоги игрока в памяти"""
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is None:
+                return
+            state.coins += coins
+            state.total_earned += total_earned
+            state.total_spent += total_spent
+            seq = self._commit(user_id, state, sections=('coins', 'stats'))
+        self._wait_durable(seq)
+
+    def touch_state(self, user_ids: List[int], *sections: str):
+        """Отметить изменение разделов, данные которых хранятся в SQLite"""
+        seq = 0
+        with self._lock:
+            for user_id in user_ids:
+                # Пустая запись журнала: номер версии не повторится после перезапуска
+                seq = self._commit(user_id, None, sections=sections)
+        self._wait_durable(seq)
+
+    def _get_state_versions(self, user_id: int) -> Tuple[Dict[str, int], int]:
+        """Версии разделов игрока из памяти"""
+        with self._lock:
+            return dict(self._versions.get(user_id, {})), self._versions_floor
+
+    def _get_game_state(self, user_id: int) -> Optional[Dict]:
+        """Игровое состояние из памяти"""
+        with self._lock:
+            state = self._states.get(user_id)
+            return state.as_dict() if state else None
+
+    def get_transactions(self, user_id: int, limit: int = 50, cursor: str = None,
+                         transaction_types: List[str] = None, since: float = None,
+                         until: float = None) -> Dict:
+        """Получить страницу истории транзакций: страница из SQLite плюс строки после снимка"""
+        position = None
+        if cursor:
+            position = decode_cursor(cursor)
+
+        with self._lock:
+            pending = list(self._pending_tx.get(user_id, ()))
+            flushing = list(self._flushing_tx.get(user_id, ()))
+            flushing_seq = self._flushing_seq
+            if position and position[1] >= PENDING_TX_ID:
+                serial = position[1] - PENDING_TX_ID
+                for first, last, first_id in self._tx_id_moves:
+                    if first <= serial <= last:
+                        # Строка курсора уже в SQLite - листаем SQLite от ее настоящего id
+                        cursor = encode_cursor(position[0], first_id + serial - first)
+
+        with self.get_connection() as conn:
+            # Номер снимка и страница читаются из одной транзакции чтения
+            conn.execute("BEGIN")
+            row = conn.execute("SELECT value FROM engine_meta WHERE key = 'journal_seq'").fetchone()
+            rows = [dict(row) for row in self._query_transactions(
+                conn, user_id, limit, cursor, transaction_types, since, until)]
+            conn.rollback()
+        if not row or int(row[0]) < flushing_seq:
+            # Снимок с этими строками еще не закоммичен
+            pending = flushing + pending
+
+        for tx_id, tx in pending:
+            created_at = tx[6]
+            if since is not None and created_at < since or until is not None and created_at >= until:
+                continue
+            if position is not None and (created_at, tx_id) >= position:
+                continue
+            if transaction_types and tx[1] not in transaction_types:
+                continue
+            rows.append({
+                'id': tx_id, 'transaction_type': tx[1], 'amount': tx[2], 'description': tx[3],
+                'item_id': tx[4], 'transaction_id': tx[5], 'created_at': created_at
+            })
+        rows.sort(key=lambda tx: (tx['created_at'], tx['id']), reverse=True)
+        return transactions_page(rows[:limit + 1], limit)
+
+    # === МЕТОДЫ ДЛЯ УЛУЧШЕНИЙ ===
+
+    def get_user_upgrades(self, user_id: int) -> List[Dict]:
+        """Получить список улучшений пользователя для API"""
+        with self._lock:
+            items = list(self._upgrades.get(user_id, {}).items())
+        items.sort(key=lambda item: item[1][1], reverse=True)
+        return [
+            {'upgrade_id': upgrade_id, 'level': level, 'purchased_at': purchased_at}
+            for upgrade_id, (level, purchased_at) in items
+        ]
+
+    def _get_upgrade_levels(self, user_id: int) -> Dict[str, int]:
+        """Получить уровни улучшений пользователя: upgrade_id -> level"""
+        with self._lock:
+            return {upgrade_id: level for upgrade_id, (level, _) in self._upgrades.get(user_id, {}).items()}
+
+    def buy_upgrade(self, user_id: int, item_id: str) -> Dict:
+        """Купить улучшение"""
+        with self._lock:
+            # Цена зависит от уровня, поэтому считаем ее под той же блокировкой, что и покупку
+            catalog_item = self.catalog.get(item_id)
+            if not catalog_item:
+                return {"success": False, "message": "Предмет не найден"}
+
+            level, _ = self._upgrades.get(user_id, {}).get(item_id, (0, 0))
+            item = catalog_item.as_dict(level)
+
+            if not item['available']:
+                return {"success": False, "message": "Предмет недоступен для покупки"}
+
+            state = self._states.get(user_id)
+            if not state or state.coins < item['price']:
+                return {"success": False, "message": "Недостаточно монет"}
+
+            now = time.time()
+            new_level = item['current_level'] + 1
+            self._upgrades.setdefault(user_id, {})[item_id] = (new_level, now)
+
+            # Применяем эффект улучшения
+            if item['effect_type'] and item['effect_value']:
+                if item['effect_type'] == "click_power":
+                    state.click_power += item['effect_value']
+                elif item['effect_type'] == "passive_income":
+                    state.passive_income += item['effect_value']
+
+            # Списываем монеты
+            state.coins -= item['price']
+            state.total_spent += item['price']
+
+            purchase = [user_id, 'upgrade_purchase', -item['price'], None, item_id, None, now, None]
+            seq = self._commit(user_id, state, upgrade=[item_id, new_level, now],
+                               txs=[purchase],
+                               sections=('coins', 'stats', upgrade_section(item_id)))
+            upgrade_levels = sum(level for level, _ in self._upgrades[user_id].values())
+            result = {
+                "success": True,
+                "message": f"Улучшение '{item['name']}' куплено!",
+                "data": {
+                    "item": item,
+                    "new_level": new_level,
+                    "new_balance": state.coins,
+                    "user_stats": {
+                        "click_power": state.click_power,
+                        "passive_income": state.passive_income
+                    }
+                }
+            }
+
+        self._wait_durable(seq)
+        result['data']['achievements'] = self._observe_achievements(user_id, {'upgrade_levels': upgrade_levels})
+        return result
+
+    # === МЕТОДЫ ДЛЯ РЕФЕРАЛОВ ===
+
+    def add_referral(self, referrer_id: int, referred_id: int, bonus: int = 100) -> bool:
+        """Добавить реферала"""
+        # Связь и дерево хранятся в SQLite, бонусы начисляются в памяти
+        credited = None
+        with self.get_connection() as conn:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                linked = self._insert_referral(conn, referrer_id, referred_id, bonus)
+                if linked is None:
+                    return False
+                team, rewards = linked
+                # Бонусы попадают на диск до коммита связи
+                credited = self._journal_credits(
+                    [(ancestor_id, amount, 'referral_bonus', referral_description(referred_id, level), None, None)
+                     for ancestor_id, level, amount in rewards],
+                    {'ref': [referrer_id, referred_id, bonus]})
+                conn.commit()
+
+            except sqlite3.Error as e:
+                log.error("Ошибка добавления реферала: %s", e, extra={'user_id': referred_id, 'referrer_id': referrer_id})
+                # Бонусы уже в журнале - связь допишет снимок
+                if credited is None:
+                    return False
+
+        self._refresh_user(referred_id)
+        self._observe_credits(credited)
+        # Версии - после коммита: клиент не получит новую версию со старыми счетчиками
+        self.touch_state(team, 'referrals')
+        return True
+
+    def apply_referral_step(self, referred_id: int, ancestors: List[Tuple[int, int]],
+                            descendants: List[Tuple[int, int]], rewards: List[Tuple[int, int, int]],
+                            now: float) -> bool:
+        """Часть привязки реферала в этом шарде: бонусы - в памяти, отметка шага - ключ начисления"""
+        credited = None
+        # Снимок не заберет отметку из очереди, пока мы ее ищем
+        with self._snapshot_lock, self.get_connection() as conn:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                with self._lock:
+                    pending = any(marker.get('rs', [None])[0] == referred_id for marker in self._markers)
+                if pending or self._referral_step_done(conn, referred_id):
+                    conn.rollback()
+                    return True
+                self._link_referral_step(conn, referred_id, ancestors, descendants, rewards, now)
+                credited = self._journal_credits(
+                    [(ancestor_id, amount, 'referral_bonus', referral_description(referred_id, level), None, None)
+                     for ancestor_id, level, amount in rewards],
+                    {'rs': [referred_id, ancestors, descendants, rewards, now]})
+                conn.commit()
+
+            except sqlite3.Error as e:
+                log.error("Ошибка привязки реферала: %s", e, extra={'user_id': referred_id})
+                # Бонусы уже в журнале - шаг допишет снимок
+                if credited is None:
+                    return False
+
+        self._observe_credits(credited)
+        return True
+
+    def get_referral_stats(self, user_id: int, limit: int = 50, cursor: str = None) -> Dict:
+        """Получить статистику рефералов"""
+        stats = super().get_referral_stats(user_id, limit, cursor)
+        # Снимок в SQLite может отставать - берем актуальные суммы из памяти
+        with self._lock:
+            for referral in stats['referrals']:
+                state = self._states.get(referral['user_id'])
+                if state:
+                    referral['total_earned'] = state.total_earned
+        return stats
+
+    # === МЕТОДЫ ДЛЯ ДОСТИЖЕНИЙ ===
+
+    def _observe_achievements(self, user_id: int, stats: Dict[str, int]) -> List[str]:
+        """Проверить пороги достижений; в SQLite идем только при пересечении порога"""
+        if not self.achievements.needs_check(user_id, stats):
+            return []
+        with self.get_connection() as conn:
+            try:
+                unlocked = self.achievements.unlock(conn, user_id, stats, time.time())
+                conn.commit()
+            except sqlite3.Error as e:
+                log.error("Ошибка открытия достижений: %s", e, extra={'user_id': user_id})
+                return []
+        return [rule.id for rule in unlocked]
+
+    def _get_achievement_stats(self, conn, user_id: int) -> Dict[str, int]:
+        """Текущие значения статистик: игровое состояние - из памяти"""
+        stats = super()._get_achievement_stats(conn, user_id)
+        with self._lock:
+            state = self._states.get(user_id)
+            if state:
+                stats['total_clicks'] = state.total_clicks
+                stats['total_earned'] = state.total_earned
+            stats['upgrade_levels'] = sum(level for level, _ in self._upgrades.get(user_id, {}).values())
+        return stats
+
+    def claim_achievements(self, user_id: int, achievement_id: str = None) -> Dict:
+        """Забрать награду за достижение (отметка - в SQLite, монеты - в памяти)"""
+        if achievement_id is not None and achievement_id not in ACHIEVEMENTS_BY_ID:
+            return {"success": False, "message": "Достижение не найдено"}
+
+        now = time.time()
+        credited = None
+        with self.get_connection() as conn:
+            try:
+                rules = self._mark_claimed(conn, user_id, achievement_id, now)
+                if rules:
+                    # Награды попадают на диск до коммита отметки claimed_at
+                    credited = self._journal_credits(
+                        [(user_id, rule.reward, 'achievement_reward', f"Достижение «{rule.title}»", None, rule.id)
+                         for rule in rules],
+                        {'ach': [user_id, [rule.id for rule in rules], now]})
+                conn.commit()
+            except sqlite3.Error as e:
+                log.error("Ошибка получения награды за достижение: %s", e, extra={'user_id': user_id})
+                # Награды уже в журнале - отметку допишет снимок
+                if credited is None:
+                    return {"success": False, "message": "Ошибка сервера"}
+
+        if not rules:
+            return {"success": False, "message": "Нет наград, которые можно получить"}
+
+        unlocked = self._observe_credits(credited)
+        reward = sum(rule.reward for rule in rules)
+        return {
+            "success": True,
+            "message": f"Получено монет: {reward}",
+            "data": {
+                "claimed": [rule.id for rule in rules],
+                "reward": reward,
+                "new_balance": self.get_user_balance(user_id),
+                "achievements": unlocked
+            }
+        }
+
+    # === МЕТОДЫ ДЛЯ ЛИДЕРБОРДА ===
+
+    def get_leaderboard(self, limit: int = 10) -> List[Dict]:
+        """Получить таблицу лидеров"""
+        with self._lock:
+            top = heapq.nlargest(limit, self._states.items(), key=lambda item: item[1].total_earned)
+            leaderboard = []
+            for i, (user_id, state) in enumerate(top, 1):
+                user = self._users.get(user_id) or (user_id, '', '', 0, 0, None)
+                leaderboard.append({
+                    'position': i,
+                    'user_id': user_id,
+                    'username': user[1] or '',
+                    'first_name': user[2] or '',
+                    'total_earned': state.total_earned,
+                    'total_clicks': state.total_clicks,
+                    'coins': state.coins
+                })
+            return leaderboard
+
+    # === ОБЩАЯ СТАТИСТИКА ===
+
+    def get_global_stats(self) -> Dict:
+        """Получить общую статистику игры"""
+        stats = super().get_global_stats()
+        with self._lock:
+            states = list(self._states.values())
+        stats.update({
+            'total_users': len(states),
+            'total_coins': sum(state.coins for state in states),
+            'total_earned': sum(state.total_earned for state in states),
+            'total_spent': sum(state.total_spent for state in states),
+            'total_clicks': sum(state.total_clicks for state in states),
+        })
+        return stats
+
+    # === МЕТОДЫ ДЛЯ ПОКУПОК МОНЕТ ===
+
+    def add_coin_purchase(self, user_id: int, amount: int, price_rub: int,
+                          telegram_payment_id: str) -> bool:
+        """Записать покупку монет за реальные деньги (повтор того же платежа не начисляет монеты)"""
+        purchase = [user_id, amount, price_rub, telegram_payment_id, time.time()]
+        credited = None
+        with self.get_connection() as conn:
+            try:
+                if self._coin_purchase_exists(conn, user_id, telegram_payment_id):
+                    return True
+
+                conn.execute("""
+                    INSERT INTO coin_purchases
+                    (user_id, amount, price_rub, telegram_payment_id, created_at)
+                    VALUES (?, ?, ?, ?, ?)
+                """, purchase)
+                # Монеты попадают на диск до коммита строки покупки: после сбоя повтор
+                # платежа найдет строку, а начисление проиграется из журнала
+                credited = self._journal_credits(
+                    [(user_id, amount, 'purchase', f"Покупка за {price_rub}₽", telegram_payment_id, None)],
+                    {'cp': purchase} if telegram_payment_id else None)
+                conn.commit()
+
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                return self._coin_purchase_exists(conn, user_id, telegram_payment_id)
+            except sqlite3.Error as e:
+                log.error("Ошибка записи покупки: %s", e, extra={'user_id': user_id})
+                # Монеты уже в журнале - строку покупки допишет снимок
+                if credited is None:
+                    return False
+
+        self._observe_credits(credited)
+        return True
+
+    def _journal_credits(self, credits: List[tuple], marker: Optional[Dict]) -> List[Tuple[int, int]]:
+        """Начислить монеты одной записью журнала вместе со строкой-ключом и дождаться fsync
+
+        credits - [(user_id, сумма, тип, описание, transaction_id, achievement_id)].
+        Вызывается в открытой транзакции SQLite до коммита ключа (покупки, связи, отметки
+        награды): если процесс упадет после fsync, восстановление проиграет начисление и
+        допишет ключ снимком. Возвращает [(user_id, total_earned)] для проверки достижений.
+        """
+        now = time.time()
+        totals = []
+        with self._lock:
+            self._seq += 1
+            changes = []
+            for user_id, amount, transaction_type, description, transaction_id, achievement_id in credits:
+                tx = [user_id, transaction_type, amount, description, None, transaction_id, now, achievement_id]
+                change = {'u': user_id, 'tx': tx}
+                state = self._states.get(user_id)
+                if state:
+                    state.coins += amount
+                    state.total_earned += amount
+                    change['s'] = state.as_list()
+                    self._dirty_states.add(user_id)
+                    self._versions.setdefault(user_id, {}).update(dict.fromkeys(('coins', 'stats'), self._seq))
+                    totals.append((user_id, state.total_earned))
+                self._append_ledger(tuple(tx))
+                changes.append(change)
+            if marker:
+                self._markers.append(marker)
+            self.journal.append(self._seq, {'q': self._seq, 'm': changes, 'k': marker})
+        # Не ждем фонового сброса: транзакция SQLite держит блокировку записи до fsync
+        self.journal.flush()
+        return totals
+
+    def _observe_credits(self, credited: List[Tuple[int, int]]) -> List[str]:
+        """Проверить достижения по заработку после начисления"""
+        unlocked = []
+        for user_id, total_earned in credited:
+            unlocked.extend(self._observe_achievements(user_id, {'total_earned': total_earned}))
+        return unlocked
@@ -0,0 +1,59 @@
+"""
+Доступ к данным игры через процесс API (для бота и других процессов вне API)
+Движок в памяти (DB_ENGINE=memory) принадлежит одному процессу: прямые записи
+в SQLite из другого процесса затрет следующий снимок, поэтому такие процессы
+ходят в служебные эндпоинты /api/bot/* с заголовком X-Bot-Token
+"""
+
+import json
+import logging
+import urllib.error
+import urllib.request
+from typing import Dict
+from urllib.parse import urlencode
+
+log = logging.getLogger('db.remote')
+
+# Таймаут запроса к API (сек)
+REQUEST_TIMEOUT = 5.0
+
+
+class RemoteDatabaseManager:
+    """Часть интерфейса DatabaseManager, нужная боту, поверх эндпоинтов API"""
+
+    def __init__(self, api_url: str, bot_token: str, timeout: float = REQUEST_TIMEOUT):
+        self.api_url = api_url.rstrip('/')
+        self.bot_token = bot_token
+        self.timeout = timeout
+
+    def create_or_update_user(self, user_id: int, telegram_data: Dict = None) -> bool:
+        """Создать или обновить пользователя"""
+        response = self._request('POST', '/api/bot/user', {'user_id': user_id, 'telegram_data': telegram_data})
+        return bool(response and response.get('success'))
+
+    def add_referral(self, referrer_id: int, referred_id: int) -> bool:
+        """Добавить реферала (бонусы начисляет процесс API)"""
+        response = self._request('POST', '/api/bot/referral',
+                                 {'referrer_id': referrer_id, 'referred_id': referred_id})
+        return bool(response and response.get('success') and response['data']['linked'])
+
+    def get_user_profile(self, user_id: int) -> Dict:
+        """Получить профиль пользователя"""
+        response = self._request('GET', '/api/bot/profile?' + urlencode({'user_id': user_id}))
+        return response['data'] if response and response.get('success') else {}
+
+    def _request(self, method: str, path: str, payload: Dict = None) -> Dict:
+        """Запрос к API; при ошибке сети или сервера - None"""
+        data = json.dumps(payload).encode('utf-8') if payload is not None else None
+        request = urllib.request.Request(self.api_url + path, data=data, method=method, headers={
+            'Content-Type': 'application/json',
+            'X-Bot-Token': self.bot_token,
+        })
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            log.error("API ответил %s на %s %s", e.code, method, path)
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            log.error("API недоступен (%s %s): %s", method, path, e)
+        return None
@@ -0,0 +1,149 @@
+"""
+Офлайн-перешардирование базы данных
+Переносит данные из одной базы или набора шардов в новый набор из N шардов
+
+Запуск (из папки backend, при остановленном API):
+    python -m db.reshard --source db/clicker_game.db --shards 4 --out db/shards
+    python -m db.reshard --source db/shards --shards 8 --out db/shards_8
+"""
+
+import argparse
+import sqlite3
+import sys
+from pathlib import Path
+from typing import List
+
+from db.database import DatabaseManager
+from db.sharding import shard_for_user, shard_path
+
+# Таблица -> колонка, по которой строка попадает в шард
+TABLE_ROUTING = {
+    'users': 'user_id',
+    'game_state': 'user_id',
+    'user_upgrades': 'user_id',
+    'user_achievements': 'user_id',
+    'referrals': 'referrer_id',
+    'referral_closure': 'ancestor_id',
+    'referral_team_stats': 'user_id',
+    'transactions': 'user_id',
+    'coin_purchases': 'user_id',
+    'earning_buckets': 'user_id',
+    'idempotency_keys': 'user_id',
+    'spend_sessions': 'user_id',
+    'state_versions': 'user_id',
+}
+# ledger_checkpoints не переносится: id транзакций в новых шардах другие, сверка начнется заново
+# referral_intents и referral_steps не переносятся: перед переносом незавершенных привязок быть не должно
+
+# Сколько строк переносить за один проход
+BATCH_SIZE = 5000
+
+
+def find_sources(source: Path) -> List[Path]:
+    """Исходные файлы: одна база или все шарды в папке"""
+    if source.is_dir():
+        return sorted(source.glob('shard_*.db'))
+    return [source]
+
+
+def copy_columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    """Колонки для переноса; автоинкрементный id назначается заново, чтобы не было коллизий между шардами"""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if 'id' in columns and table != 'users':
+        columns.remove('id')
+    return columns
+
+
+def reshard(sources: List[Path], out_dir: Path, num_shards: int) -> dict:
+    """Перенести все строки в новые шарды; возвращает число строк по таблицам"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if any(out_dir.glob('shard_*.db')):
+        raise ValueError(f"Папка {out_dir} уже содержит шарды")
+
+    # Шаги незавершенной привязки реферала записаны по старым шардам - ее надо дописать до переноса
+    for source in sources:
+        src = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+        try:
+            pending = src.execute("SELECT 1 FROM sqlite_master WHERE name = 'referral_intents'").fetchone()
+            if pending:
+                pending = src.execute("SELECT 1 FROM referral_intents LIMIT 1").fetchone()
+        finally:
+            src.close()
+        if pending:
+            raise ValueError(f"В {source.name} есть незавершенные привязки рефералов: "
+                             f"запустите API до завершения задачи обслуживания referrals")
+
+    # Создаем пустые шарды со схемой
+    targets = []
+    for index in range(num_shards):
+        DatabaseManager(shard_path(out_dir, index))
+        targets.append(sqlite3.connect(shard_path(out_dir, index)))
+
+    counts = {}
+    try:
+        for source in sources:
+            src = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+            try:
+                for table, route_column in TABLE_ROUTING.items():
+                    columns = copy_columns(src, table)
+                    route_index = columns.index(route_column)
+                    column_list = ', '.join(columns)
+                    placeholders = ', '.join('?' for _ in columns)
+                    insert = f"INSERT OR IGNORE INTO {table} ({column_list}) VALUES ({placeholders})"
+                    # Сохраняем хронологию, чтобы новые id шли в том же порядке
+                    order = " ORDER BY created_at" if 'created_at' in columns else ""
+
+                    cursor = src.execute(f"SELECT {column_list} FROM {table}{order}")
+                    while True:
+                        rows = cursor.fetchmany(BATCH_SIZE)
+                        if not rows:
+                            break
+                        batches = [[] for _ in range(num_shards)]
+                        for row in rows:
+                            batches[shard_for_user(row[route_index], num_shards)].append(row)
+                        for target, batch in zip(targets, batches):
+                            if batch:
+                                target.executemany(insert, batch)
+                        counts[table] = counts.get(table, 0) + len(rows)
+            finally:
+                src.close()
+
+        for target in targets:
+            target.commit()
+    finally:
+        for target in targets:
+            target.close()
+
+    return counts
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Перешардирование базы данных игры")
+    parser.add_argument('--source', required=True, type=Path, help="файл базы или папка с шардами")
+    parser.add_argument('--shards', required=True, type=int, help="число новых шардов")
+    parser.add_argument('--out', required=True, type=Path, help="папка для новых шардов")
+    args = parser.parse_args(argv)
+
+    sources = find_sources(args.source)
+    if not sources:
+        print(f"[ERROR] Не найдено исходных баз: {args.source}")
+        return 1
+    if args.shards < 1:
+        print("[ERROR] Число шардов должно быть положительным")
+        return 1
+
+    try:
+        counts = reshard(sources, args.out, args.shards)
+    except (ValueError, sqlite3.Error) as e:
+        print(f"[ERROR] Перешардирование не выполнено: {e}")
+        return 1
+
+    print(f"[OK] Перенесено в {args.shards} шардов ({args.out}):")
+    for table, count in counts.items():
+        print(f"   {table}: {count}")
+    print("[TIP] Журнал движка memory после перешардирования не переносится - сделайте снимок до запуска")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
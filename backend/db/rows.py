@@ -0,0 +1,101 @@
+"""
+Компактные модели строк для частых запросов
+Строка выборки сразу становится кортежем с именованными полями (без sqlite3.Row и
+промежуточных словарей), а порядок и имена полей совпадают с ответом API: словарь
+для JSON собирается одним вызовом as_dict() или прямо в row_factory (fetch_dicts)
+"""
+
+from functools import lru_cache
+from itertools import count
+from typing import Callable, Dict, List, NamedTuple, Type
+
+
+class UserProfileRow(NamedTuple):
+    """Профиль игрока (ответ /api/user/profile)"""
+    user_id: int
+    telegram_id: int
+    username: str
+    first_name: str
+    coins: int
+    total_earned: int
+    total_spent: int
+    total_clicks: int
+    click_power: int
+    passive_income: int
+    registration_date: float
+    last_active: float
+    total_purchases: int
+    referrals_count: int
+    referral_earnings: int
+
+    def as_dict(self) -> Dict:
+        return self._asdict()
+
+
+class ReferralRow(NamedTuple):
+    """Приглашенный игрок на странице рефералов; id - ключ курсора, в ответ не входит"""
+    user_id: int
+    username: str
+    first_name: str
+    registration_date: float
+    total_earned: int
+    id: int
+
+    def as_dict(self) -> Dict:
+        return {
+            'user_id': self.user_id,
+            'username': self.username,
+            'first_name': self.first_name,
+            'registration_date': self.registration_date,
+            'total_earned': self.total_earned
+        }
+
+
+class LeaderRow(NamedTuple):
+    """Строка общей таблицы лидеров"""
+    position: int
+    user_id: int
+    username: str
+    first_name: str
+    total_earned: int
+    total_clicks: int
+    coins: int
+
+
+class WindowLeaderRow(NamedTuple):
+    """Строка таблицы лидеров за окно"""
+    position: int
+    user_id: int
+    username: str
+    first_name: str
+    earned: int
+
+
+@lru_cache(maxsize=None)
+def row_factory(model: Type[NamedTuple]) -> Callable:
+    """row_factory курсора, создающая модель прямо из кортежа строки"""
+    make = model._make
+    return lambda cursor, row: make(row)
+
+
+def fetch_models(conn, model: Type[NamedTuple], query: str, params=()) -> list:
+    """Выполнить запрос и вернуть строки в виде модели (колонки - в порядке полей)"""
+    cursor = conn.cursor()
+    cursor.row_factory = row_factory(model)
+    return cursor.execute(query, params).fetchall()
+
+
+def fetch_dicts(conn, model: Type[NamedTuple], query: str, params=(), ranked: bool = False) -> List[Dict]:
+    """Выполнить запрос и сразу собрать словари ответа API по полям модели
+
+    Для списков, которые целиком уходят в JSON: на строку создается один словарь.
+    ranked=True - первое поле модели (position) проставляется по порядку строк, начиная с 1.
+    """
+    cursor = conn.cursor()
+    if ranked:
+        fields, positions = model._fields, count(1)
+        cursor.row_factory = lambda cursor, row: dict(zip(fields, (next(positions),) + row))
+    else:
+        fields = model._fields
+        cursor.row_factory = lambda cursor, row: dict(zip(fields, row))
+    return cursor.execute(query, params).fetchall()
@@ -60,6 +60,38 @@ CREATE TABLE IF NOT EXISTS referrals (
     UNIQUE(referrer_id, referred_id)
 );
 
+-- Замыкание реферального дерева: все пары предок/потомок с глубиной (1 - прямой реферал)
+CREATE TABLE IF NOT EXISTS referral_closure (
+    ancestor_id INTEGER NOT NULL,
+    descendant_id INTEGER NOT NULL,
+    depth INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (ancestor_id, depth, descendant_id)
+) WITHOUT ROWID;
+
+-- Счетчики команды по уровням (depth = 0 - итог по всем уровням)
+CREATE TABLE IF NOT EXISTS referral_team_stats (
+    user_id INTEGER NOT NULL,
+    depth INTEGER NOT NULL,
+    members INTEGER DEFAULT 0,
+    earnings INTEGER DEFAULT 0, -- реферальные бонусы, полученные с этого уровня
+    PRIMARY KEY (user_id, depth)
+) WITHOUT ROWID;
+
+-- Привязки рефералов между шардами, еще не записанные во все шарды (в шарде приглашенного)
+CREATE TABLE IF NOT EXISTS referral_intents (
+    referred_id INTEGER PRIMARY KEY,
+    referrer_id INTEGER NOT NULL,
+    bonus INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+
+-- Части привязки реферала, уже записанные в этот шард (повтор шага их пропускает)
+CREATE TABLE IF NOT EXISTS referral_steps (
+    referred_id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL
+);
+
 -- Транзакции (все операции с монетами)
 CREATE TABLE IF NOT EXISTS transactions (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -74,6 +106,15 @@ CREATE TABLE IF NOT EXISTS transactions (
     FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
 );
 
+-- Заработок по временным корзинам для лидербордов за окно (period: 'day' или 'week')
+CREATE TABLE IF NOT EXISTS earning_buckets (
+    period TEXT NOT NULL,
+    bucket INTEGER NOT NULL, -- номер дня или недели (с понедельника) от начала эпохи, UTC
+    user_id INTEGER NOT NULL,
+    earned INTEGER DEFAULT 0,
+    PRIMARY KEY (period, bucket, user_id)
+) WITHOUT ROWID;
+
 -- Покупки монет за реальные деньги
 CREATE TABLE IF NOT EXISTS coin_purchases (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -85,6 +126,52 @@ CREATE TABLE IF NOT EXISTS coin_purchases (
     FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
 );
 
+-- Ключи идемпотентности для повторяемых запросов записи
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    user_id INTEGER NOT NULL,
+    idempotency_key TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    fingerprint TEXT NOT NULL, -- хэш тела запроса
+    status_code INTEGER NOT NULL,
+    response TEXT NOT NULL, -- сохраненный JSON ответа
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (user_id, idempotency_key)
+) WITHOUT ROWID;
+
+-- Сессии клиентского журнала трат: последний обработанный номер траты
+CREATE TABLE IF NOT EXISTS spend_sessions (
+    user_id INTEGER NOT NULL,
+    session TEXT NOT NULL, -- id сессии клиента (вкладка игры)
+    last_seq INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (user_id, session)
+) WITHOUT ROWID;
+
+-- Сверка журнала транзакций: итоги по транзакциям пользователя до last_tx_id включительно
+CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+    user_id INTEGER PRIMARY KEY,
+    last_tx_id INTEGER NOT NULL,
+    coins INTEGER NOT NULL,
+    total_earned INTEGER NOT NULL,
+    total_spent INTEGER NOT NULL,
+    checked_at REAL NOT NULL
+);
+
+-- Версии разделов состояния игрока для дельта-синхронизации клиента
+-- (section: coins, stats, referrals или upgrade:<id>; номер растет с каждым изменением игрока)
+CREATE TABLE IF NOT EXISTS state_versions (
+    user_id INTEGER NOT NULL,
+    section TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (user_id, section)
+) WITHOUT ROWID;
+
+-- Служебные значения движков хранения (например, номер последнего снимка журнала)
+CREATE TABLE IF NOT EXISTS engine_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+
 -- Индексы для оптимизации запросов
 CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id);
 CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active);
@@ -92,8 +179,26 @@ CREATE INDEX IF NOT EXISTS idx_game_state_total_earned ON game_state(total_earne
 CREATE INDEX IF NOT EXISTS idx_user_upgrades_user_id ON user_upgrades(user_id);
 CREATE INDEX IF NOT EXISTS idx_user_achievements_user_id ON user_achievements(user_id);
 CREATE INDEX IF NOT EXISTS idx_referrals_referrer_id ON referrals(referrer_id);
-CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions(user_id);
+CREATE INDEX IF NOT EXISTS idx_referrals_referrer_created ON referrals(referrer_id, created_at, id);
+-- У пользователя один пригласивший. В старых базах гонка могла записать второго:
+-- оставляем первую связь (до создания индекса), остальное дерево пересобирает init_database
+UPDATE users SET referrer_id = (
+    SELECT r.referrer_id FROM referrals r WHERE r.referred_id = users.user_id ORDER BY r.id LIMIT 1
+)
+WHERE NOT EXISTS (SELECT 1 FROM sqlite_master WHERE name = 'idx_referrals_referred_id')
+  AND user_id IN (SELECT referred_id FROM referrals GROUP BY referred_id HAVING COUNT(*) > 1);
+DELETE FROM referrals
+WHERE NOT EXISTS (SELECT 1 FROM sqlite_master WHERE name = 'idx_referrals_referred_id')
+  AND id NOT IN (SELECT MIN(id) FROM referrals GROUP BY referred_id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_referrals_referred_id ON referrals(referred_id);
+CREATE INDEX IF NOT EXISTS idx_referral_closure_descendant ON referral_closure(descendant_id, depth);
+-- История транзакций листается по (user_id, created_at, id); индекс только по user_id им покрыт
+DROP INDEX IF EXISTS idx_transactions_user_id;
+CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions(user_id, created_at, id);
 CREATE INDEX IF NOT EXISTS idx_transactions_created_at ON transactions(created_at);
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys(expires_at);
+CREATE INDEX IF NOT EXISTS idx_earning_buckets_rank ON earning_buckets(period, bucket, earned DESC);
+CREATE INDEX IF NOT EXISTS idx_spend_sessions_updated_at ON spend_sessions(updated_at);
 
 -- Триггеры для автоматического обновления статистики
 
@@ -0,0 +1,384 @@
+"""
+Шардирование базы данных по user_id
+Пользователи распределяются по N файлам SQLite по хэшу user_id: операции одного
+пользователя идут в его шард, сводные (лидерборд, общая статистика, рефералы
+между шардами) выполняются опросом всех шардов и слиянием результатов
+"""
+
+import heapq
+import logging
+import sqlite3
+import time
+import zlib
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from db.database import (
+    DatabaseManager, RECONCILE_BATCH, RECONCILE_SAMPLE_LIMIT, REFERRAL_TREE_DEPTH, referral_rewards
+)
+
+log = logging.getLogger('db.sharding')
+
+# Через сколько секунд незавершенная привязка реферала считается прерванной (ее дописывает обслуживание)
+REFERRAL_RESUME_AFTER = 60.0
+
+
+def shard_for_user(user_id: int, num_shards: int) -> int:
+    """Номер шарда пользователя (стабилен между запусками и процессами)"""
+    return zlib.crc32(str(int(user_id)).encode('ascii')) % num_shards
+
+
+def shard_path(shard_dir: Path, index: int) -> Path:
+    """Путь к файлу шарда"""
+    return Path(shard_dir) / f"shard_{index:02d}.db"
+
+
+class ShardedDatabaseManager:
+    """Тот же API, что у DatabaseManager, поверх N шардов SQLite"""
+
+    def __init__(self, shard_dir: Path, num_shards: int,
+                 shard_factory: Callable[[Path, int], DatabaseManager] = None):
+        self.shard_dir = Path(shard_dir)
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        self.num_shards = num_shards
+
+        factory = shard_factory or (lambda path, index: DatabaseManager(path))
+        self.shards = [factory(shard_path(self.shard_dir, i), i) for i in range(num_shards)]
+        self.supports_multiprocess = all(shard.supports_multiprocess for shard in self.shards)
+        print(f"[OK] Подключено шардов: {num_shards} ({self.shard_dir})")
+
+    def shard(self, user_id: int) -> DatabaseManager:
+        """Шард, в котором хранятся данные пользователя"""
+        return self.shards[shard_for_user(user_id, self.num_shards)]
+
+    def get_connection(self):
+        """Подключение к первому шарду (для служебных запросов без пользователя)"""
+        return self.shards[0].get_connection()
+
+    def connection_for(self, user_id: int):
+        """Подключение к шарду пользователя"""
+        return self.shard(user_id).get_connection()
+
+    def shard_managers(self) -> List[DatabaseManager]:
+        """Все шарды"""
+        return list(self.shards)
+
+    # === МЕТОДЫ ДЛЯ ПОЛЬЗОВАТЕЛЕЙ ===
+
+    def create_user(self, user_id: int, telegram_data: Dict = None) -> bool:
+        return self.shard(user_id).create_user(user_id, telegram_data)
+
+    def create_or_update_user(self, user_id: int, telegram_data: Dict = None) -> bool:
+        return self.shard(user_id).create_or_update_user(user_id, telegram_data)
+
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        return self.shard(user_id).get_user(user_id)
+
+    def get_user_profile(self, user_id: int) -> Dict:
+        return self.shard(user_id).get_user_profile(user_id)
+
+    def update_user_activity(self, user_id: int):
+        self.shard(user_id).update_user_activity(user_id)
+
+    # === МЕТОДЫ ДЛЯ ИГРОВОГО СОСТОЯНИЯ ===
+
+    def update_coins(self, user_id: int, amount: int, transaction_type: str = 'manual',
+                     description: str = None, item_id: str = None) -> bool:
+        return self.shard(user_id).update_coins(user_id, amount, transaction_type, description, item_id)
+
+    def add_coins(self, user_id: int, amount: int, transaction_id: str = None,
+                  transaction_type: str = "purchase") -> int:
+        return self.shard(user_id).add_coins(user_id, amount, transaction_id, transaction_type)
+
+    def update_click_stats(self, user_id: int, clicks: int = 1):
+        self.shard(user_id).update_click_stats(user_id, clicks)
+
+    def get_user_balance(self, user_id: int) -> int:
+        return self.shard(user_id).get_user_balance(user_id)
+
+    def get_balance(self, user_id: int, now: float = None) -> Dict:
+        return self.shard(user_id).get_balance(user_id, now)
+
+    def spend_coins(self, user_id: int, spends: List[Tuple[int, int]], session: str = None) -> Dict:
+        return self.shard(user_id).spend_coins(user_id, spends, session)
+
+    def expire_spend_sessions(self, now: float = None, limit: int = None) -> int:
+        return sum(shard.expire_spend_sessions(now, limit) for shard in self.shards)
+
+    def get_transactions(self, user_id: int, limit: int = 50, cursor: str = None,
+                         transaction_types: List[str] = None, since: float = None,
+                         until: float = None) -> Dict:
+        return self.shard(user_id).get_transactions(user_id, limit, cursor, transaction_types, since, until)
+
+    # === МЕТОДЫ ДЛЯ УЛУЧШЕНИЙ ===
+
+    def get_user_upgrades(self, user_id: int) -> List[Dict]:
+        return self.shard(user_id).get_user_upgrades(user_id)
+
+    def buy_upgrade(self, user_id: int, item_id: str) -> Dict:
+        return self.shard(user_id).buy_upgrade(user_id, item_id)
+
+    def get_shop_items(self, user_id: int) -> List[Dict]:
+        return self.shard(user_id).get_shop_items(user_id)
+
+    # === МЕТОДЫ ДЛЯ РЕФЕРАЛОВ ===
+
+    def add_referral(self, referrer_id: int, referred_id: int, bonus: int = 100) -> bool:
+        """Добавить реферала: связь - в шарде пригласившего, замыкание дерева - в шардах предков
+
+        Общей транзакции между шардами нет: вместе с захватом места пригласившего
+        в шарде приглашенного пишется намерение (referral_intents), а каждый следующий
+        шаг можно повторить. Прерванную привязку дописывает resume_referrals.
+        """
+        if referrer_id == referred_id or self._is_referral_ancestor(referred_id, referrer_id):
+            return False
+
+        # У пользователя может быть только один пригласивший
+        if self._scatter("""
+            SELECT 1 FROM referral_closure WHERE descendant_id = ? AND depth = 1
+        """, (referred_id,)):
+            return False
+
+        # Пригласившего "занимаем" в строке users приглашенного: второй параллельный
+        # запрос увидит занятое место
+        now = time.time()
+        with self.shard(referred_id).get_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT referrer_id FROM users WHERE user_id = ?", (referred_id,)).fetchone()
+            if row is None or row[0] is not None:
+                conn.rollback()
+                return False
+            conn.execute("UPDATE users SET referrer_id = ? WHERE user_id = ?", (referrer_id, referred_id))
+            conn.execute("""
+                INSERT OR REPLACE INTO referral_intents (referred_id, referrer_id, bonus, created_at)
+                VALUES (?, ?, ?, ?)
+            """, (referred_id, referrer_id, bonus, now))
+            conn.commit()
+
+        return self._complete_referral(referrer_id, referred_id, bonus, now)
+
+    def resume_referrals(self, older_than: float = REFERRAL_RESUME_AFTER,
+                         deadline: float = None) -> Tuple[int, int]:
+        """Дописать привязки, прерванные между шардами; возвращает (дописано, осталось)"""
+        cutoff = time.time() - older_than
+        intents = self._scatter("""
+            SELECT referred_id, referrer_id, bonus, created_at FROM referral_intents
+            WHERE created_at < ? ORDER BY created_at
+        """, (cutoff,))
+        resumed = 0
+        for row in intents:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            self._complete_referral(row['referrer_id'], row['referred_id'], row['bonus'], row['created_at'])
+            resumed += 1
+        left = self._scatter("SELECT COUNT(*) FROM referral_intents WHERE created_at < ?", (cutoff,))
+        return resumed, sum(row[0] for row in left)
+
+    def _complete_referral(self, referrer_id: int, referred_id: int, bonus: int, created_at: float) -> bool:
+        """Шаги привязки после захвата места; при сбое намерение остается для повтора"""
+        referred_shard = self.shard(referred_id)
+        if not self._has_referral_row(referrer_id, referred_id):
+            # Цепочка проверяется еще раз после захвата: встречный запрос мог замкнуть цикл
+            if self._is_referral_ancestor(referred_id, referrer_id):
+                with referred_shard.get_connection() as conn:
+                    conn.execute("""
+                        UPDATE users SET referrer_id = NULL WHERE user_id = ? AND referrer_id = ?
+                    """, (referred_id, referrer_id))
+                    conn.execute("DELETE FROM referral_intents WHERE referred_id = ?", (referred_id,))
+                    conn.commit()
+                return False
+            if not self._insert_referral_row(referrer_id, referred_id, bonus, created_at):
+                return False
+
+        ancestors = [(referrer_id, 0)] + [
+            (row['ancestor_id'], row['depth']) for row in self._scatter("""
+                SELECT ancestor_id, depth FROM referral_closure
+                WHERE descendant_id = ? AND depth < ?
+            """, (referrer_id, REFERRAL_TREE_DEPTH))
+        ]
+        with referred_shard.get_connection() as conn:
+            descendants = referred_shard._get_descendants(conn, referred_id)
+        rewards = referral_rewards(ancestors, bonus)
+
+        # Замыкание, счетчики и бонусы - по одной транзакции в шарде каждого предка;
+        # уже записанный шаг повтор пропускает
+        by_shard: Dict[int, List] = {}
+        for ancestor in ancestors:
+            by_shard.setdefault(shard_for_user(ancestor[0], self.num_shards), []).append(ancestor)
+        for index, shard_ancestors in by_shard.items():
+            shard_rewards = [reward for reward in rewards
+                             if shard_for_user(reward[0], self.num_shards) == index]
+            if not self.shards[index].apply_referral_step(referred_id, shard_ancestors, descendants,
+                                                          shard_rewards, created_at):
+                log.warning("Привязка реферала прервана, ее допишет обслуживание",
+                            extra={'user_id': referred_id, 'referrer_id': referrer_id})
+                return False
+
+        with referred_shard.get_connection() as conn:
+            conn.execute("DELETE FROM referral_intents WHERE referred_id = ?", (referred_id,))
+            conn.commit()
+
+        # Версии счетчиков команды - когда все шарды записаны
+        for index, shard_ancestors in by_shard.items():
+            self.shards[index].touch_state([ancestor_id for ancestor_id, _ in shard_ancestors], 'referrals')
+        return True
+
+    def _has_referral_row(self, referrer_id: int, referred_id: int) -> bool:
+        """Записана ли уже связь в шарде пригласившего"""
+        with self.shard(referrer_id).get_connection() as conn:
+            cursor = conn.execute("""
+                SELECT 1 FROM referrals WHERE referrer_id = ? AND referred_id = ?
+            """, (referrer_id, referred_id))
+            return cursor.fetchone() is not None
+
+    def _insert_referral_row(self, referrer_id: int, referred_id: int, bonus: int, now: float) -> bool:
+        """Записать связь в шард пригласившего"""
+        with self.shard(referrer_id).get_connection() as conn:
+            try:
+                conn.execute("""
+                    INSERT INTO referrals (referrer_id, referred_id, created_at, bonus_paid)
+                    VALUES (?, ?, ?, ?)
+                """, (referrer_id, referred_id, now, bonus))
+                conn.commit()
+                return True
+            except sqlite3.Error as e:
+                log.error("Ошибка добавления реферала: %s", e, extra={'user_id': referred_id, 'referrer_id': referrer_id})
+                return False
+
+    def _is_referral_ancestor(self, ancestor_id: int, user_id: int) -> bool:
+        """Есть ли ancestor_id в цепочке пригласивших user_id (users.referrer_id по шардам, без предела глубины)"""
+        seen = set()
+        while user_id is not None and user_id not in seen:
+            if user_id == ancestor_id:
+                return True
+            seen.add(user_id)
+            with self.shard(user_id).get_connection() as conn:
+                row = conn.execute("SELECT referrer_id FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            user_id = row[0] if row else None
+        return False
+
+    def get_referral_stats(self, user_id: int, limit: int = 50, cursor: str = None) -> Dict:
+        """Получить статистику рефералов (данные приглашенных - из их шардов)"""
+        stats = self.shard(user_id).get_referral_stats(user_id, limit, cursor)
+
+        details = self._get_users_brief([referral['user_id'] for referral in stats['referrals']])
+        for referral in stats['referrals']:
+            if referral['user_id'] in details:
+                username, first_name, total_earned = details[referral['user_id']]
+                referral['username'] = username or ''
+                referral['first_name'] = first_name or ''
+                referral['total_earned'] = total_earned or 0
+        return stats
+
+    def get_team_stats(self, user_id: int, depth: int = 0) -> Dict:
+        return self.shard(user_id).get_team_stats(user_id, depth)
+
+    # === ДЕЛЬТА-СИНХРОНИЗАЦИЯ СОСТОЯНИЯ ===
+
+    def touch_state(self, user_ids: List[int], *sections: str):
+        by_shard: Dict[int, List[int]] = {}
+        for user_id in user_ids:
+            by_shard.setdefault(shard_for_user(user_id, self.num_shards), []).append(user_id)
+        for index, shard_user_ids in by_shard.items():
+            self.shards[index].touch_state(shard_user_ids, *sections)
+
+    def get_state_changes(self, user_id: int, since: int = None) -> Dict:
+        return self.shard(user_id).get_state_changes(user_id, since)
+
+    def _scatter(self, query: str, params: tuple) -> List[sqlite3.Row]:
+        """Выполнить запрос во всех шардах и объединить строки"""
+        rows = []
+        for shard in self.shards:
+            with shard.get_connection() as conn:
+                rows.extend(conn.execute(query, params).fetchall())
+        return rows
+
+    def _get_users_brief(self, user_ids: List[int]) -> Dict[int, tuple]:
+        """Имя и заработок пользователей, сгруппированных по шардам"""
+        by_shard: Dict[int, List[int]] = {}
+        for user_id in user_ids:
+            by_shard.setdefault(shard_for_user(user_id, self.num_shards), []).append(user_id)
+
+        result = {}
+        for index, ids in by_shard.items():
+            shard = self.shards[index]
+            for user_id in ids:
+                user = shard.get_user(user_id)
+                if user:
+                    result[user_id] = (user.get('username'), user.get('first_name'), user.get('total_earned'))
+        return result
+
+    def generate_referral_link(self, user_id: int) -> str:
+        return self.shard(user_id).generate_referral_link(user_id)
+
+    # === МЕТОДЫ ДЛЯ ДОСТИЖЕНИЙ ===
+
+    def get_achievements(self, user_id: int) -> List[Dict]:
+        return self.shard(user_id).get_achievements(user_id)
+
+    def claim_achievements(self, user_id: int, achievement_id: str = None) -> Dict:
+        return self.shard(user_id).claim_achievements(user_id, achievement_id)
+
+    # === МЕТОДЫ ДЛЯ ЛИДЕРБОРДА ===
+
+    def get_leaderboard(self, limit: int = 10) -> List[Dict]:
+        """Получить таблицу лидеров: топ каждого шарда и слияние"""
+        candidates = []
+        for shard in self.shards:
+            candidates.extend(shard.get_leaderboard(limit))
+
+        top = heapq.nlargest(limit, candidates, key=lambda entry: entry['total_earned'])
+        for i, entry in enumerate(top, 1):
+            entry['position'] = i
+        return top
+
+    def get_windowed_leaderboard(self, window: str = 'week', limit: int = 10,
+                                 now: float = None) -> Dict:
+        """Получить таблицу лидеров за окно: топ каждого шарда и слияние"""
+        now = now or time.time()
+        result = None
+        candidates = []
+        for shard in self.shards:
+            result = shard.get_windowed_leaderboard(window, limit, now)
+            candidates.extend(result['leaders'])
+
+        top = heapq.nsmallest(limit, candidates, key=lambda entry: (-entry['earned'], entry['user_id']))
+        for i, entry in enumerate(top, 1):
+            entry['position'] = i
+        result['leaders'] = top
+        return result
+
+    def expire_earning_buckets(self, now: float = None, limit: int = None) -> int:
+        return sum(shard.expire_earning_buckets(now, limit) for shard in self.shards)
+
+    # === СВЕРКА ЖУРНАЛА ТРАНЗАКЦИЙ ===
+
+    def reconcile_ledger(self, repair: bool = False, limit: int = RECONCILE_BATCH) -> Dict:
+        """Сверка в каждом шарде; счетчики суммируются"""
+        report = {'users_checked': 0, 'transactions_checked': 0, 'mismatches': 0, 'repaired': 0, 'samples': [],
+                  'complete': True}
+        for shard in self.shards:
+            result = shard.reconcile_ledger(repair, limit)
+            report['complete'] = report['complete'] and result['complete']
+            for key in ('users_checked', 'transactions_checked', 'mismatches', 'repaired'):
+                report[key] += result[key]
+            report['samples'].extend(result['samples'])
+        report['samples'] = report['samples'][:RECONCILE_SAMPLE_LIMIT]
+        return report
+
+    # === ОБЩАЯ СТАТИСТИКА ===
+
+    def get_global_stats(self) -> Dict:
+        """Получить общую статистику игры (сумма по шардам)"""
+        totals: Dict[str, int] = {}
+        for shard in self.shards:
+            for key, value in shard.get_global_stats().items():
+                totals[key] = totals.get(key, 0) + (value or 0)
+        totals['shards'] = self.num_shards
+        return totals
+
+    # === МЕТОДЫ ДЛЯ ПОКУПОК МОНЕТ ===
+
+    def add_coin_purchase(self, user_id: int, amount: int, price_rub: int,
+                          telegram_payment_id: str) -> bool:
+        return self.shard(user_id).add_coin_purchase(user_id, amount, price_rub, telegram_payment_id)
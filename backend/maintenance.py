@@ -0,0 +1,361 @@
+"""
+Фоновое обслуживание SQLite внутри процесса API
+Планировщик по очереди запускает задачи: ANALYZE, контрольные точки WAL,
+incremental_vacuum, удаление устаревших данных, сверку журнала транзакций с балансами,
+дописывание прерванных привязок рефералов между шардами и резервные копии (db/backup.py). У каждой задачи свой интервал
+и бюджет времени; при высокой нагрузке задача откладывается, а между шардами
+прерывается, если нагрузка выросла. Итоги запусков пишутся в engine_meta первой
+базы, поэтому статус видят все воркеры, а сам планировщик работает в одном из них.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from db.backup import BackupAborted, create_backup_manager
+
+log = logging.getLogger('maintenance')
+
+# Доля занятых слотов обработки, начиная с которой задачи откладываются
+MAINTENANCE_BUSY_LOAD = 0.5
+
+# Наибольшая пауза отложенной задачи (пауза удваивается, пока API занят), сек
+MAINTENANCE_MAX_DEFER = 300.0
+
+# Через сколько повторить задачу, не уложившуюся в бюджет, сек
+MAINTENANCE_PARTIAL_RETRY = 30.0
+
+# Сколько строк каждого индекса просматривает ANALYZE (ограничивает время задачи)
+ANALYSIS_LIMIT = 1000
+
+# Размер WAL, после которого контрольная точка пробует усечь файл
+WAL_TRUNCATE_BYTES = 64 * 1024 * 1024
+
+# Сколько ждать читателей при усечении WAL (мс): дольше - отступаем до следующего раза
+WAL_TRUNCATE_BUSY_MS = 100
+
+# incremental_vacuum: с какого числа свободных страниц запускать и сколько освобождать за шаг
+VACUUM_MIN_FREE_PAGES = 256
+VACUUM_PAGES_PER_STEP = 256
+
+# Сколько устаревших строк удаляет один DELETE (блокировка записи держится недолго)
+EXPIRE_BATCH = 1000
+
+# Сколько транзакций проверяет один шаг сверки журнала
+RECONCILE_STEP = 10000
+
+# Ключ статуса планировщика в engine_meta
+STATUS_KEY = 'maintenance_status'
+
+
+class MaintenanceJob:
+    """Задача обслуживания и итог ее последнего запуска"""
+
+    def __init__(self, name: str, run: Callable[[float], Tuple[bool, str]],
+                 interval: float, budget: float):
+        self.name = name
+        self.run = run  # run(deadline) -> (выполнена целиком, описание)
+        self.interval = interval
+        self.budget = budget
+        self.next_run = 0.0
+        self.defer = 0.0
+        self.runs = 0
+        self.failures = 0
+        self.deferrals = 0
+        self.last_status = None  # ok, partial или error
+        self.last_started_at = None
+        self.last_duration_ms = None
+        self.last_result = None
+
+    def as_dict(self) -> Dict:
+        return {
+            "interval": self.interval,
+            "budget_ms": round(self.budget * 1000),
+            "runs": self.runs,
+            "failures": self.failures,
+            "deferrals": self.deferrals,
+            "last_status": self.last_status,
+            "last_started_at": self.last_started_at,
+            "last_duration_ms": self.last_duration_ms,
+            "last_result": self.last_result,
+        }
+
+
+class MaintenanceScheduler:
+    """Фоновый поток, запускающий задачи обслуживания по расписанию"""
+
+    def __init__(self, jobs: List[MaintenanceJob], load: Callable[[], float],
+                 busy_load: float = MAINTENANCE_BUSY_LOAD, max_defer: float = MAINTENANCE_MAX_DEFER,
+                 publish: Callable[[Dict], None] = None):
+        self.jobs = jobs
+        self.load = load
+        self.busy_load = busy_load
+        self.max_defer = max_defer
+        self.publish = publish
+        self._stop = threading.Event()
+        self._thread = None
+
+    def is_busy(self) -> bool:
+        """Нагружен ли API настолько, что обслуживание надо отложить"""
+        return self.load() >= self.busy_load
+
+    def start(self):
+        """Запустить поток; первые запуски задач разнесены по времени"""
+        now = time.monotonic()
+        for index, job in enumerate(self.jobs):
+            job.next_run = now + 5.0 * (index + 1)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run_loop, name='maintenance', daemon=True)
+        self._thread.start()
+        print(f"[OK] Фоновое обслуживание БД запущено (PID {os.getpid()}): "
+              f"{', '.join(job.name for job in self.jobs)}")
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run_loop(self):
+        while not self._stop.is_set():
+            job = min(self.jobs, key=lambda job: job.next_run)
+            wait = job.next_run - time.monotonic()
+            if wait > 0:
+                self._stop.wait(min(wait, 1.0))
+                continue
+
+            if self.is_busy():
+                job.deferrals += 1
+                job.defer = min(max(job.defer * 2, 1.0), self.max_defer)
+                job.next_run = time.monotonic() + job.defer
+                continue
+
+            job.defer = 0.0
+            self.run_job(job)
+
+    def run_job(self, job: MaintenanceJob):
+        """Выполнить задачу и записать итог"""
+        job.last_started_at = time.time()
+        clock = time.monotonic()
+        complete = True
+        try:
+            complete, result = job.run(clock + job.budget)
+            job.last_status = 'ok' if complete else 'partial'
+        except Exception as e:
+            job.failures += 1
+            job.last_status, result = 'error', str(e)
+            log.warning("Задача обслуживания %s завершилась с ошибкой: %s", job.name, e)
+
+        finished = time.monotonic()
+        job.runs += 1
+        job.last_duration_ms = round((finished - clock) * 1000, 1)
+        job.last_result = result
+        job.next_run = finished + (job.interval if complete else min(job.interval, MAINTENANCE_PARTIAL_RETRY))
+
+        if self.publish:
+            try:
+                self.publish(self.stats())
+            except Exception as e:
+                log.warning("Не удалось сохранить статус обслуживания: %s", e)
+
+    def stats(self) -> Dict:
+        """Статус планировщика и всех задач"""
+        return {
+            "active": bool(self._thread and self._thread.is_alive()),
+            "pid": os.getpid(),
+            "load": round(self.load(), 3),
+            "busy_load": self.busy_load,
+            "updated_at": time.time(),
+            "jobs": {job.name: job.as_dict() for job in self.jobs},
+        }
+
+
+class DatabaseMaintenance:
+    """Задачи обслуживания для всех физических баз менеджера"""
+
+    def __init__(self, db_manager, idempotency_store, is_busy: Callable[[], bool], backup_manager=None,
+                 repair_ledger: bool = False):
+        self.db_manager = db_manager
+        self.idempotency_store = idempotency_store
+        self.is_busy = is_busy
+        self.backup_manager = backup_manager
+        self.repair_ledger = repair_ledger
+        self._cursors: Dict[str, int] = {}  # задача -> шард, с которого продолжить
+
+    def _each_shard(self, name: str, deadline: float,
+                    action: Callable[[object, float], Tuple[bool, str]]) -> Tuple[bool, str]:
+        """Выполнить действие для шардов по кругу, пока есть бюджет и API не занят"""
+        shards = self.db_manager.shard_managers()
+        start = self._cursors.get(name, 0) % len(shards)
+        results = []
+        for offset in range(len(shards)):
+            index = (start + offset) % len(shards)
+            if offset and (time.monotonic() >= deadline or self.is_busy()):
+                self._cursors[name] = index
+                results.append(f"остановлено перед шардом {index}")
+                return False, '; '.join(results)
+            complete, result = action(shards[index], deadline)
+            results.append(result)
+            if not complete:
+                self._cursors[name] = index
+                return False, '; '.join(results)
+        self._cursors[name] = 0
+        return True, '; '.join(results)
+
+    # === ЗАДАЧИ ===
+
+    def analyze(self, deadline: float) -> Tuple[bool, str]:
+        """Обновить статистику планировщика запросов (ANALYZE с ограничением)"""
+        def action(shard, deadline):
+            with shard.get_connection() as conn:
+                conn.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+                conn.execute("ANALYZE")
+            return True, f"{shard.db_path.name}: ANALYZE"
+        return self._each_shard('analyze', deadline, action)
+
+    def checkpoint(self, deadline: float) -> Tuple[bool, str]:
+        """Перенести WAL в базу; большой WAL после полного переноса усечь"""
+        def action(shard, deadline):
+            with shard.get_connection() as conn:
+                # PASSIVE не ждет ни читателей, ни писателей
+                busy, log_pages, done_pages = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+                wal_path = f"{shard.db_path}-wal"
+                wal_size = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+                truncated = ''
+                if not busy and log_pages == done_pages and wal_size > WAL_TRUNCATE_BYTES:
+                    conn.execute(f"PRAGMA busy_timeout = {WAL_TRUNCATE_BUSY_MS}")
+                    busy, _, _ = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+                    truncated = ', WAL усечен' if not busy else ', WAL занят'
+            return True, f"{shard.db_path.name}: {done_pages}/{log_pages} стр., WAL {wal_size // 1024} КБ{truncated}"
+        return self._each_shard('checkpoint', deadline, action)
+
+    def vacuum(self, deadline: float) -> Tuple[bool, str]:
+        """Вернуть свободные страницы файлу базы небольшими шагами (incremental_vacuum)"""
+        def action(shard, deadline):
+            with shard.get_connection() as conn:
+                if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                    return True, f"{shard.db_path.name}: auto_vacuum не INCREMENTAL"
+                free = before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if free < VACUUM_MIN_FREE_PAGES:
+                    return True, f"{shard.db_path.name}: свободно {free} стр."
+                while free and time.monotonic() < deadline and not self.is_busy():
+                    # executescript выполняет прагму до конца (execute освобождает одну страницу)
+                    conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_STEP})")
+                    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            return not free, f"{shard.db_path.name}: освобождено {before - free} стр., осталось {free}"
+        return self._each_shard('vacuum', deadline, action)
+
+    def expire(self, deadline: float) -> Tuple[bool, str]:
+        """Удалить просроченные ключи идемпотентности, корзины заработка и сессии трат пачками"""
+        def action(shard, deadline):
+            steps = (
+                ('ключей идемпотентности', lambda: self.idempotency_store.expire(EXPIRE_BATCH, [shard])),
+                ('корзин заработка', lambda: shard.expire_earning_buckets(limit=EXPIRE_BATCH)),
+                ('сессий трат', lambda: shard.expire_spend_sessions(limit=EXPIRE_BATCH)),
+            )
+            counts = []
+            complete = True
+            for title, step in steps:
+                deleted = batch = step()
+                while batch >= EXPIRE_BATCH and complete:
+                    if time.monotonic() >= deadline or self.is_busy():
+                        complete = False
+                        break
+                    batch = step()
+                    deleted += batch
+                counts.append(f"{title}: {deleted}")
+                if not complete:
+                    break
+            return complete, f"{shard.db_path.name}: {', '.join(counts)}"
+        return self._each_shard('expire', deadline, action)
+
+    def reconcile(self, deadline: float) -> Tuple[bool, str]:
+        """Сверить балансы с новыми транзакциями (RECONCILE_REPAIR=1 - исправлять расхождения)"""
+        def action(shard, deadline):
+            totals = {'users_checked': 0, 'transactions_checked': 0, 'mismatches': 0, 'repaired': 0}
+            while True:
+                report = shard.reconcile_ledger(repair=self.repair_ledger, limit=RECONCILE_STEP)
+                for key in totals:
+                    totals[key] += report[key]
+                if report['mismatches']:
+                    log.warning("Сверка журнала: расхождений %s, исправлено %s", report['mismatches'],
+                                report['repaired'], extra={'samples': report['samples'][:3]})
+                if report['complete'] or time.monotonic() >= deadline or self.is_busy():
+                    break
+            return report['complete'], (
+                f"{shard.db_path.name}: пользователей {totals['users_checked']}, "
+                f"транзакций {totals['transactions_checked']}, расхождений {totals['mismatches']}, "
+                f"исправлено {totals['repaired']}")
+        return self._each_shard('reconcile', deadline, action)
+
+    def referrals(self, deadline: float) -> Tuple[bool, str]:
+        """Дописать привязки рефералов, прерванные между шардами"""
+        resumed, left = self.db_manager.resume_referrals(deadline=deadline)
+        return not left, f"дописано привязок {resumed}, осталось {left}"
+
+    def backup(self, deadline: float) -> Tuple[bool, str]:
+        """Снять резервную копию всех баз (движок memory сначала сбрасывает снимок)"""
+        shards = self.db_manager.shard_managers()
+        for shard in shards:
+            if hasattr(shard, 'snapshot'):
+                shard.snapshot()
+        try:
+            backup_set = self.backup_manager.create([shard.db_path for shard in shards], deadline)
+        except BackupAborted as e:
+            return False, str(e)
+        return True, f"{backup_set.name}: баз {len(shards)}, наборов {len(self.backup_manager.list_sets())}"
+
+    # === СТАТУС ===
+
+    def publish_status(self, status: Dict):
+        """Сохранить статус планировщика в engine_meta первой базы"""
+        with self.db_manager.shard_managers()[0].get_connection() as conn:
+            conn.execute("""
+                INSERT INTO engine_meta (key, value) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value
+            """, (STATUS_KEY, json.dumps(status, ensure_ascii=False)))
+            conn.commit()
+
+    def read_status(self) -> Optional[Dict]:
+        """Последний сохраненный статус (из любого воркера)"""
+        with self.db_manager.shard_managers()[0].get_connection() as conn:
+            row = conn.execute("SELECT value FROM engine_meta WHERE key = ?", (STATUS_KEY,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+def create_maintenance(db_manager, idempotency_store,
+                       load: Callable[[], float]) -> Tuple[Optional[MaintenanceScheduler], DatabaseMaintenance]:
+    """Собрать задачи по конфигурации; планировщик None, если обслуживание выключено"""
+    busy_load = float(os.getenv("MAINTENANCE_BUSY_LOAD", str(MAINTENANCE_BUSY_LOAD)))
+    is_busy = lambda: load() >= busy_load
+    maintenance = DatabaseMaintenance(db_manager, idempotency_store, is_busy, create_backup_manager(is_busy),
+                                      repair_ledger=os.getenv("RECONCILE_REPAIR", "0") == "1")
+    if os.getenv("MAINTENANCE_ENABLED", "1") != "1":
+        return None, maintenance
+
+    budget = float(os.getenv("MAINTENANCE_BUDGET_MS", "250")) / 1000
+    jobs = [
+        MaintenanceJob('checkpoint', maintenance.checkpoint,
+                       float(os.getenv("MAINTENANCE_CHECKPOINT_INTERVAL", "60")), budget),
+        MaintenanceJob('expire', maintenance.expire,
+                       float(os.getenv("MAINTENANCE_EXPIRE_INTERVAL", "600")), budget),
+        MaintenanceJob('reconcile', maintenance.reconcile,
+                       float(os.getenv("RECONCILE_INTERVAL", "300")), budget),
+        MaintenanceJob('vacuum', maintenance.vacuum,
+                       float(os.getenv("MAINTENANCE_VACUUM_INTERVAL", "900")), budget),
+        MaintenanceJob('analyze', maintenance.analyze,
+                       float(os.getenv("MAINTENANCE_ANALYZE_INTERVAL", "21600")), budget),
+    ]
+    if hasattr(db_manager, 'resume_referrals'):
+        jobs.append(MaintenanceJob('referrals', maintenance.referrals,
+                                   float(os.getenv("MAINTENANCE_REFERRAL_INTERVAL", "60")), budget))
+    if maintenance.backup_manager:
+        # Копия идет небольшими шагами с паузами, поэтому ее бюджет - минуты, а не миллисекунды
+        jobs.append(MaintenanceJob('backup', maintenance.backup,
+                                   float(os.getenv("BACKUP_INTERVAL", "21600")),
+                                   float(os.getenv("BACKUP_MAX_SECONDS", "600"))))
+        print(f"[INFO] Резервные копии: {maintenance.backup_manager.directory}")
+    scheduler = MaintenanceScheduler(jobs, load, busy_load, publish=maintenance.publish_status)
+    return scheduler, maintenance
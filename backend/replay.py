@@ -0,0 +1,319 @@
+"""
+Проигрывание записанного трафика API на тестовом стенде
+Запросы из журналов traffic.py отправляются с исходными интервалами (1x), ускоренно (Nx)
+или без пауз (max, с числом одновременных запросов, как в пике записи); псевдонимы
+пользователей заменяются синтетическими user_id. Результат пишется в JSONL и сравнивается
+с записью или с другим прогоном: распределение задержек и статусы по маршрутам
+
+Запуск (из папки backend):
+    python replay.py run --log /var/log/traffic --target http://127.0.0.1:8080 --speed 4 --out run.jsonl
+    python replay.py compare baseline.jsonl run.jsonl
+
+Задержка в записи измерена сервером, а при прогоне - клиентом (вместе с сетью), поэтому
+для поиска регрессий сравнивайте два прогона на одном стенде.
+"""
+
+import argparse
+import http.client
+import json
+import math
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import urlencode, urlparse
+
+# С какого user_id начинаются синтетические пользователи прогона
+REPLAY_USER_BASE = 900000000
+
+# Таймаут одного запроса (сек)
+REQUEST_TIMEOUT = 30.0
+
+
+def load_records(paths: List[Path]) -> List[Dict]:
+    """Прочитать журналы (папку или файлы, включая ротированные .jsonl.N) по времени запроса"""
+    files = []
+    for path in paths:
+        files.extend(sorted(path.glob('*.jsonl*')) if path.is_dir() else [path])
+
+    records = []
+    for file in files:
+        with open(file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue  # оборванная последняя строка
+    records.sort(key=lambda record: record.get('t', 0))
+    return records
+
+
+def peak_concurrency(records: List[Dict]) -> int:
+    """Наибольшее число одновременно обрабатывавшихся запросов в записи"""
+    events = []
+    for record in records:
+        events.append((record['t'], 1))
+        events.append((record['t'] + record.get('ms', 0) / 1000, -1))
+    events.sort(key=lambda event: (event[0], event[1]))
+
+    current = peak = 0
+    for _, delta in events:
+        current += delta
+        peak = max(peak, current)
+    return max(peak, 1)
+
+
+class UserMap:
+    """Псевдоним из записи -> синтетический user_id"""
+
+    def __init__(self, base: int = REPLAY_USER_BASE):
+        self.base = base
+        self.ids: Dict[str, int] = {}
+
+    def resolve(self, value):
+        """Подставить синтетические id вместо псевдонимов во вложенных значениях"""
+        if isinstance(value, dict):
+            return {k: self.resolve(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.resolve(v) for v in value]
+        if isinstance(value, str) and value.startswith('u:'):
+            return self.user_id(value)
+        return value
+
+    def user_id(self, pseudonym: str) -> int:
+        if pseudonym not in self.ids:
+            self.ids[pseudonym] = self.base + len(self.ids) + 1
+        return self.ids[pseudonym]
+
+
+class Replayer:
+    """Отправка записанных запросов на стенд"""
+
+    def __init__(self, target: str, users: UserMap):
+        parsed = urlparse(target)
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 80
+        self.users = users
+        self.tokens: Dict[int, str] = {}
+
+    def login(self, user_ids: List[int]):
+        """Создать синтетических пользователей и получить их токены"""
+        for user_id in user_ids:
+            status, body = self.request('POST', '/api/auth/login', {'user_id': user_id})
+            if status == 200 and body.get('token'):
+                self.tokens[user_id] = body['token']
+
+    def request(self, method: str, path: str, body: Optional[Dict] = None,
+                headers: Dict = None) -> tuple:
+        """Один HTTP запрос: (статус, JSON ответа или {})"""
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=REQUEST_TIMEOUT)
+        try:
+            payload = json.dumps(body).encode('utf-8') if body is not None else None
+            headers = dict(headers or {})
+            if payload is not None:
+                headers['Content-Type'] = 'application/json'
+            conn.request(method, path, payload, headers)
+            response = conn.getresponse()
+            raw = response.read()
+            try:
+                data = json.loads(raw) if raw else {}
+            except ValueError:
+                data = {}
+            return response.status, data if isinstance(data, dict) else {}
+        finally:
+            conn.close()
+
+    def replay_one(self, index: int, record: Dict) -> Dict:
+        """Повторить запрос из записи и измерить время ответа"""
+        query = self.users.resolve(record.get('query') or {})
+        if 'auth_date' in query:
+            query['auth_date'] = int(time.time())
+        path = record['route'] + ('?' + urlencode(query, doseq=True) if query else '')
+
+        headers = {}
+        body = None
+        if record['method'] == 'POST':
+            body = self.users.resolve(record.get('body') or {})
+            user = record.get('user')
+            token = self.tokens.get(self.users.user_id(user)) if user else None
+            if token:
+                headers['Authorization'] = f'Bearer {token}'
+            elif user and 'user_id' not in body:
+                body['user_id'] = self.users.user_id(user)
+
+        started = time.perf_counter()
+        try:
+            status, _ = self.request(record['method'], path, body, headers)
+        except (OSError, http.client.HTTPException):
+            status = 0  # соединение не удалось
+        return {
+            'i': index,
+            'route': record['route'],
+            'method': record['method'],
+            'status': status,
+            'ms': round((time.perf_counter() - started) * 1000, 3),
+            'recorded_status': record.get('status'),
+            'recorded_ms': record.get('ms'),
+        }
+
+
+def run(records: List[Dict], replayer: Replayer, speed: Optional[float], workers: int) -> List[Dict]:
+    """Проиграть записи: speed=None - без пауз, иначе ускорение относительно записи"""
+    results: List[Optional[Dict]] = [None] * len(records)
+
+    def task(index, record):
+        results[index] = replayer.replay_one(index, record)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        if speed is None:
+            for index, record in enumerate(records):
+                pool.submit(task, index, record)
+        else:
+            # Запросы уходят в исходные моменты независимо от ответов - параллелизм как в записи
+            first = records[0]['t'] if records else 0
+            start = time.monotonic()
+            for index, record in enumerate(records):
+                delay = (record['t'] - first) / speed - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(task, index, record)
+    return [result for result in results if result]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(math.ceil(q * len(ordered) / 100) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(records: List[Dict], ms_key: str = 'ms', status_key: str = 'status') -> Dict[str, Dict]:
+    """Задержки и статусы по маршрутам"""
+    routes: Dict[str, Dict] = {}
+    for record in records:
+        route = f"{record['method']} {record['route']}"
+        summary = routes.setdefault(route, {'ms': [], 'statuses': {}})
+        summary['ms'].append(record.get(ms_key) or 0)
+        status = str(record.get(status_key))
+        summary['statuses'][status] = summary['statuses'].get(status, 0) + 1
+    return routes
+
+
+def print_comparison(base: Dict[str, Dict], current: Dict[str, Dict], mismatches: Dict[str, int] = None):
+    """Таблица сравнения двух прогонов"""
+    print(f"{'route':36} {'n':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'Δp95':>8}  statuses")
+    for route in sorted(set(base) | set(current)):
+        before, after = base.get(route), current.get(route)
+        if not before or not after:
+            side = after or before
+            label = 'только в прогоне' if after else 'только в базе'
+            print(f"{route:36} {len(side['ms']):>6}  {label}")
+            continue
+
+        p95_before, p95_after = percentile(before['ms'], 95), percentile(after['ms'], 95)
+        delta = (p95_after - p95_before) / p95_before * 100 if p95_before else 0.0
+        print(f"{route:36} {len(after['ms']):>6} "
+              f"{percentile(after['ms'], 50):>9.1f} {p95_after:>9.1f} {percentile(after['ms'], 99):>9.1f} "
+              f"{delta:>+7.0f}%  {after['statuses']}")
+        if before['statuses'] != after['statuses']:
+            print(f"{'':36} {'':>6}  база: p95 {p95_before:.1f} мс, статусы {before['statuses']}")
+        if mismatches and mismatches.get(route):
+            print(f"{'':36} {'':>6}  другой статус у {mismatches[route]} запросов")
+
+
+def status_mismatches(results: List[Dict], status_key: str = 'recorded_status') -> Dict[str, int]:
+    """Число запросов, у которых статус отличается от записанного"""
+    mismatches: Dict[str, int] = {}
+    for result in results:
+        if result.get(status_key) is not None and result['status'] != result[status_key]:
+            route = f"{result['method']} {result['route']}"
+            mismatches[route] = mismatches.get(route, 0) + 1
+    return mismatches
+
+
+def read_results(path: Path) -> List[Dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def command_run(args) -> int:
+    records = load_records(args.log)
+    if not records:
+        print(f"[ERROR] В журналах нет записей: {', '.join(map(str, args.log))}")
+        return 1
+
+    speed = None if args.speed == 'max' else float(args.speed)
+    peak = peak_concurrency(records)
+    workers = args.workers or (peak if speed is None else max(peak * 4, 16))
+
+    users = UserMap(args.user_base)
+    for record in records:
+        if record.get('user'):
+            users.user_id(record['user'])
+    replayer = Replayer(args.target, users)
+    if not args.no_login:
+        replayer.login(list(users.ids.values()))
+
+    print(f"[INFO] Запросов: {len(records)}, пользователей: {len(users.ids)}, "
+          f"пик параллельности в записи: {peak}, скорость: {args.speed}, потоков: {workers}")
+    started = time.monotonic()
+    results = run(records, replayer, speed, workers)
+    elapsed = time.monotonic() - started
+
+    with open(args.out, 'w', encoding='utf-8') as f:
+        for result in results:
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+    print(f"[OK] Проиграно за {elapsed:.1f} с, результат: {args.out}")
+    print("[INFO] Сравнение с записью (задержка записи - серверная):")
+    print_comparison(summarize(results, 'recorded_ms', 'recorded_status'), summarize(results),
+                     status_mismatches(results))
+    return 0
+
+
+def command_compare(args) -> int:
+    base, current = read_results(args.base), read_results(args.current)
+    mismatches = None
+    if base and current and 'i' in base[0] and 'i' in current[0]:
+        base_status = {result['i']: result['status'] for result in base}
+        paired = [dict(result, base_status=base_status.get(result['i'])) for result in current]
+        mismatches = status_mismatches(paired, 'base_status')
+    print_comparison(summarize(base), summarize(current), mismatches)
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Проигрывание записанного трафика API")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="проиграть журналы на стенде")
+    run_parser.add_argument('--log', required=True, type=Path, nargs='+', help="папка или файлы журналов")
+    run_parser.add_argument('--target', default='http://127.0.0.1:8080', help="адрес тестового API")
+    run_parser.add_argument('--speed', default='1', help="1 - как в записи, N - в N раз быстрее, max - без пауз")
+    run_parser.add_argument('--out', required=True, type=Path, help="файл результатов JSONL")
+    run_parser.add_argument('--workers', type=int, help="потоков отправки (по умолчанию - по пику записи)")
+    run_parser.add_argument('--user-base', type=int, default=REPLAY_USER_BASE, help="первый синтетический user_id")
+    run_parser.add_argument('--no-login', action='store_true', help="не создавать пользователей перед прогоном")
+
+    compare_parser = commands.add_parser('compare', help="сравнить два файла результатов")
+    compare_parser.add_argument('base', type=Path)
+    compare_parser.add_argument('current', type=Path)
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        if args.speed != 'max':
+            try:
+                if float(args.speed) <= 0:
+                    raise ValueError
+            except ValueError:
+                print("[ERROR] --speed должен быть положительным числом или max")
+                return 1
+        return command_run(args)
+    return command_compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
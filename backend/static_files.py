@@ -0,0 +1,184 @@
+"""
+Раздача статики фронтенда (frontend/ и сборки WebGL) прямо из API
+Файлы отдаются через sendfile без копирования в память процесса, предсжатые .br -
+с Content-Encoding: br, с сильным ETag, Range-запросами и долгим кэшем для файлов
+с хэшем в имени. Включается переменной SERVE_STATIC, тогда прокси server.js не нужен
+"""
+
+import mimetypes
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Optional, Tuple
+from urllib.parse import unquote
+
+# Корень статики по умолчанию
+STATIC_ROOT = Path(__file__).parent.parent / "frontend"
+
+# Типы файлов сборки Unity и фронтенда (mimetypes знает их не везде одинаково)
+CONTENT_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.js': 'application/javascript',
+    '.mjs': 'application/javascript',
+    '.css': 'text/css; charset=utf-8',
+    '.json': 'application/json',
+    '.wasm': 'application/wasm',
+    '.data': 'application/octet-stream',
+    '.webm': 'video/webm',
+    '.svg': 'image/svg+xml',
+}
+
+# Имя с хэшем содержимого (Unity "Name Files As Hashes", сборщики фронтенда):
+# такой файл никогда не меняется и кэшируется навсегда
+HASHED_NAME = re.compile(r'(^|[.\-_])[0-9a-f]{16,}([.\-_]|$)')
+
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE = 'no-cache'
+
+RANGE_HEADER = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def content_type_for(name: str) -> str:
+    """Content-Type по расширению файла"""
+    suffix = Path(name).suffix.lower()
+    if suffix in CONTENT_TYPES:
+        return CONTENT_TYPES[suffix]
+    guessed, _ = mimetypes.guess_type(name)
+    return guessed or 'application/octet-stream'
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Один диапазон bytes=a-b -> (начало, конец включительно); None - отдать файл целиком
+
+    ValueError, если диапазон не пересекается с файлом (ответ 416).
+    Несколько диапазонов через запятую не поддерживаем и отдаем файл целиком.
+    """
+    match = RANGE_HEADER.match(header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+
+    first, last = match.group(1), match.group(2)
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+    else:
+        # bytes=-N: последние N байт
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        start, end = max(size - length, 0), size - 1
+
+    if start >= size:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+class StaticFiles:
+    """Раздача файлов из одного корня"""
+
+    def __init__(self, root: Path = STATIC_ROOT, index: str = 'index.html'):
+        self.root = Path(root).resolve()
+        self.index = index
+
+    def resolve(self, url_path: str) -> Optional[Path]:
+        """Файл для пути запроса или None; пути за пределами корня не отдаются"""
+        relative = unquote(url_path).lstrip('/')
+        candidate = (self.root / relative).resolve()
+        if candidate != self.root and self.root not in candidate.parents:
+            return None
+        if candidate.is_dir():
+            candidate = candidate / self.index
+        return candidate if candidate.is_file() else None
+
+    def serve(self, handler, url_path: str, head_only: bool = False) -> bool:
+        """Отдать файл; False, если его нет (вызывающий решает, что ответить)"""
+        path = self.resolve(url_path)
+        if path is None:
+            # Одностраничное приложение: неизвестные пути отдают index.html
+            if Path(url_path).suffix:
+                return False
+            path = self.resolve('/')
+            if path is None:
+                return False
+
+        headers = {'Vary': 'Accept-Encoding'}
+        name = path.name
+        if name.endswith('.br'):
+            # Предсжатый файл: тип - по имени без .br
+            name = name[:-3]
+            headers['Content-Encoding'] = 'br'
+        elif 'br' in {coding.split(';')[0].strip()
+                      for coding in handler.headers.get('Accept-Encoding', '').split(',')}:
+            compressed = path.with_name(path.name + '.br')
+            if compressed.is_file():
+                path = compressed
+                headers['Content-Encoding'] = 'br'
+
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return False
+
+        with f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            etag = f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{size:x}"'
+            headers.update({
+                'Content-Type': content_type_for(name),
+                'ETag': etag,
+                'Last-Modified': formatdate(stat.st_mtime, usegmt=True),
+                'Cache-Control': IMMUTABLE_CACHE if HASHED_NAME.search(name) else REVALIDATE_CACHE,
+                'Accept-Ranges': 'bytes',
+            })
+
+            if self._not_modified(handler, etag, stat.st_mtime):
+                self._send_headers(handler, 304, headers)
+                return True
+
+            status, start, end = 200, 0, size - 1
+            range_header = handler.headers.get('Range')
+            if_range = handler.headers.get('If-Range')
+            if range_header and size and (not if_range or if_range == etag):
+                try:
+                    byte_range = parse_range(range_header, size)
+                except ValueError:
+                    headers['Content-Range'] = f'bytes */{size}'
+                    headers['Content-Length'] = '0'
+                    self._send_headers(handler, 416, headers)
+                    return True
+                if byte_range:
+                    status, (start, end) = 206, byte_range
+                    headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+            length = end - start + 1 if size else 0
+            headers['Content-Length'] = str(length)
+            self._send_headers(handler, status, headers)
+            if not head_only and length:
+                # socket.sendfile использует os.sendfile (без копирования), где он есть
+                handler.connection.sendfile(f, start, length)
+        return True
+
+    @staticmethod
+    def _not_modified(handler, etag: str, mtime: float) -> bool:
+        """Условный запрос: If-None-Match, а без него If-Modified-Since"""
+        if_none_match = handler.headers.get('If-None-Match')
+        if if_none_match:
+            return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+
+        if_modified_since = handler.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    @staticmethod
+    def _send_headers(handler, status: int, headers: dict):
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
@@ -0,0 +1,94 @@
+"""
+Общие фикстуры тестов: один и тот же сценарий гоняется на всех движках хранения
+"""
+
+import json
+import sys
+import threading
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from db.database import DatabaseManager  # noqa: E402
+from db.memory_engine import MemoryDatabaseManager  # noqa: E402
+from db.sharding import ShardedDatabaseManager  # noqa: E402
+from db.idempotency import IdempotencyStore  # noqa: E402
+from admission import AdmissionController  # noqa: E402
+
+ENGINES = ('sqlite', 'memory', 'sharded')
+
+# Токен бота в тестах API (от него же считается секрет JWT)
+BOT_TOKEN = 'test-bot-token'
+
+
+def open_memory(path: Path) -> MemoryDatabaseManager:
+    """Движок в памяти без фоновых снимков (снимок - только явный)"""
+    return MemoryDatabaseManager(path / 'game.db', journal_dir=path / 'journal', snapshot_interval=3600)
+
+
+def crash(db: MemoryDatabaseManager):
+    """Остановить движок как при сбое: журнал на диске, снимка нет"""
+    db._stop_snapshots.set()
+    db._snapshot_thread.join()
+    db.journal.close()
+
+
+@pytest.fixture(params=ENGINES)
+def db(request, tmp_path):
+    """Свежая база каждого движка"""
+    if request.param == 'sqlite':
+        manager = DatabaseManager(tmp_path / 'game.db')
+    elif request.param == 'memory':
+        manager = open_memory(tmp_path)
+    else:
+        manager = ShardedDatabaseManager(tmp_path, 3)
+    yield manager
+    if request.param == 'memory':
+        manager.close()
+
+
+@pytest.fixture(scope='session')
+def web_api(tmp_path_factory):
+    """Модуль API: база по умолчанию во временном каталоге, без фонового обслуживания"""
+    pytest.importorskip('jwt')
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('DB_PATH', str(tmp_path_factory.mktemp('api') / 'game.db'))
+        patch.setenv('DB_ENGINE', 'sqlite')
+        patch.setenv('DB_SHARDS', '1')
+        patch.setenv('MAINTENANCE_ENABLED', '0')
+        patch.setenv('BOT_TOKEN', BOT_TOKEN)
+        import web_api
+    return web_api
+
+
+@pytest.fixture
+def api(web_api, db, monkeypatch):
+    """Сервер API на свободном порту поверх базы из фикстуры db; возвращает адрес"""
+    monkeypatch.setattr(web_api, 'db_manager', db)
+    monkeypatch.setattr(web_api, 'idempotency_store', IdempotencyStore(db))
+    monkeypatch.setattr(web_api, 'admission_controller', AdmissionController(max_concurrency=8, rate=1000, burst=1000))
+    server = web_api.GameAPIServer(('127.0.0.1', 0), web_api.GameAPIHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def call(url: str, method: str = 'GET', payload: dict = None, headers: dict = None):
+    """HTTP запрос к API: (код ответа, JSON тела, заголовки)"""
+    data = json.dumps(payload).encode('utf-8') if payload is not None else None
+    request = urllib.request.Request(url, data=data, method=method, headers=headers or {})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status, json.loads(response.read() or b'null'), response.headers
+    except urllib.error.HTTPError as e:
+        body = e.read()
+        try:
+            return e.code, json.loads(body or b'null'), e.headers
+        except ValueError:
+            return e.code, None, e.headers
@@ -0,0 +1,93 @@
+"""
+Контроль допуска: корзины токенов, приоритеты, ключ лимита за прокси
+"""
+
+import threading
+import time
+
+import pytest
+
+from admission import (PRIORITY_CRITICAL, PRIORITY_POLL, PRIORITY_WRITE, AdmissionController,
+                       TokenBucket)
+from conftest import call
+
+
+def test_bucket_spends_burst_then_refills():
+    bucket = TokenBucket(rate=2.0, capacity=3.0, now=0.0)
+    assert [bucket.take(0.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    # Пустая корзина: ждать, пока набежит один токен
+    assert bucket.take(0.0) == pytest.approx(0.5)
+    assert bucket.take(0.5) == 0.0
+    # Долгий простой не копит токенов больше емкости
+    bucket.take(100.0)
+    assert bucket.tokens == pytest.approx(2.0)
+
+
+def test_rate_is_limited_per_key():
+    controller = AdmissionController(rate=0.001, burst=2)
+    assert controller.check_rate('a') == 0
+    assert controller.check_rate('a') == 0
+    assert controller.check_rate('a') > 0
+    assert controller.check_rate('b') == 0
+    assert controller.stats()['shed_rate_limited'] == 1
+
+
+def test_oldest_buckets_are_evicted():
+    controller = AdmissionController(rate=0.001, burst=1, max_buckets=2)
+    controller.check_rate('a')
+    controller.check_rate('b')
+    controller.check_rate('a')  # 'a' снова самый свежий
+    controller.check_rate('c')
+    assert list(controller._buckets) == ['a', 'c']
+    # Вытесненный ключ начинает с полной корзины
+    assert controller.check_rate('b') == 0
+
+
+def test_polls_are_shed_before_writes_and_critical():
+    controller = AdmissionController(max_concurrency=10, queue_timeout=0)
+    assert controller.limits == {PRIORITY_CRITICAL: 10, PRIORITY_WRITE: 8, PRIORITY_POLL: 6}
+    for _ in range(6):
+        assert controller.acquire(PRIORITY_POLL)
+    assert not controller.acquire(PRIORITY_POLL)
+    assert controller.acquire(PRIORITY_WRITE)
+    assert controller.acquire(PRIORITY_WRITE)
+    assert not controller.acquire(PRIORITY_WRITE)
+    assert controller.acquire(PRIORITY_CRITICAL)
+    assert controller.acquire(PRIORITY_CRITICAL)
+    assert not controller.acquire(PRIORITY_CRITICAL)
+
+    stats = controller.stats()
+    assert stats['in_flight'] == 10
+    assert stats['shed_overload'] == {'critical': 1, 'write': 1, 'poll': 1}
+
+
+def test_critical_request_waits_for_a_free_slot():
+    controller = AdmissionController(max_concurrency=1, queue_timeout=2)
+    assert controller.acquire(PRIORITY_CRITICAL)
+    threading.Timer(0.05, controller.release).start()
+
+    started = time.monotonic()
+    assert controller.acquire(PRIORITY_CRITICAL)
+    assert time.monotonic() - started < 1
+    # Опрос не ждет в очереди
+    assert not controller.acquire(PRIORITY_POLL)
+    controller.release()
+    assert controller.wait_idle(1)
+
+
+def test_rate_key_is_forwarded_client_behind_proxy(api, web_api, monkeypatch):
+    monkeypatch.setattr(web_api, 'admission_controller', AdmissionController(rate=0.001, burst=1))
+    payload = {'user_id': 1, 'amount': 1}
+
+    def spend(client_ip):
+        return call(api + '/api/user/spend', 'POST', payload, {'X-Forwarded-For': f'{client_ip}, 10.0.0.1'})
+
+    assert spend('203.0.113.1')[0] != 429
+    status, _, headers = spend('203.0.113.1')
+    assert status == 429
+    assert int(headers['Retry-After']) >= 1
+    # Другой клиент за тем же прокси - своя корзина
+    assert spend('203.0.113.2')[0] != 429
+    # Клики не ограничиваются корзиной
+    for _ in range(3):
+        assert call(api + '/api/user/click', 'POST', {'user_id': 1, 'clicks': 1})[0] != 429
@@ -0,0 +1,103 @@
+"""
+Резервные копии: набор с манифестом, проверка целостности, восстановление, ротация
+"""
+
+import gzip
+import json
+import time
+
+import pytest
+
+from db.backup import MANIFEST_NAME, PARTIAL_PREFIX, BackupAborted, BackupManager, find_sources
+from db.sharding import ShardedDatabaseManager
+
+
+@pytest.fixture
+def source(tmp_path):
+    """Три шарда с игроками и их балансами"""
+    db = ShardedDatabaseManager(tmp_path / 'live', 3)
+    for user_id in range(1, 7):
+        db.create_or_update_user(user_id, {'username': f'user{user_id}'})
+        db.update_coins(user_id, user_id * 100, 'manual')
+    return db
+
+
+def test_backup_set_verifies_and_restores(source, tmp_path):
+    backups = BackupManager(tmp_path / 'backups', step_sleep=0)
+    backup_set = backups.create(find_sources(tmp_path / 'live'))
+    assert backups.list_sets() == [backup_set]
+
+    manifest = json.loads((backup_set / MANIFEST_NAME).read_text(encoding='utf-8'))
+    assert [entry['source'] for entry in manifest['files']] == ['shard_00.db', 'shard_01.db', 'shard_02.db']
+    assert sum(entry['tables']['users'] for entry in manifest['files']) == 6
+    assert backups.verify(backup_set) == []
+    # Проверка не оставляет распакованных файлов
+    assert sorted(path.name for path in backup_set.iterdir()) == [
+        MANIFEST_NAME, 'shard_00.db.gz', 'shard_01.db.gz', 'shard_02.db.gz']
+
+    restored = backups.restore(backup_set, tmp_path / 'restored')
+    assert [path.name for path in restored] == ['shard_00.db', 'shard_01.db', 'shard_02.db']
+    assert not list((tmp_path / 'restored').glob('*.restoring*'))
+    db = ShardedDatabaseManager(tmp_path / 'restored', 3)
+    assert [db.get_user_balance(user_id) for user_id in range(1, 7)] == [100, 200, 300, 400, 500, 600]
+
+
+def test_verify_reports_damaged_sets(source, tmp_path):
+    backups = BackupManager(tmp_path / 'backups', step_sleep=0)
+    backup_set = backups.create(find_sources(tmp_path / 'live'))
+    manifest_path = backup_set / MANIFEST_NAME
+    manifest = json.loads(manifest_path.read_text(encoding='utf-8'))
+
+    # Число строк в манифесте не сходится с базой
+    manifest['files'][1]['tables']['users'] += 1
+    manifest_path.write_text(json.dumps(manifest), encoding='utf-8')
+    assert backups.verify(backup_set) == ['shard_01.db: число строк не совпадает с манифестом']
+
+    # Архив поврежден или пропал
+    (backup_set / 'shard_00.db.gz').write_bytes(gzip.compress(b'not a database'))
+    (backup_set / 'shard_02.db.gz').unlink()
+    errors = backups.verify(backup_set)
+    assert errors[0] == 'shard_00.db.gz: контрольная сумма архива не совпадает'
+    assert errors[-1] == 'shard_02.db.gz: файл отсутствует'
+
+
+def test_restore_refuses_damaged_set_and_existing_files(source, tmp_path):
+    backups = BackupManager(tmp_path / 'backups', step_sleep=0)
+    backup_set = backups.create(find_sources(tmp_path / 'live'))
+
+    with pytest.raises(ValueError, match='--force'):
+        backups.restore(backup_set, tmp_path / 'live')
+
+    target = tmp_path / 'target'
+    target.mkdir()
+    (target / 'shard_00.db-wal').write_bytes(b'old wal')
+    backups.restore(backup_set, target)
+    assert not (target / 'shard_00.db-wal').exists()
+
+    (backup_set / 'shard_01.db.gz').write_bytes(b'garbage')
+    with pytest.raises(ValueError, match='контрольная сумма'):
+        backups.restore(backup_set, target, force=True)
+    # Неудачное восстановление не оставляет полупроверенных файлов
+    assert not list(target.glob('*.restoring'))
+
+
+def test_aborted_backup_leaves_no_set(source, tmp_path):
+    backups = BackupManager(tmp_path / 'backups', pages_per_step=1, step_sleep=0)
+    with pytest.raises(BackupAborted):
+        backups.create(find_sources(tmp_path / 'live'), deadline=time.monotonic() - 1)
+    assert backups.list_sets() == []
+    assert not list((tmp_path / 'backups').glob(f'{PARTIAL_PREFIX}*'))
+
+
+def test_prune_keeps_latest_sets(tmp_path):
+    backups = BackupManager(tmp_path, keep=2)
+    for name in ('20260101-000000', '20260102-000000', '20260103-000000'):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / MANIFEST_NAME).write_text('{}')
+    # Папка без манифеста - не набор
+    (tmp_path / 'notes').mkdir()
+
+    removed = backups.prune()
+    assert [path.name for path in removed] == ['20260101-000000']
+    assert [path.name for path in backups.list_sets()] == ['20260102-000000', '20260103-000000']
+    assert (tmp_path / 'notes').exists()
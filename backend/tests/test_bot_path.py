@@ -0,0 +1,56 @@
+"""
+Запись из бота на всех движках: данные бота видит процесс API, снимок их не затирает
+"""
+
+import pytest
+
+from conftest import BOT_TOKEN, call
+from db.engine import create_client_database_manager
+from db.memory_engine import MemoryDatabaseManager
+from db.remote import RemoteDatabaseManager
+from db.sharding import ShardedDatabaseManager
+
+
+@pytest.fixture
+def bot_db(api, db, tmp_path, monkeypatch):
+    """Менеджер бота для того же движка, что и у API"""
+    monkeypatch.delenv('DB_SHARDS', raising=False)
+    monkeypatch.setenv('DB_ENGINE', 'memory' if isinstance(db, MemoryDatabaseManager) else 'sqlite')
+    if isinstance(db, ShardedDatabaseManager):
+        monkeypatch.setenv('DB_SHARDS', str(len(db.shards)))
+        monkeypatch.setenv('DB_SHARD_DIR', str(tmp_path))
+    return create_client_database_manager(api, BOT_TOKEN, tmp_path / 'game.db')
+
+
+def test_memory_engine_bot_goes_through_api(db, bot_db):
+    assert isinstance(bot_db, RemoteDatabaseManager) == isinstance(db, MemoryDatabaseManager)
+
+
+def test_bot_start_with_referral(db, bot_db):
+    assert bot_db.create_or_update_user(1, {'username': 'alice', 'first_name': 'Alice'})
+    assert bot_db.create_or_update_user(2, {'username': 'bob', 'first_name': 'Bob'})
+    assert bot_db.add_referral(1, 2)
+    assert not bot_db.add_referral(1, 2)
+
+    # Процесс API видит пользователей и бонус, записанные ботом
+    assert db.get_user(2)['username'] == 'bob'
+    assert db.get_user_balance(1) == 100
+    assert db.get_referral_stats(1)['total_referrals'] == 1
+
+    if isinstance(db, MemoryDatabaseManager):
+        db.snapshot()
+        with db.get_connection() as conn:
+            coins = conn.execute("SELECT coins FROM game_state WHERE user_id = 1").fetchone()[0]
+        assert coins == 100
+
+    profile = bot_db.get_user_profile(1)
+    assert profile['coins'] == 100
+    assert profile['referrals_count'] == 1
+
+
+def test_bot_endpoints_require_bot_token(api, db):
+    status, _, _ = call(f"{api}/api/bot/user", 'POST', {'user_id': 1})
+    assert status == 403
+    status, _, _ = call(f"{api}/api/bot/profile?user_id=1", headers={'X-Bot-Token': 'wrong'})
+    assert status == 403
+    assert db.get_user(1) is None
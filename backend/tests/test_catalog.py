@@ -0,0 +1,92 @@
+"""
+Каталог магазина: таблица цен по уровням, проверка файла, перезагрузка при изменении
+"""
+
+import json
+import os
+
+import pytest
+
+from db.catalog import ShopCatalog, load_catalog, shop_catalog
+
+
+def write_catalog(path, items, version=1, **extra):
+    path.write_text(json.dumps({'version': version, 'items': items, **extra}))
+    # Две записи подряд могут получить одно время изменения - сдвигаем его явно
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    return path
+
+
+def item(item_id='tap', **fields):
+    return {'id': item_id, 'name': item_id, 'price': 100, 'effect_type': 'click_power',
+            'effect_value': 1, 'max_level': 3, **fields}
+
+
+def test_prices_and_effects_are_precomputed_per_level(tmp_path):
+    path = write_catalog(tmp_path / 'shop.json', [
+        item('tap'),
+        item('farm', price=10, price_growth=2, effects=[1, 2, 5], effect_type='passive_income'),
+    ], price_growth=1.5)
+    tap, farm = load_catalog(path).items
+
+    assert list(tap.prices) == [100, 150, 225, 337]
+    assert list(farm.prices) == [10, 20, 40, 80]
+    assert [farm.as_dict(level)['effect_value'] for level in range(4)] == [1, 2, 5, 5]
+
+    top = farm.as_dict(3)
+    assert (top['price'], top['available'], top['current_level']) == (80, False, 3)
+    # Уровень выше максимума (каталог урезали) не выходит за таблицу
+    assert farm.as_dict(7)['price'] == 80
+
+
+@pytest.mark.parametrize('items, message', [
+    ([item(), item()], 'duplicate item id'),
+    ([item(max_level=0)], 'must be positive'),
+    ([item(effects=[1, 2])], 'must have max_level values'),
+    ([{'id': 'tap', 'name': 'tap'}], 'Invalid shop catalog'),
+])
+def test_invalid_catalog_is_rejected(tmp_path, items, message):
+    path = write_catalog(tmp_path / 'shop.json', items)
+    with pytest.raises(ValueError, match=message):
+        load_catalog(path)
+
+
+def test_version_changes_with_content(tmp_path):
+    path = write_catalog(tmp_path / 'shop.json', [item()])
+    first = load_catalog(path).version
+    write_catalog(path, [item(price=120)])
+    second = load_catalog(path).version
+    assert first.startswith('1-') and second.startswith('1-')
+    assert first != second
+
+
+def test_catalog_reloads_changed_file_and_keeps_last_good(tmp_path):
+    path = write_catalog(tmp_path / 'shop.json', [item()])
+    catalog = ShopCatalog(path, check_interval=0)
+    assert catalog.get('tap').prices[0] == 100
+    first = catalog.current()
+    # Неизмененный файл не перечитывается
+    assert catalog.current() is first
+
+    write_catalog(path, [item(price=200)], version=2)
+    assert catalog.get('tap').prices[0] == 200
+    assert catalog.version.startswith('2-')
+
+    # Недописанный файл: остается последняя рабочая версия
+    path.write_text('{"version": 3, "items": [')
+    assert catalog.get('tap').prices[0] == 200
+    path.unlink()
+    assert catalog.version.startswith('2-')
+
+
+def test_buy_uses_price_of_current_level(db):
+    db.create_or_update_user(1, {'username': 'user1'})
+    db.update_coins(1, 10000, 'manual')
+    prices = shop_catalog.get('click_power_1').prices
+
+    for level in range(3):
+        result = db.buy_upgrade(1, 'click_power_1')
+        assert result['success']
+        assert result['data']['item']['price'] == prices[level]
+    assert db.get_user_balance(1) == 10000 - sum(prices[:3])
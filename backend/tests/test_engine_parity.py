@@ -0,0 +1,329 @@
+"""
+Одинаковое поведение DatabaseManager, MemoryDatabaseManager и ShardedDatabaseManager
+"""
+
+import base64
+import time
+from urllib.parse import urlencode
+
+import pytest
+
+from conftest import call, crash, open_memory
+from db.database import REFERRAL_TREE_DEPTH, encode_cursor
+
+
+def create_users(db, *user_ids):
+    for user_id in user_ids:
+        db.create_or_update_user(user_id, {'username': f'user{user_id}'})
+
+
+def count_rows(db, table: str) -> int:
+    managers = db.shard_managers() if hasattr(db, 'shard_managers') else [db]
+    total = 0
+    for manager in managers:
+        with manager.get_connection() as conn:
+            total += conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    return total
+
+
+def test_coin_purchase_is_credited_once(db):
+    create_users(db, 1)
+    assert db.add_coin_purchase(1, 500, 99, 'pay-1')
+    assert db.add_coin_purchase(1, 500, 99, 'pay-1')
+    assert db.get_user_balance(1) == 500
+    assert count_rows(db, 'coin_purchases') == 1
+
+
+def test_spend_batch_and_session_replay(db):
+    create_users(db, 1)
+    db.update_coins(1, 100, 'manual')
+
+    result = db.spend_coins(1, [(1, 30), (2, 50), (3, 40), (4, 20)], 's1')
+    assert not result['success']
+    # Номера трат свернуты в диапазоны [первый, последний]
+    assert result['data']['accepted'] == [[1, 2], [4, 4]]
+    assert result['data']['rejected'] == [[3, 3]]
+    assert result['data']['balance'] == 0
+
+    # Повтор той же пачки ничего не списывает
+    result = db.spend_coins(1, [(3, 40), (4, 20), (5, 5)], 's1')
+    assert result['data']['duplicate'] == [[3, 4]]
+    assert result['data']['rejected'] == [[5, 5]]
+    assert db.get_user_balance(1) == 0
+
+
+def test_referral_links_once_and_pays_bonus(db):
+    create_users(db, 1, 2, 3)
+    assert db.add_referral(1, 2)
+    assert not db.add_referral(1, 2)
+    assert not db.add_referral(3, 2)
+    # Цикл: 1 уже пригласил 2
+    assert not db.add_referral(2, 1)
+    assert db.get_user_balance(1) == 100
+
+    stats = db.get_referral_stats(1)
+    assert [referral['user_id'] for referral in stats['referrals']] == [2]
+
+
+def test_referral_cycle_deeper_than_tree(db):
+    chain = list(range(1, REFERRAL_TREE_DEPTH + 4))
+    create_users(db, *chain)
+    for referrer_id, referred_id in zip(chain, chain[1:]):
+        assert db.add_referral(referrer_id, referred_id)
+    assert not db.add_referral(chain[-1], chain[0])
+
+
+def test_achievement_reward_is_claimed_once(db):
+    create_users(db, 1)
+    db.update_click_stats(1, 100)
+
+    result = db.claim_achievements(1, 'clicks_100')
+    assert result['success']
+    assert result['data']['reward'] == 50
+    assert not db.claim_achievements(1, 'clicks_100')['success']
+    assert db.get_user_balance(1) == db.get_balance(1)['balance']
+
+
+def test_transactions_paging(db):
+    create_users(db, 1)
+    for amount in range(1, 6):
+        db.update_coins(1, amount, 'manual')
+
+    amounts, cursor = [], None
+    while True:
+        page = db.get_transactions(1, limit=2, cursor=cursor)
+        amounts += [tx['amount'] for tx in page['transactions']]
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+    assert amounts == [5, 4, 3, 2, 1]
+
+    page = db.get_transactions(1, limit=10, transaction_types=['purchase'])
+    assert page['transactions'] == []
+
+
+MALFORMED_CURSORS = [
+    'not base64!', encode_cursor(), encode_cursor(1.5), encode_cursor(1.5, 2, 3),
+    encode_cursor('1.5', 2), encode_cursor(1.5, '2'), encode_cursor(1.5, 2.5), encode_cursor(True, 2),
+    base64.urlsafe_b64encode(b'42').decode('ascii'), base64.urlsafe_b64encode(b'{"a": 1}').decode('ascii'),
+]
+
+
+@pytest.mark.parametrize('cursor', MALFORMED_CURSORS)
+def test_malformed_cursor_is_rejected(db, cursor):
+    create_users(db, 1)
+    with pytest.raises(ValueError):
+        db.get_transactions(1, cursor=cursor)
+    with pytest.raises(ValueError):
+        db.get_referral_stats(1, cursor=cursor)
+
+
+def test_malformed_cursor_is_bad_request(api):
+    for cursor in MALFORMED_CURSORS:
+        status, body, _ = call(f"{api}/api/user/transactions?" + urlencode(
+            {'user_id': 1, 'auth_date': 1, 'cursor': cursor}))
+        assert status == 400
+        assert body == {'success': False, 'message': 'Invalid cursor'}
+
+
+def test_reconcile_finds_no_drift(db):
+    create_users(db, 1, 2)
+    db.update_coins(1, 1000, 'manual')
+    db.spend_coins(1, [(1, 10), (2, 20)], 's')
+    db.add_coin_purchase(2, 500, 99, 'pay-2')
+
+    report = db.reconcile_ledger()
+    assert report['mismatches'] == 0
+    assert report['users_checked'] == 2
+    assert db.reconcile_ledger()['users_checked'] == 0
+
+
+def test_reconcile_in_batches(db):
+    create_users(db, 1, 2)
+    for amount in range(1, 6):
+        db.update_coins(1, amount, 'manual')
+        db.update_coins(2, amount, 'manual')
+
+    checked = 0
+    for _ in range(10):
+        report = db.reconcile_ledger(limit=3)
+        assert report['mismatches'] == 0
+        checked += report['transactions_checked']
+        if report['complete']:
+            break
+    assert checked == 10
+    assert db.reconcile_ledger(limit=3) == {
+        'users_checked': 0, 'transactions_checked': 0, 'mismatches': 0, 'repaired': 0, 'samples': [],
+        'complete': True
+    }
+
+
+def test_reconcile_repair_survives_snapshot(db):
+    create_users(db, 1)
+    db.update_coins(1, 100, 'manual')
+    # Расхождение мимо журнала транзакций
+    for manager in (db.shard_managers() if hasattr(db, 'shard_managers') else [db]):
+        manager._adjust_totals(1, 7, 0, 0)
+    assert db.get_user_balance(1) == 107
+
+    report = db.reconcile_ledger(repair=True)
+    assert (report['mismatches'], report['repaired']) == (1, 1)
+    if hasattr(db, 'snapshot'):
+        db.snapshot()
+    assert db.get_user_balance(1) == 100
+
+    db.update_coins(1, 1, 'manual')
+    assert db.reconcile_ledger()['mismatches'] == 0
+
+
+def test_memory_reconcile_snapshots_once_per_pass(tmp_path, monkeypatch):
+    db = open_memory(tmp_path)
+    try:
+        create_users(db, 1)
+        for amount in range(1, 5):
+            db.update_coins(1, amount, 'manual')
+        snapshots = []
+        snapshot = db.snapshot
+        monkeypatch.setattr(db, 'snapshot', lambda: snapshots.append(1) or snapshot())
+
+        while not db.reconcile_ledger(limit=1)['complete']:
+            pass
+        assert len(snapshots) == 1
+        db.reconcile_ledger(limit=1)
+        assert len(snapshots) == 2
+    finally:
+        db.close()
+
+
+def test_earning_writes_leave_bucket_expiry_to_maintenance(db):
+    create_users(db, 1)
+    with db.connection_for(1) as conn:
+        conn.executemany("INSERT INTO earning_buckets (period, bucket, user_id, earned) VALUES (?, ?, 1, 5)",
+                         [('day', 1), ('day', 2), ('week', 1)])
+        conn.commit()
+
+    db.update_coins(1, 10, 'manual')
+    if hasattr(db, 'snapshot'):
+        db.snapshot()
+    assert count_rows(db, 'earning_buckets') == 5
+
+    assert db.expire_earning_buckets(limit=2) == 2
+    assert db.expire_earning_buckets(limit=2) == 1
+    assert count_rows(db, 'earning_buckets') == 2
+
+
+def test_sync_returns_changed_sections(db):
+    create_users(db, 1)
+    full = db.get_state_changes(1)
+    assert full['full']
+    assert full['changed']['coins']['coins'] == 0
+
+    idle = db.get_state_changes(1, full['version'])
+    assert idle == {'version': full['version'], 'full': False, 'changed': {}}
+
+    db.update_click_stats(1, 5)
+    delta = db.get_state_changes(1, full['version'])
+    assert not delta['full']
+    assert delta['changed']['stats']['total_clicks'] == 5
+    assert delta['version'] > full['version']
+
+
+def set_passive(db, user_id: int, passive_income: int, collected_at: float):
+    if hasattr(db, '_states'):
+        with db._lock:
+            state = db._states[user_id]
+            state.passive_income, state.last_passive_collection = passive_income, collected_at
+        return
+    with db.connection_for(user_id) as conn:
+        conn.execute("UPDATE game_state SET passive_income = ?, last_passive_collection = ? WHERE user_id = ?",
+                     (passive_income, collected_at, user_id))
+        conn.commit()
+
+
+def test_passive_collection_is_uncapped_and_stamped(db):
+    create_users(db, 1)
+    # Десять часов без захода в игру копятся целиком
+    set_passive(db, 1, 2, time.time() - 10 * 3600)
+    version = db.get_state_changes(1)['version']
+
+    result = db.spend_coins(1, [(1, 10 ** 9)])
+    assert result['data']['rejected'] == [[1, 1]]
+    assert 72000 <= db.get_user_balance(1) < 72010
+
+    delta = db.get_state_changes(1, version)
+    assert delta['version'] > version
+    assert delta['changed']['coins']['coins'] == db.get_user_balance(1)
+
+
+def test_memory_transactions_paging_across_snapshot(tmp_path):
+    db = open_memory(tmp_path)
+    try:
+        create_users(db, 1)
+        for amount in range(1, 4):
+            db.update_coins(1, amount, 'manual')
+        db.snapshot()
+        for amount in range(4, 7):
+            db.update_coins(1, amount, 'manual')
+
+        first = db.get_transactions(1, limit=2)
+        # Чтение истории не сбрасывает снимок
+        assert len(db._ledger) == 3
+        db.snapshot()
+        rest = db.get_transactions(1, limit=10, cursor=first['next_cursor'])
+        amounts = [tx['amount'] for tx in first['transactions'] + rest['transactions']]
+        assert amounts == [6, 5, 4, 3, 2, 1]
+    finally:
+        db.close()
+
+
+class Crash(Exception):
+    pass
+
+
+def test_memory_journal_replay_after_crash(tmp_path):
+    db = open_memory(tmp_path)
+    create_users(db, 1, 2)
+    db.snapshot()
+    db.update_coins(1, 300, 'manual')
+    db.update_click_stats(1, 7)
+    balance = db.buy_upgrade(1, 'click_power_1')['data']['new_balance']
+    crash(db)
+
+    db = open_memory(tmp_path)
+    try:
+        profile = db.get_user_profile(1)
+        assert profile['total_clicks'] == 7
+        assert db.get_user_upgrades(1)[0]['upgrade_id'] == 'click_power_1'
+        assert db.get_user_balance(1) == balance < 300
+    finally:
+        db.close()
+
+
+@pytest.mark.parametrize('action', [
+    lambda db: db.add_coin_purchase(1, 500, 99, 'pay-1'),
+    lambda db: db.add_referral(1, 2, 500),
+])
+def test_memory_credit_survives_crash_before_sqlite_commit(tmp_path, action):
+    db = open_memory(tmp_path)
+    create_users(db, 1, 2)
+    db.snapshot()
+    journal_credits = db._journal_credits
+
+    def credit_and_crash(*args):
+        journal_credits(*args)
+        raise Crash()
+
+    db._journal_credits = credit_and_crash
+    with pytest.raises(Crash):
+        action(db)
+    crash(db)
+
+    db = open_memory(tmp_path)
+    try:
+        # Начисление проиграно из журнала, строка-ключ дописана снимком - повтор ничего не дает
+        assert db.get_user_balance(1) == 500
+        action(db)
+        assert db.get_user_balance(1) == 500
+        assert count_rows(db, 'coin_purchases') + count_rows(db, 'referrals') == 1
+    finally:
+        db.close()
@@ -0,0 +1,97 @@
+"""
+Ключи идемпотентности: повтор, другое тело, ключ в работе, ошибки хранилища
+"""
+
+import sqlite3
+import time
+
+import pytest
+
+from conftest import call
+from db.idempotency import IdempotencyConflict, IdempotencyStore, request_fingerprint
+
+ENDPOINT = '/api/user/spend'
+
+
+def fingerprint(amount: int) -> str:
+    return request_fingerprint(ENDPOINT, {'user_id': 1, 'amount': amount})
+
+
+def test_completed_key_replays_response(db):
+    store = IdempotencyStore(db)
+    assert store.begin(1, 'k', ENDPOINT, fingerprint(5)) is None
+    store.complete(1, 'k', ENDPOINT, fingerprint(5), 200, {'success': True})
+
+    assert store.begin(1, 'k', ENDPOINT, fingerprint(5)) == (200, {'success': True})
+    # Другой воркер не видит кэша этого процесса, но видит строку в SQLite
+    assert IdempotencyStore(db).begin(1, 'k', ENDPOINT, fingerprint(5)) == (200, {'success': True})
+
+
+def test_key_reused_with_different_body_conflicts(db):
+    store = IdempotencyStore(db)
+    store.begin(1, 'k', ENDPOINT, fingerprint(5))
+    store.complete(1, 'k', ENDPOINT, fingerprint(5), 200, {'success': True})
+
+    with pytest.raises(IdempotencyConflict, match='different request'):
+        store.begin(1, 'k', ENDPOINT, fingerprint(6))
+    with pytest.raises(IdempotencyConflict, match='different request'):
+        IdempotencyStore(db).begin(1, 'k', ENDPOINT, fingerprint(6))
+
+
+def test_pending_key_conflicts_until_abandoned(db):
+    store = IdempotencyStore(db)
+    assert store.begin(1, 'k', ENDPOINT, fingerprint(5)) is None
+
+    with pytest.raises(IdempotencyConflict, match='in progress'):
+        store.begin(1, 'k', ENDPOINT, fingerprint(5))
+    # Резерв (status_code = 0) виден и другому воркеру
+    with pytest.raises(IdempotencyConflict, match='in progress'):
+        IdempotencyStore(db).begin(1, 'k', ENDPOINT, fingerprint(5))
+
+    store.abandon(1, 'k')
+    assert IdempotencyStore(db).begin(1, 'k', ENDPOINT, fingerprint(5)) is None
+
+
+def test_stale_pending_key_can_be_taken_again(db):
+    # Воркер упал, не дописав ответ: просроченный резерв занимается заново
+    with db.connection_for(1) as conn:
+        conn.execute("""
+            INSERT INTO idempotency_keys
+            (user_id, idempotency_key, endpoint, fingerprint, status_code, response, expires_at)
+            VALUES (1, 'k', ?, ?, 0, '', ?)
+        """, (ENDPOINT, fingerprint(5), time.time() - 1))
+        conn.commit()
+    assert IdempotencyStore(db).begin(1, 'k', ENDPOINT, fingerprint(5)) is None
+
+
+def spend(api, key, amount, session='s1'):
+    return call(f"{api}/api/user/spend", 'POST',
+                {'user_id': 1, 'session': session, 'spends': [{'seq': 1, 'amount': amount}]},
+                {'Idempotency-Key': key})
+
+
+def test_api_replays_spend(api, db):
+    db.create_user(1)
+    db.update_coins(1, 100, 'manual')
+
+    status, body, headers = spend(api, 'key-1', 10)
+    assert status == 200 and headers.get('Idempotent-Replayed') is None
+    replay_status, replay_body, replay_headers = spend(api, 'key-1', 10)
+    assert (replay_status, replay_body) == (status, body)
+    assert replay_headers['Idempotent-Replayed'] == 'true'
+    assert db.get_user_balance(1) == 90
+
+    status, body, _ = spend(api, 'key-1', 20)
+    assert status == 409
+    assert db.get_user_balance(1) == 90
+
+
+def test_api_storage_error_is_answered(api, db, web_api, monkeypatch):
+    def locked(*args):
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(web_api.idempotency_store, 'begin', locked)
+    status, body, headers = spend(api, 'key-2', 10)
+    assert status == 503
+    assert body['success'] is False
+    assert headers['Retry-After']
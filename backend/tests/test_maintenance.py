@@ -0,0 +1,158 @@
+"""
+Фоновое обслуживание: откладывание под нагрузкой, бюджет времени задач, обход шардов
+"""
+
+import threading
+import time
+
+import pytest
+
+import maintenance
+from db.database import DatabaseManager
+from db.idempotency import IdempotencyStore
+from db.sharding import ShardedDatabaseManager
+from maintenance import (MAINTENANCE_PARTIAL_RETRY, DatabaseMaintenance, MaintenanceJob,
+                         MaintenanceScheduler, create_maintenance)
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, 'не дождались'
+        time.sleep(0.01)
+
+
+def test_job_is_deferred_with_backoff_while_busy():
+    load = [1.0]
+    runs = []
+    job = MaintenanceJob('job', lambda deadline: runs.append(deadline) or (True, 'done'), 600, 0.25)
+    scheduler = MaintenanceScheduler([job], lambda: load[0], busy_load=0.5, max_defer=150)
+    scheduler._thread = threading.Thread(target=scheduler._run_loop, daemon=True)
+    scheduler._thread.start()
+    try:
+        wait_for(lambda: job.deferrals == 1)
+        assert job.defer == 1.0 and not runs
+        assert job.next_run - time.monotonic() == pytest.approx(1.0, abs=0.2)
+
+        # Пауза удваивается, но не больше max_defer
+        job.defer, job.next_run = 100.0, 0.0
+        wait_for(lambda: job.deferrals == 2)
+        assert job.defer == 150
+
+        # Нагрузка спала: задача выполняется, пауза сбрасывается
+        load[0], job.next_run = 0.0, 0.0
+        wait_for(lambda: job.runs == 1)
+        assert job.defer == 0.0 and len(runs) == 1
+    finally:
+        scheduler.stop()
+
+
+def test_run_job_records_partial_and_failed_runs():
+    published = []
+    steps = iter([(False, 'half'), RuntimeError('disk full'), (True, 'rest')])
+
+    def run(deadline):
+        assert deadline - time.monotonic() == pytest.approx(0.25, abs=0.1)
+        step = next(steps)
+        if isinstance(step, Exception):
+            raise step
+        return step
+
+    job = MaintenanceJob('job', run, 600, 0.25)
+    scheduler = MaintenanceScheduler([job], lambda: 0.0, publish=published.append)
+
+    scheduler.run_job(job)
+    assert (job.last_status, job.last_result) == ('partial', 'half')
+    # Не уложившаяся задача продолжится раньше своего интервала
+    assert job.next_run - time.monotonic() == pytest.approx(MAINTENANCE_PARTIAL_RETRY, abs=1)
+
+    scheduler.run_job(job)
+    assert (job.last_status, job.last_result, job.failures) == ('error', 'disk full', 1)
+
+    scheduler.run_job(job)
+    assert job.last_status == 'ok' and job.runs == 3
+    assert job.next_run - time.monotonic() == pytest.approx(600, abs=1)
+    assert published[-1]['jobs']['job']['runs'] == 3
+
+
+@pytest.fixture
+def sharded(tmp_path):
+    return ShardedDatabaseManager(tmp_path, 3)
+
+
+def test_shards_resume_after_deadline(sharded):
+    work = DatabaseMaintenance(sharded, IdempotencyStore(sharded), lambda: False)
+
+    # Бюджет исчерпан: первый шард выполняется всегда, остальные ждут следующего запуска
+    complete, result = work.analyze(time.monotonic() - 1)
+    assert not complete
+    assert result == 'shard_00.db: ANALYZE; остановлено перед шардом 1'
+
+    complete, result = work.analyze(time.monotonic() + 60)
+    assert complete
+    assert result == 'shard_01.db: ANALYZE; shard_02.db: ANALYZE; shard_00.db: ANALYZE'
+    assert work._cursors['analyze'] == 0
+
+
+def test_shards_stop_when_api_gets_busy(sharded):
+    busy = iter([False, True])
+    work = DatabaseMaintenance(sharded, IdempotencyStore(sharded), lambda: next(busy, True))
+    complete, result = work.checkpoint(time.monotonic() + 60)
+    assert not complete
+    assert result.endswith('остановлено перед шардом 2')
+
+
+def test_expire_stops_between_batches_at_deadline(tmp_path, monkeypatch):
+    monkeypatch.setattr(maintenance, 'EXPIRE_BATCH', 2)
+    db = DatabaseManager(tmp_path / 'game.db')
+    with db.get_connection() as conn:
+        conn.executemany("INSERT INTO spend_sessions (user_id, session, last_seq, updated_at) VALUES (1, ?, 1, 0)",
+                         [(f's{i}',) for i in range(5)])
+        conn.commit()
+    work = DatabaseMaintenance(db, IdempotencyStore(db), lambda: False)
+
+    complete, result = work.expire(time.monotonic() - 1)
+    assert not complete
+    assert 'сессий трат: 2' in result
+
+    complete, result = work.expire(time.monotonic() + 60)
+    assert complete
+    assert 'сессий трат: 3' in result
+
+
+def test_reconcile_runs_steps_until_complete(tmp_path, monkeypatch):
+    monkeypatch.setattr(maintenance, 'RECONCILE_STEP', 2)
+    db = DatabaseManager(tmp_path / 'game.db')
+    db.create_or_update_user(1, {'username': 'user1'})
+    for amount in range(1, 6):
+        db.update_coins(1, amount, 'manual')
+    work = DatabaseMaintenance(db, IdempotencyStore(db), lambda: False)
+
+    complete, result = work.reconcile(time.monotonic() + 60)
+    assert complete
+    assert 'транзакций 5, расхождений 0' in result
+
+
+def test_status_is_shared_through_the_database(tmp_path):
+    db = DatabaseManager(tmp_path / 'game.db')
+    work = DatabaseMaintenance(db, IdempotencyStore(db), lambda: False)
+    assert work.read_status() is None
+    job = MaintenanceJob('analyze', work.analyze, 600, 0.25)
+    MaintenanceScheduler([job], lambda: 0.0, publish=work.publish_status).run_job(job)
+
+    status = DatabaseMaintenance(DatabaseManager(tmp_path / 'game.db'), None, lambda: False).read_status()
+    assert status['jobs']['analyze']['last_status'] == 'ok'
+
+
+def test_jobs_follow_configuration(sharded, monkeypatch):
+    monkeypatch.delenv('BACKUP_DIR', raising=False)
+    monkeypatch.setenv('MAINTENANCE_ENABLED', '0')
+    scheduler, _ = create_maintenance(sharded, IdempotencyStore(sharded), lambda: 0.0)
+    assert scheduler is None
+
+    monkeypatch.setenv('MAINTENANCE_ENABLED', '1')
+    monkeypatch.setenv('MAINTENANCE_BUDGET_MS', '100')
+    scheduler, _ = create_maintenance(sharded, IdempotencyStore(sharded), lambda: 0.0)
+    assert [job.name for job in scheduler.jobs] == [
+        'checkpoint', 'expire', 'reconcile', 'vacuum', 'analyze', 'referrals']
+    assert {job.budget for job in scheduler.jobs} == {0.1}
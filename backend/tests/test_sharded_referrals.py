@@ -0,0 +1,109 @@
+"""
+Привязка реферала между шардами: сбой посередине дописывает resume_referrals
+"""
+
+import pytest
+
+from conftest import crash, open_memory
+from db.database import DatabaseManager
+from db.memory_engine import MemoryDatabaseManager
+from db.sharding import ShardedDatabaseManager, shard_for_user
+
+NUM_SHARDS = 3
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def sharded(request, tmp_path):
+    """Шарды SQLite или движка в памяти"""
+    if request.param == 'sqlite':
+        manager = ShardedDatabaseManager(tmp_path / 'shards', NUM_SHARDS)
+    else:
+        manager = ShardedDatabaseManager(tmp_path / 'shards', NUM_SHARDS, shard_factory=lambda path, index: (
+            MemoryDatabaseManager(path, journal_dir=path.parent / f'journal_{index:02d}', snapshot_interval=3600)))
+    yield manager
+    for shard in manager.shards:
+        if isinstance(shard, MemoryDatabaseManager):
+            shard.close()
+
+
+def chain_users():
+    """Три пользователя: пригласивший пригласившего лежит в другом шарде"""
+    users = range(1, 100)
+    return next((a, b, c) for a in users for b in users for c in users
+                if len({a, b, c}) == 3 and shard_for_user(a, NUM_SHARDS) != shard_for_user(b, NUM_SHARDS))
+
+
+def expected_balances(tmp_path, a, b, c):
+    """Те же привязки в одной базе без сбоев"""
+    db = DatabaseManager(tmp_path / 'single.db')
+    for user_id in (a, b, c):
+        db.create_user(user_id)
+    db.add_referral(a, b)
+    db.add_referral(b, c)
+    return [db.get_user_balance(user_id) for user_id in (a, b, c)], db.get_team_stats(a)
+
+
+def intents(sharded) -> int:
+    return sum(row[0] for row in sharded._scatter("SELECT COUNT(*) FROM referral_intents", ()))
+
+
+def test_failure_between_shards_is_resumed(sharded, tmp_path, monkeypatch):
+    a, b, c = chain_users()
+    balances, team = expected_balances(tmp_path, a, b, c)
+    for user_id in (a, b, c):
+        sharded.create_user(user_id)
+    assert sharded.add_referral(a, b)
+
+    # Шард предка второго уровня падает: бонус первого уровня уже начислен в другом шарде
+    failing = sharded.shard(a)
+    monkeypatch.setattr(failing, 'apply_referral_step', lambda *args: False)
+    assert not sharded.add_referral(b, c)
+    assert intents(sharded) == 1
+    assert sharded.get_user_balance(a) < balances[0]
+    # Место пригласившего занято: повтор не привязывает второй раз
+    assert not sharded.add_referral(b, c)
+
+    monkeypatch.undo()
+    assert sharded.resume_referrals(older_than=-1) == (1, 0)
+    assert sharded.resume_referrals(older_than=-1) == (0, 0)
+    assert intents(sharded) == 0
+    assert [sharded.get_user_balance(user_id) for user_id in (a, b, c)] == balances
+    assert sharded.get_team_stats(a) == team
+    assert sharded.get_referral_stats(b)['total_referrals'] == 1
+
+
+def test_resumed_step_is_not_applied_twice(sharded, tmp_path):
+    a, b, c = chain_users()
+    balances, team = expected_balances(tmp_path, a, b, c)
+    for user_id in (a, b, c):
+        sharded.create_user(user_id)
+    assert sharded.add_referral(a, b)
+    assert sharded.add_referral(b, c)
+
+    # Намерение осталось (сбой перед его удалением): повтор всех шагов ничего не меняет
+    with sharded.shard(c).get_connection() as conn:
+        conn.execute("INSERT INTO referral_intents VALUES (?, ?, 100, 0)", (c, b))
+        conn.commit()
+    assert sharded.resume_referrals() == (1, 0)
+    assert [sharded.get_user_balance(user_id) for user_id in (a, b, c)] == balances
+    assert sharded.get_team_stats(a) == team
+
+
+def test_memory_shard_step_survives_crash(tmp_path):
+    db = open_memory(tmp_path)
+    db.create_user(1)
+    db.create_user(2)
+    db.snapshot()
+    assert db.apply_referral_step(2, [(1, 0)], [(2, 0)], [(1, 1, 100)], 1.0)
+    # Повтор до снимка видит отметку в очереди журнала
+    assert db.apply_referral_step(2, [(1, 0)], [(2, 0)], [(1, 1, 100)], 1.0)
+    crash(db)
+
+    # Бонус проигран из журнала, отметку шага дописал снимок восстановления
+    db = open_memory(tmp_path)
+    try:
+        assert db.apply_referral_step(2, [(1, 0)], [(2, 0)], [(1, 1, 100)], 1.0)
+        assert db.get_user_balance(1) == 100
+        assert db.get_team_stats(1, 1) == {'depth': 1, 'members': 1, 'earnings': 100}
+    finally:
+        db.close()
@@ -0,0 +1,148 @@
+"""
+Раздача статики: диапазоны, ETag и условные запросы, выбор предсжатого .br
+"""
+
+import http.client
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from static_files import IMMUTABLE_CACHE, REVALIDATE_CACHE, StaticFiles, parse_range
+
+BODY = bytes(range(256)) * 4
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-9', (0, 9)),
+    ('bytes=1000-', (1000, 1023)),
+    ('bytes=1000-5000', (1000, 1023)),
+    ('bytes=-24', (1000, 1023)),
+    ('bytes=-5000', (0, 1023)),
+    ('bytes=9-0', None),
+    ('bytes=0-1,5-9', None),
+    ('items=0-9', None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, len(BODY)) == expected
+
+
+@pytest.mark.parametrize('header', ['bytes=1024-', 'bytes=-0'])
+def test_unsatisfiable_range(header):
+    with pytest.raises(ValueError):
+        parse_range(header, len(BODY))
+
+
+@pytest.fixture
+def site(tmp_path):
+    """Сервер статики над временным корнем; возвращает функцию запроса (код, заголовки, тело)"""
+    (tmp_path / 'index.html').write_text('<html>index</html>')
+    (tmp_path / 'game.data').write_bytes(BODY)
+    (tmp_path / 'app.js').write_text('plain()')
+    (tmp_path / 'app.js.br').write_bytes(b'brotli-bytes')
+    (tmp_path / 'Build.0123456789abcdef0123.wasm').write_bytes(b'\0asm')
+    (tmp_path.parent / 'secret.txt').write_text('secret')
+    files = StaticFiles(tmp_path)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if not files.serve(self, self.path):
+                self.send_error(404)
+
+        def do_HEAD(self):
+            if not files.serve(self, self.path, head_only=True):
+                self.send_error(404)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def fetch(path, headers=None, method='GET'):
+        conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=5)
+        conn.request(method, path, headers={'Accept-Encoding': 'identity', **(headers or {})})
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        return response.status, response.headers, body
+
+    yield fetch
+    server.shutdown()
+    server.server_close()
+
+
+def test_full_file_with_validators(site):
+    status, headers, body = site('/game.data')
+    assert status == 200 and body == BODY
+    assert headers['Content-Type'] == 'application/octet-stream'
+    assert headers['Accept-Ranges'] == 'bytes'
+    assert headers['Cache-Control'] == REVALIDATE_CACHE
+    assert headers['ETag'].startswith('"')
+
+    status, headers, body = site('/game.data', method='HEAD')
+    assert (status, body) == (200, b'')
+    assert headers['Content-Length'] == str(len(BODY))
+
+
+def test_conditional_requests(site):
+    _, headers, _ = site('/game.data')
+    etag, last_modified = headers['ETag'], headers['Last-Modified']
+
+    assert site('/game.data', {'If-None-Match': etag})[0] == 304
+    assert site('/game.data', {'If-None-Match': f'"other", {etag}'})[0] == 304
+    assert site('/game.data', {'If-None-Match': '"other"'})[0] == 200
+    assert site('/game.data', {'If-Modified-Since': last_modified})[0] == 304
+    # If-None-Match важнее If-Modified-Since
+    assert site('/game.data', {'If-None-Match': '"other"', 'If-Modified-Since': last_modified})[0] == 200
+
+
+def test_range_requests(site):
+    status, headers, body = site('/game.data', {'Range': 'bytes=10-19'})
+    assert status == 206 and body == BODY[10:20]
+    assert headers['Content-Range'] == f'bytes 10-19/{len(BODY)}'
+
+    status, _, body = site('/game.data', {'Range': 'bytes=-4'})
+    assert status == 206 and body == BODY[-4:]
+
+    status, headers, body = site('/game.data', {'Range': 'bytes=5000-'})
+    assert status == 416 and body == b''
+    assert headers['Content-Range'] == f'bytes */{len(BODY)}'
+
+    # If-Range с устаревшим ETag - файл целиком
+    etag = site('/game.data')[1]['ETag']
+    assert site('/game.data', {'Range': 'bytes=0-0', 'If-Range': etag})[0] == 206
+    status, _, body = site('/game.data', {'Range': 'bytes=0-0', 'If-Range': '"stale"'})
+    assert status == 200 and body == BODY
+
+
+def test_precompressed_brotli_is_negotiated(site):
+    status, headers, body = site('/app.js', {'Accept-Encoding': 'gzip, br;q=0.9'})
+    assert status == 200 and body == b'brotli-bytes'
+    assert headers['Content-Encoding'] == 'br'
+    assert headers['Content-Type'] == 'application/javascript'
+    assert headers['Vary'] == 'Accept-Encoding'
+
+    status, headers, body = site('/app.js', {'Accept-Encoding': 'gzip'})
+    assert body == b'plain()' and 'Content-Encoding' not in headers
+    # Разные представления - разные ETag
+    assert site('/app.js', {'Accept-Encoding': 'br'})[1]['ETag'] != headers['ETag']
+
+    # Прямой запрос .br: тип по имени без расширения
+    _, headers, _ = site('/app.js.br')
+    assert headers['Content-Encoding'] == 'br'
+    assert headers['Content-Type'] == 'application/javascript'
+
+
+def test_hashed_names_are_immutable(site):
+    _, headers, _ = site('/Build.0123456789abcdef0123.wasm')
+    assert headers['Cache-Control'] == IMMUTABLE_CACHE
+    assert headers['Content-Type'] == 'application/wasm'
+
+
+def test_paths_outside_root_and_spa_fallback(site):
+    assert site('/../secret.txt')[0] == 404
+    assert site('/%2e%2e/secret.txt')[0] == 404
+    assert site('/missing.js')[0] == 404
+    status, _, body = site('/profile/settings')
+    assert status == 200 and body == b'<html>index</html>'
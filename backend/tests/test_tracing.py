@@ -0,0 +1,136 @@
+"""
+Трассировка и очередь журнала: интервалы, медленные трассы, отбрасывание, перезапуск после fork
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import pytest
+
+from tracing import JsonFormatter, NonBlockingQueueHandler, Tracer, current_trace_id, span
+
+
+class ListHandler(logging.Handler):
+    """Собирает отформатированные записи; может задержать вывод до gate"""
+
+    def __init__(self, gate: threading.Event = None):
+        super().__init__()
+        self.setFormatter(JsonFormatter())
+        self.lines = []
+        self.gate = gate
+
+    def emit(self, record):
+        if self.gate:
+            self.gate.wait(5)
+        self.lines.append(json.loads(self.format(record)))
+
+
+def make_logger(handler: logging.Handler, name: str) -> logging.Logger:
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.handlers = [handler]
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def test_records_carry_trace_id_and_fields():
+    output = ListHandler()
+    handler = NonBlockingQueueHandler([output])
+    logger = make_logger(handler, 'test.fields')
+    tracer = Tracer(slow_ms=10000)
+
+    trace = tracer.start('GET /api/user/profile', 'req-1')
+    logger.info("Профиль", extra={'user_id': 7})
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        logger.exception("Ошибка")
+    tracer.finish(trace)
+    assert current_trace_id() is None
+    logger.info("Вне запроса")
+    handler.close()
+
+    first, error, outside = output.lines
+    assert (first['msg'], first['trace_id'], first['user_id'], first['pid']) == ('Профиль', 'req-1', 7, os.getpid())
+    assert 'ValueError: boom' in error['exc']
+    assert 'trace_id' not in outside
+
+
+def test_full_queue_drops_instead_of_blocking():
+    gate = threading.Event()
+    output = ListHandler(gate)
+    handler = NonBlockingQueueHandler([output], maxsize=2)
+    logger = make_logger(handler, 'test.drop')
+
+    started = time.monotonic()
+    for i in range(20):
+        logger.info("запись %s", i)
+    assert time.monotonic() - started < 1
+    assert handler.dropped >= 17
+
+    gate.set()
+    handler.close()
+    assert 1 <= len(output.lines) <= 3
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='fork только на POSIX')
+def test_forked_worker_starts_its_own_listener(tmp_path):
+    path = tmp_path / 'log.jsonl'
+    output = logging.FileHandler(path)
+    output.setFormatter(JsonFormatter())
+    handler = NonBlockingQueueHandler([output])
+    logger = make_logger(handler, 'test.fork')
+    logger.info("до fork")
+    parent_queue = handler.queue
+
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            # Поток слушателя родителя в воркер не перешел: запись обязана дойти через новый
+            logger.info("из воркера")
+            code = 0 if handler.queue is not parent_queue else 2
+            handler.close()
+        finally:
+            os._exit(code)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    # Слушатель родителя продолжает работать
+    logger.info("после fork")
+    handler.close()
+
+    lines = [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+    assert [(line['msg'], line['pid']) for line in lines] == [
+        ('до fork', os.getpid()), ('из воркера', pid), ('после fork', os.getpid())]
+
+
+def test_slow_traces_are_buffered_with_spans():
+    tracer = Tracer(slow_ms=20, buffer=2)
+    for name in ('fast', 'slow-1', 'slow-2', 'slow-3'):
+        trace = tracer.start(name)
+        with span('db', detail="SELECT   *\n FROM users"):
+            if name != 'fast':
+                time.sleep(0.03)
+        tracer.finish(trace, status=200)
+
+    assert [trace['name'] for trace in tracer.recent()] == ['slow-3', 'slow-2']
+    latest = tracer.recent(1)[0]
+    assert latest['status'] == 200 and latest['duration_ms'] >= 20
+    assert latest['spans'][0]['name'] == 'db'
+    assert latest['spans'][0]['detail'] == 'SELECT * FROM users'
+    stats = tracer.stats()
+    assert (stats['finished'], stats['slow'], stats['buffered']) == (4, 3, 2)
+
+
+def test_invalid_request_id_is_replaced():
+    tracer = Tracer()
+    assert tracer.start('a', 'client-id.1').trace_id == 'client-id.1'
+    generated = tracer.start('b', 'bad id\n').trace_id
+    assert generated != 'bad id\n' and len(generated) == 16
+    # Без трассы span ничего не делает
+    with span('idle'):
+        pass
@@ -0,0 +1,151 @@
+"""
+Запись трафика и его проигрывание: обезличивание, ротация, порядок и подстановка пользователей
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import replay
+from traffic import REDACTED, TrafficRecorder
+
+
+def recorder(tmp_path, **kwargs) -> TrafficRecorder:
+    return TrafficRecorder(tmp_path / 'traffic', b'salt', **kwargs)
+
+
+def read_lines(path):
+    return [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+
+
+def test_record_is_pseudonymized_and_redacted(tmp_path):
+    traffic = recorder(tmp_path)
+    traffic.record('POST', '/api/auth/telegram', {'user_id': ['42'], 'tag': ['a', 'b']}, {
+        'user_id': 42,
+        'username': 'alice',
+        'init_data': 'query_id=...&hash=abc',
+        'referrals': [{'referred_id': 7, 'first_name': 'Bob'}],
+        'amount': 5,
+    }, 42, 1000.5, 0.0125, 200)
+    traffic.record('GET', '/api/shop/items', {}, None, None, 1000.0, 0.001, 200)
+    traffic.close()
+
+    (path,) = (tmp_path / 'traffic').glob('traffic-*.jsonl')
+    first, second = read_lines(path)
+    alias = traffic.pseudonym(42)
+    assert alias.startswith('u:') and alias == TrafficRecorder(tmp_path, b'salt').pseudonym(42)
+    assert alias != TrafficRecorder(tmp_path, b'other').pseudonym(42)
+
+    assert first['user'] == alias and first['ms'] == 12.5 and first['status'] == 200
+    assert first['query'] == {'user_id': alias, 'tag': ['a', 'b']}
+    assert first['body'] == {
+        'user_id': alias,
+        'username': REDACTED,
+        'init_data': REDACTED,
+        'referrals': [{'referred_id': traffic.pseudonym(7), 'first_name': REDACTED}],
+        'amount': 5,
+    }
+    assert 'alice' not in path.read_text(encoding='utf-8')
+    assert second['user'] is None and 'body' not in second
+
+
+def test_record_rotates_and_samples(tmp_path):
+    traffic = recorder(tmp_path, max_bytes=400, backups=2)
+    for i in range(20):
+        traffic.record('GET', '/api/user/profile', {'user_id': [str(i)]}, None, i, 1000.0 + i, 0.001, 200)
+    traffic.close()
+    files = sorted(path.name for path in (tmp_path / 'traffic').iterdir())
+    assert len(files) == 3 and files[0].endswith('.jsonl') and files[1].endswith('.jsonl.1')
+
+    muted = TrafficRecorder(tmp_path / 'muted', b'salt', sample=0.0)
+    muted.record('GET', '/api/user/profile', {}, None, 1, 1000.0, 0.001, 200)
+    assert not list((tmp_path / 'muted').iterdir())
+
+
+def test_load_records_sorts_files_and_skips_torn_lines(tmp_path):
+    (tmp_path / 'traffic-1.jsonl.1').write_text('{"t": 3, "route": "/c"}\n')
+    (tmp_path / 'traffic-1.jsonl').write_text('{"t": 1, "route": "/a"}\n{"t": 4, "rou')
+    (tmp_path / 'traffic-2.jsonl').write_text('{"t": 2, "route": "/b"}\n')
+    assert [record['route'] for record in replay.load_records([tmp_path])] == ['/a', '/b', '/c']
+
+
+def test_peak_concurrency_and_percentile():
+    records = [{'t': 0.0, 'ms': 1000}, {'t': 0.5, 'ms': 1000}, {'t': 0.9, 'ms': 50}, {'t': 2.0, 'ms': 10}]
+    assert replay.peak_concurrency(records) == 3
+    assert replay.peak_concurrency([]) == 1
+    values = list(range(1, 101))
+    assert (replay.percentile(values, 50), replay.percentile(values, 95), replay.percentile([], 99)) == (50, 95, 0.0)
+
+
+def test_user_map_is_stable():
+    users = replay.UserMap(base=100)
+    resolved = users.resolve({'user_id': 'u:aa', 'list': ['u:bb', 'u:aa'], 'note': 'plain'})
+    assert resolved == {'user_id': 101, 'list': [102, 101], 'note': 'plain'}
+
+
+@pytest.fixture
+def target():
+    """Стенд, который запоминает запросы и отвечает 200 (или 404 на /missing)"""
+    seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def handle_request(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length)) if length else None
+            seen.append((self.command, self.path, body, self.headers.get('Authorization')))
+            status = 404 if self.path.startswith('/missing') else 200
+            payload = {'token': f"t{body['user_id']}"} if self.path == '/api/auth/login' else {}
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = handle_request
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}', seen
+    server.shutdown()
+    server.server_close()
+
+
+def test_replay_substitutes_users_and_reports_statuses(target):
+    url, seen = target
+    records = [
+        {'t': 1.0, 'ms': 2, 'method': 'POST', 'route': '/api/user/click', 'status': 200,
+         'user': 'u:aa', 'query': {}, 'body': {'user_id': 'u:aa', 'clicks': 3}},
+        {'t': 1.1, 'ms': 1, 'method': 'GET', 'route': '/api/user/profile', 'status': 200,
+         'user': 'u:bb', 'query': {'user_id': 'u:bb'}},
+        {'t': 1.2, 'ms': 1, 'method': 'GET', 'route': '/missing', 'status': 200, 'query': {}},
+    ]
+    users = replay.UserMap(base=100)
+    replayer = replay.Replayer(url, users)
+    users.user_id('u:aa')
+    replayer.login([101])
+    seen.clear()
+
+    results = replay.run(records, replayer, None, 2)
+    assert [result['i'] for result in results] == [0, 1, 2]
+    by_path = {path: (body, auth) for _, path, body, auth in seen}
+    assert by_path['/api/user/click'] == ({'user_id': 101, 'clicks': 3}, 'Bearer t101')
+    assert '/api/user/profile?user_id=102' in by_path
+    assert replay.status_mismatches(results) == {'GET /missing': 1}
+
+
+def test_compare_reports_routes(tmp_path, capsys):
+    base, current = tmp_path / 'base.jsonl', tmp_path / 'current.jsonl'
+    base.write_text('\n'.join(json.dumps(
+        {'i': i, 'method': 'GET', 'route': '/api/a', 'status': 200, 'ms': 10}) for i in range(3)) + '\n')
+    current.write_text('\n'.join(json.dumps(
+        {'i': i, 'method': 'GET', 'route': '/api/a', 'status': 500 if i else 200, 'ms': 20})
+        for i in range(3)) + '\n')
+    assert replay.main(['compare', str(base), str(current)]) == 0
+    output = capsys.readouterr().out
+    assert 'GET /api/a' in output and '+100%' in output
+    assert 'другой статус у 2 запросов' in output
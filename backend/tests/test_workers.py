@@ -0,0 +1,102 @@
+"""
+Pre-fork режим: запуск воркеров на общем сокете, перезапуск упавших, остановка по SIGTERM
+"""
+
+import os
+import signal
+import sys
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+import workers
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason='pre-fork режим только на POSIX')
+
+
+class PidHandler(BaseHTTPRequestHandler):
+    """Отвечает PID воркера, обработавшего запрос"""
+
+    def do_GET(self):
+        body = str(os.getpid()).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def read_events(path):
+    return path.read_text().split('\n')[:-1] if path.exists() else []
+
+
+def wait_for(predicate, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(0.05)
+    raise AssertionError('не дождались')
+
+
+@pytest.fixture
+def supervisor(tmp_path, monkeypatch):
+    """Супервизор с двумя воркерами в отдельном процессе: (PID, адрес, журнал событий)"""
+    monkeypatch.setattr(workers, 'RESTART_BACKOFF', 0.1)
+    events = tmp_path / 'events'
+    httpd = HTTPServer(('127.0.0.1', 0), PidHandler)
+
+    def log(line):
+        with open(events, 'a') as f:
+            f.write(line + '\n')
+
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            sys.stdout = open(os.devnull, 'w')
+            workers.run_prefork(httpd, 2, lambda timeout: log(f'drain {os.getpid()}'),
+                                on_worker_start=lambda slot: log(f'start {slot} {os.getpid()}'))
+        except BaseException:
+            code = 1
+        finally:
+            os._exit(code)
+
+    httpd.server_close()
+    yield pid, f'http://127.0.0.1:{httpd.server_address[1]}', events
+    try:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    except (ProcessLookupError, ChildProcessError):
+        pass
+
+
+def started(events):
+    return {int(slot): int(pid) for _, slot, pid in
+            (line.split() for line in read_events(events) if line.startswith('start'))}
+
+
+def test_workers_serve_restart_and_drain(supervisor):
+    pid, url, events = supervisor
+    workers_by_slot = wait_for(lambda: len(started(events)) == 2 and started(events))
+    with urllib.request.urlopen(url, timeout=5) as response:
+        assert int(response.read()) in workers_by_slot.values()
+
+    # Упавший воркер перезапускается в том же слоте
+    os.kill(workers_by_slot[0], signal.SIGKILL)
+    restarted = wait_for(lambda: started(events).get(0) != workers_by_slot[0] and started(events))
+    assert restarted[1] == workers_by_slot[1]
+    with urllib.request.urlopen(url, timeout=5) as response:
+        assert int(response.read()) in restarted.values()
+
+    # SIGTERM супервизору: каждый живой воркер дожидается своих запросов и выходит
+    os.kill(pid, signal.SIGTERM)
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    drained = {int(line.split()[1]) for line in read_events(events) if line.startswith('drain')}
+    assert drained == set(restarted.values())
@@ -0,0 +1,328 @@
+"""
+Структурированные журналы и трассировка запросов
+Записи журнала кладутся в ограниченную очередь, а форматирует и пишет их отдельный
+поток, поэтому обработчики запросов не ждут вывода; при переполнении очереди записи
+отбрасываются и считаются. У каждого запроса API и сообщения бота есть трасса:
+идентификатор (X-Request-ID) попадает во все записи журнала этого запроса, а интервалы
+(контроль допуска, SQL, ответ) собираются с таймингами. Медленные трассы пишутся в журнал
+и хранятся в кольцевом буфере (/api/system/traces), остальные - по доле выборки.
+
+Настройки: LOG_LEVEL, LOG_FORMAT (text или json), LOG_QUEUE_SIZE,
+TRACE_SLOW_MS, TRACE_SAMPLE, TRACE_BUFFER.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Optional
+
+# Трасса дольше этого порога (мс) считается медленной
+TRACE_SLOW_MS = 250.0
+
+# Сколько медленных трасс хранить в памяти
+TRACE_BUFFER = 100
+
+# Сколько интервалов хранить в одной трассе (остальные только считаются)
+TRACE_MAX_SPANS = 200
+
+# Сколько записей журнала может ждать вывода
+LOG_QUEUE_SIZE = 10000
+
+# Допустимый X-Request-ID от клиента; иначе генерируем свой
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+
+# Стандартные атрибуты LogRecord: все прочие - структурированные поля записи
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'trace_id'}
+
+_current_trace: ContextVar[Optional['Trace']] = ContextVar('trace', default=None)
+
+
+class Trace:
+    """Трасса одного запроса: интервалы с временем начала и длительностью"""
+
+    __slots__ = ('trace_id', 'name', 'started', 'clock', 'spans', 'dropped', 'attrs', 'sampled', '_token')
+
+    def __init__(self, name: str, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.name = name
+        self.started = time.time()
+        self.clock = time.perf_counter()
+        self.spans = []  # (имя, начало, конец, подробности)
+        self.dropped = 0
+        self.attrs = {}
+        self.sampled = sampled
+        self._token = None
+
+    def add_span(self, name: str, start: float, end: float, detail=None):
+        """Добавить интервал (start и end - значения time.perf_counter())"""
+        if len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append((name, start, end, detail))
+        else:
+            self.dropped += 1
+
+    def as_dict(self, duration: float) -> Dict:
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'started_at': self.started,
+            'duration_ms': round(duration * 1000, 3),
+            **self.attrs,
+            'spans': [
+                {
+                    'name': name,
+                    'start_ms': round((start - self.clock) * 1000, 3),
+                    'duration_ms': round((end - start) * 1000, 3),
+                    **({'detail': ' '.join(str(detail).split())[:200]} if detail is not None else {}),
+                }
+                for name, start, end, detail in self.spans
+            ],
+            'spans_dropped': self.dropped,
+        }
+
+
+class Tracer:
+    """Начало и завершение трасс, выборка и буфер медленных трасс"""
+
+    def __init__(self, slow_ms: float = TRACE_SLOW_MS, sample: float = 0.0, buffer: int = TRACE_BUFFER):
+        self._lock = threading.Lock()
+        self.finished = 0
+        self.slow_count = 0
+        self.log = logging.getLogger('trace')
+        self.configure(slow_ms, sample, buffer)
+
+    def configure(self, slow_ms: float, sample: float, buffer: int):
+        """Порог медленной трассы (мс), доля выборки и размер буфера"""
+        self.slow = slow_ms / 1000
+        self.sample = sample
+        self._slow_traces = deque(maxlen=buffer)
+
+    def start(self, name: str, trace_id: str = None) -> Trace:
+        """Начать трассу и сделать ее текущей в этом контексте"""
+        if not trace_id or not REQUEST_ID_PATTERN.match(trace_id):
+            trace_id = secrets.token_hex(8)
+        trace = Trace(name, trace_id, self.sample > 0 and random.random() < self.sample)
+        trace._token = _current_trace.set(trace)
+        return trace
+
+    def finish(self, trace: Trace, **attrs) -> float:
+        """Завершить трассу; медленную - сохранить и записать в журнал. Возвращает длительность (сек)"""
+        duration = time.perf_counter() - trace.clock
+        if trace._token is not None:
+            _current_trace.reset(trace._token)
+            trace._token = None
+        trace.attrs.update(attrs)
+
+        slow = duration >= self.slow
+        with self._lock:
+            self.finished += 1
+            if slow:
+                self.slow_count += 1
+        if slow or trace.sampled:
+            data = trace.as_dict(duration)
+            if slow:
+                with self._lock:
+                    self._slow_traces.append(data)
+            self.log.log(logging.WARNING if slow else logging.INFO,
+                         "Медленный запрос" if slow else "Трасса запроса",
+                         extra={'trace_id': trace.trace_id, 'trace': data})
+        return duration
+
+    def recent(self, limit: int = None) -> List[Dict]:
+        """Последние медленные трассы, новые первыми"""
+        with self._lock:
+            traces = list(self._slow_traces)
+        traces.reverse()
+        return traces[:limit] if limit else traces
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'finished': self.finished,
+                'slow': self.slow_count,
+                'slow_ms': self.slow * 1000,
+                'sample': self.sample,
+                'buffered': len(self._slow_traces),
+                'buffer_size': self._slow_traces.maxlen,
+                'log_dropped': _queue_handler.dropped if _queue_handler else 0,
+            }
+
+
+tracer = Tracer()
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _current_trace.get()
+    return trace.trace_id if trace else None
+
+
+@contextmanager
+def span(name: str, detail=None):
+    """Интервал внутри текущей трассы (без трассы ничего не записывает)"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, start, time.perf_counter(), detail)
+
+
+@contextmanager
+def traced(name: str, trace_id: str = None, **attrs):
+    """Трасса вокруг блока кода (сообщения бота, фоновые задачи)"""
+    trace = tracer.start(name, trace_id)
+    status = 'ok'
+    try:
+        yield trace
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        tracer.finish(trace, status=status, **attrs)
+
+
+# === КОНВЕЙЕР ЖУРНАЛА ===
+
+class TextFormatter(logging.Formatter):
+    """Строка для чтения глазами: время, уровень, сообщение, trace и поля"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        record.message = record.getMessage()
+        record.asctime = self.formatTime(record)
+        line = self.formatMessage(record)
+        fields = {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS}
+        trace = fields.pop('trace', None)
+        if getattr(record, 'trace_id', None):
+            line += f" trace={record.trace_id}"
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        if trace:
+            line += ' ' + json.dumps(trace, ensure_ascii=False, separators=(',', ':'))
+        if record.exc_text:
+            line += '\n' + record.exc_text
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process,
+        }
+        if getattr(record, 'trace_id', None):
+            entry['trace_id'] = record.trace_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str, separators=(',', ':'))
+
+
+class DrainingQueueListener(QueueListener):
+    """Слушатель, который при остановке дописывает и полную очередь"""
+
+    def enqueue_sentinel(self):
+        # put_nowait в QueueListener падает на полной очереди; поток слушателя ее разгрузит
+        self.queue.put(self._sentinel)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Кладет записи в ограниченную очередь без ожидания; вывод - в потоке слушателя
+
+    После fork у процесса своя очередь и свой слушатель: поток родителя не наследуется.
+    """
+
+    def __init__(self, handlers: List[logging.Handler], maxsize: int = LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(maxsize))
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self.queue = queue.Queue(self.maxsize)
+                self._listener = DrainingQueueListener(self.queue, *self.handlers, respect_handler_level=True)
+                self._listener.start()
+                self._pid = os.getpid()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Сообщение форматирует слушатель; здесь только trace_id и текст исключения"""
+        if not hasattr(record, 'trace_id'):
+            record.trace_id = current_trace_id()
+        if record.exc_info:
+            # Трассировку стека нужно снять сейчас, пока кадры живы
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Дописать очередь (при завершении процесса)"""
+        if self._listener and self._pid == os.getpid():
+            self._listener.stop()
+            self._pid = None
+        super().close()
+
+
+_queue_handler: Optional[NonBlockingQueueHandler] = None
+
+
+def configure_logging() -> NonBlockingQueueHandler:
+    """Настроить корневой журнал и трассировку по переменным окружения (повторно - без изменений)"""
+    global _queue_handler
+    if _queue_handler is not None:
+        return _queue_handler
+
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if os.getenv("LOG_FORMAT", "text") == "json" else TextFormatter())
+    _queue_handler = NonBlockingQueueHandler([output], int(os.getenv("LOG_QUEUE_SIZE", str(LOG_QUEUE_SIZE))))
+
+    root = logging.getLogger()
+    root.addHandler(_queue_handler)
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+    tracer.configure(
+        float(os.getenv("TRACE_SLOW_MS", str(TRACE_SLOW_MS))),
+        float(os.getenv("TRACE_SAMPLE", "0")),
+        int(os.getenv("TRACE_BUFFER", str(TRACE_BUFFER))),
+    )
+    atexit.register(_queue_handler.close)
+    return _queue_handler
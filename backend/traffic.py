@@ -0,0 +1,120 @@
+"""
+Запись реального трафика API для нагрузочных прогонов
+Каждый запрос к /api/ пишется строкой JSONL: маршрут, параметры, тело, статус и время
+ответа. Идентификаторы пользователей заменяются псевдонимами (HMAC с солью), личные
+данные и подписи вырезаются. Файлы ротируются по размеру; проигрывает их replay.py
+
+Включается переменной TRAFFIC_RECORD_DIR. Каждый воркер пишет в свой файл
+traffic-<pid>.jsonl, поэтому соль генерируется до форка и одинакова для всех воркеров.
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import secrets
+import threading
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Dict, Optional
+
+# Ключи с идентификаторами пользователей: заменяются псевдонимом
+USER_KEYS = {'user_id', 'referrer_id', 'referred_id', 'id'}
+
+# Ключи с личными данными и подписями: значение не сохраняется
+REDACTED_KEYS = {'username', 'first_name', 'last_name', 'photo_url', 'phone_number',
+                 'hash', 'signature', 'init_data', 'initData', 'token', 'telegram_payment_id'}
+
+REDACTED = '<redacted>'
+
+
+class TrafficRecorder:
+    """Запись обезличенных запросов в ротируемый JSONL"""
+
+    def __init__(self, directory: Path, salt: bytes, max_bytes: int = 50 * 1024 * 1024,
+                 backups: int = 5, sample: float = 1.0):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.salt = salt
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.sample = sample
+        self._handler = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def pseudonym(self, user_id) -> str:
+        """Стабильный псевдоним пользователя (один и тот же во всех воркерах)"""
+        digest = hmac.new(self.salt, str(user_id).encode('utf-8'), hashlib.sha256).hexdigest()
+        return f"u:{digest[:16]}"
+
+    def sanitize(self, value, key: str = None):
+        """Копия параметров или тела без личных данных"""
+        if isinstance(value, dict):
+            return {k: self.sanitize(v, k) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.sanitize(v, key) for v in value]
+        if key in REDACTED_KEYS:
+            return REDACTED
+        if key in USER_KEYS and value not in (None, '', 0, '0'):
+            return self.pseudonym(value)
+        return value
+
+    def record(self, method: str, path: str, query: Dict, body: Optional[Dict],
+               user_id, started: float, duration: float, status: int):
+        """Записать один запрос (started - time.time() начала, duration - секунды)"""
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return
+
+        entry = {
+            't': round(started, 6),
+            'ms': round(duration * 1000, 3),
+            'method': method,
+            'route': path,
+            'status': status,
+            'user': self.pseudonym(user_id) if user_id else None,
+            # Значения query - списки (parse_qs); одиночные храним скаляром
+            'query': self.sanitize({k: v[0] if len(v) == 1 else v for k, v in query.items()}),
+        }
+        if body is not None:
+            entry['body'] = self.sanitize(body)
+
+        record = logging.makeLogRecord({'msg': json.dumps(entry, ensure_ascii=False, separators=(',', ':'))})
+        self._get_handler().handle(record)
+
+    def close(self):
+        if self._handler:
+            self._handler.close()
+
+    def _get_handler(self) -> RotatingFileHandler:
+        """Файл текущего процесса (после форка у воркера свой)"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                handler = RotatingFileHandler(
+                    self.directory / f"traffic-{self._pid}.jsonl",
+                    maxBytes=self.max_bytes, backupCount=self.backups, encoding='utf-8'
+                )
+                handler.setFormatter(logging.Formatter('%(message)s'))
+                self._handler = handler
+            return self._handler
+
+
+def create_traffic_recorder() -> Optional[TrafficRecorder]:
+    """Создать запись трафика по конфигурации (None, если выключена)"""
+    directory = os.getenv("TRAFFIC_RECORD_DIR")
+    if not directory:
+        return None
+
+    salt = os.getenv("TRAFFIC_RECORD_SALT")
+    recorder = TrafficRecorder(
+        Path(directory),
+        salt.encode('utf-8') if salt else secrets.token_bytes(32),
+        max_bytes=int(float(os.getenv("TRAFFIC_RECORD_MAX_MB", "50")) * 1024 * 1024),
+        backups=int(os.getenv("TRAFFIC_RECORD_BACKUPS", "5")),
+        sample=float(os.getenv("TRAFFIC_RECORD_SAMPLE", "1")),
+    )
+    print(f"[INFO] Запись трафика включена: {recorder.directory}")
+    return recorder
@@ -7,35 +7,171 @@ import json
 import hashlib
 import hmac
 import jwt
+import logging
+import sqlite3
+import sys
 import time
 import urllib.parse
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
-from db.database import DatabaseManager
+from db.catalog import shop_catalog
+from db.database import LEADERBOARD_WINDOWS, normalize_spends
+from db.engine import create_database_manager
+from db.idempotency import IdempotencyStore, IdempotencyConflict, request_fingerprint
+from maintenance import create_maintenance
+from static_files import StaticFiles, STATIC_ROOT
+from traffic import create_traffic_recorder
+from tracing import configure_logging, span, tracer
+from workers import run_prefork
+from admission import (
+    AdmissionController, PRIORITY_CRITICAL, PRIORITY_WRITE, PRIORITY_POLL, OVERLOAD_RETRY_AFTER
+)
 import os
 
 # Секретный ключ бота для проверки подлинности запросов
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 JWT_SECRET = os.getenv("JWT_SECRET", BOT_TOKEN or "default_secret_key_change_in_production")
 PAYMENT_PROVIDER_TOKEN = os.getenv("PAYMENT_PROVIDER_TOKEN", "")  # Токен от платежного провайдера
-# Инициализируем базу данных
-db_manager = DatabaseManager()
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")  # Токен служебных эндпоинтов (заголовок X-Admin-Token)
+
+# Журнал пишется из отдельного потока; трассы запросов - см. tracing.py
+configure_logging()
+log = logging.getLogger('api')
+access_log = logging.getLogger('api.access')
+
+# Инициализируем базу данных (движок выбирается переменной DB_ENGINE)
+db_manager = create_database_manager()
+
+# Контроль допуска: лимит одновременных запросов и частоты записей
+admission_controller = AdmissionController(
+    max_concurrency=int(os.getenv("API_MAX_CONCURRENCY", "32")),
+    rate=float(os.getenv("API_RATE_LIMIT_RPS", "10")),
+    burst=float(os.getenv("API_RATE_LIMIT_BURST", "20")),
+)
+
+# Ключи идемпотентности для повторяемых запросов записи
+idempotency_store = IdempotencyStore(db_manager)
+
+# Эндпоинты с повышенным приоритетом (авторизация и покупки)
+CRITICAL_ROUTES = {'/api/auth/login', '/api/shop/buy'}
+
+# Эндпоинты записи, ограниченные корзиной токенов на пользователя
+RATE_LIMITED_ROUTES = {'/api/shop/buy', '/api/user/spend'}
+
+# Адреса локального прокси (server.js): за ним адрес клиента берется из X-Forwarded-For
+LOCAL_PEERS = ('127.0.0.1', '::1')
+
+# Служебные эндпоинты: только с ADMIN_TOKEN или напрямую с localhost
+ADMIN_ROUTES = {'/api/system/admission', '/api/system/maintenance', '/api/system/traces'}
+
+# Эндпоинты бота (заголовок X-Bot-Token = BOT_TOKEN): с движком в памяти бот пишет только через API
+BOT_ROUTES = {'/api/bot/user', '/api/bot/referral', '/api/bot/profile'}
+
+# Эндпоинты записи, поддерживающие заголовок Idempotency-Key
+IDEMPOTENT_ROUTES = {'/api/shop/buy', '/api/user/spend'}
+
+# Фоновое обслуживание БД: ANALYZE, WAL, vacuum, очистка (MAINTENANCE_ENABLED=0 - выключить)
+maintenance_scheduler, db_maintenance = create_maintenance(
+    db_manager, idempotency_store, admission_controller.utilization
+)
+
+# Раздача фронтенда из этого же процесса (SERVE_STATIC=1, корень - STATIC_ROOT)
+static_files = StaticFiles(os.getenv("STATIC_ROOT", STATIC_ROOT)) if os.getenv("SERVE_STATIC") == "1" else None
+
+# Запись обезличенного трафика для нагрузочных прогонов (TRAFFIC_RECORD_DIR)
+traffic_recorder = create_traffic_recorder()
 
 class GameAPIHandler(BaseHTTPRequestHandler):
+    # Зарезервированный ключ идемпотентности текущего запроса
+    _idempotency = None
+    
+    # Запрос для записи трафика: (метод, путь, query, тело) и статус ответа
+    _traffic = None
+    _status = None
+    
+    # Трасса текущего запроса (начинается после разбора строки запроса)
+    _trace = None
+    
+    def handle_one_request(self):
+        """Обработать запрос: трасса, журнал доступа и, если включено, запись трафика"""
+        self._traffic = self._status = self._trace = None
+        try:
+            super().handle_one_request()
+        finally:
+            trace, self._trace = self._trace, None
+            if trace:
+                duration = tracer.finish(trace, status=self._status)
+                access_log.info("запрос", extra={
+                    'method': self.command, 'path': urlparse(self.path).path,
+                    'status': self._status, 'ms': round(duration * 1000, 3),
+                })
+                if traffic_recorder and self._traffic:
+                    method, path, query_params, request_data = self._traffic
+                    user_id = (query_params.get('user_id', [None])[0] if request_data is None
+                               else self._get_user_from_auth(request_data))
+                    traffic_recorder.record(method, path, query_params, request_data, user_id,
+                                            trace.started, duration, self._status)
+    
+    def parse_request(self):
+        """Разобрать запрос и начать трассу (X-Request-ID клиента сохраняется)"""
+        if not super().parse_request():
+            return False
+        self._trace = tracer.start(f"{self.command} {urlparse(self.path).path}", self.headers.get('X-Request-ID'))
+        return True
+    
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+    
+    def end_headers(self):
+        if self._trace:
+            self.send_header('X-Request-ID', self._trace.trace_id)
+        super().end_headers()
+    
+    def log_request(self, code='-', size='-'):
+        """Журнал доступа пишет handle_one_request (со временем ответа и trace)"""
+    
+    def log_message(self, format, *args):
+        access_log.info(format, *args, extra={'client': self.client_address[0]})
+    
     def do_GET(self):
         """Обработка GET запросов"""
         parsed_url = urlparse(self.path)
         path = parsed_url.path
         query_params = parse_qs(parsed_url.query)
         
-        # Добавляем CORS заголовки
-        self._add_cors_headers()
+        # Статика не трогает БД и не учитывается контролем допуска
+        if not path.startswith('/api/'):
+            self._serve_static(path)
+            return
+        
+        self._traffic = ('GET', path, query_params, None)
         
-        # Маршрутизация GET запросов
-        if path == '/api/user/profile':
+        # Проверяем лимиты до любой работы с БД
+        if not self._admit(path, PRIORITY_POLL):
+            return
+        
+        try:
+            self._route_get(path, query_params)
+        finally:
+            admission_controller.release()
+    
+    def _route_get(self, path, query_params):
+        """Маршрутизация GET запросов"""
+        if path in ADMIN_ROUTES and not self._is_admin_request():
+            self._send_json_response({"success": False, "message": "Forbidden"}, 403)
+        elif path in BOT_ROUTES and not self._is_bot_request():
+            self._send_json_response({"success": False, "message": "Forbidden"}, 403)
+        elif path == '/api/user/profile':
             self.handle_get_profile(query_params)
         elif path == '/api/user/stats':
             self.handle_get_stats(query_params)
+        elif path == '/api/user/balance':
+            self.handle_get_balance(query_params)
+        elif path == '/api/user/transactions':
+            self.handle_get_transactions(query_params)
+        elif path == '/api/user/sync':
+            self.handle_sync_state(query_params)
         elif path == '/api/shop/items':
             self.handle_get_shop_items(query_params)
         elif path == '/api/upgrades/list':
@@ -44,6 +180,20 @@ class GameAPIHandler(BaseHTTPRequestHandler):
             self.handle_get_referral_link(query_params)
         elif path == '/api/referral/stats':
             self.handle_get_referral_stats(query_params)
+        elif path == '/api/achievements/list':
+            self.handle_get_achievements(query_params)
+        elif path == '/api/leaderboard':
+            self.handle_get_leaderboard(query_params)
+        elif path == '/api/system/admission':
+            self.handle_get_admission_stats(query_params)
+        elif path == '/api/system/stats':
+            self.handle_get_global_stats(query_params)
+        elif path == '/api/system/maintenance':
+            self.handle_get_maintenance_status(query_params)
+        elif path == '/api/system/traces':
+            self.handle_get_traces(query_params)
+        elif path == '/api/bot/profile':
+            self.handle_bot_profile(query_params)
         else:
             self.send_error(404, "Endpoint not found")
     
@@ -52,9 +202,6 @@ class GameAPIHandler(BaseHTTPRequestHandler):
         parsed_url = urlparse(self.path)
         path = parsed_url.path
         
-        # Добавляем CORS заголовки
-        self._add_cors_headers()
-        
         # Читаем тело запроса
         content_length = int(self.headers.get('Content-Length', 0))
         post_data = self.rfile.read(content_length).decode('utf-8') if content_length > 0 else '{}'
@@ -64,42 +211,163 @@ class GameAPIHandler(BaseHTTPRequestHandler):
         except json.JSONDecodeError:
             self.send_error(400, "Invalid JSON")
             return
+        if not isinstance(request_data, dict):
+            self.send_error(400, "Invalid JSON")
+            return
+        self._traffic = ('POST', path, parse_qs(parsed_url.query), request_data)
         
-        # Маршрутизация POST запросов
-        if path == '/api/auth/login':
+        priority = PRIORITY_CRITICAL if path in CRITICAL_ROUTES else PRIORITY_WRITE
+        if not self._admit(path, priority):
+            return
+        
+        try:
+            if path in IDEMPOTENT_ROUTES and not self._begin_idempotent(path, request_data):
+                return
+            self._route_post(path, request_data)
+        finally:
+            self._abandon_idempotent()
+            admission_controller.release()
+    
+    def _route_post(self, path, request_data):
+        """Маршрутизация POST запросов"""
+        if path in BOT_ROUTES and not self._is_bot_request():
+            self._send_json_response({"success": False, "message": "Forbidden"}, 403)
+        elif path == '/api/auth/login':
             self.handle_login(request_data)
+        elif path == '/api/user/spend':
+            self.handle_spend(request_data)
         elif path == '/api/shop/buy':
             self.handle_buy_upgrade(request_data)
         elif path == '/api/upgrades/apply':
             self.handle_apply_upgrade(request_data)
         elif path == '/api/referral/claim':
             self.handle_claim_referral(request_data)
+        elif path == '/api/achievements/claim':
+            self.handle_claim_achievements(request_data)
+        elif path == '/api/bot/user':
+            self.handle_bot_user(request_data)
+        elif path == '/api/bot/referral':
+            self.handle_bot_referral(request_data)
         else:
             self.send_error(404, "Endpoint not found")
     
+    def _admit(self, path, priority) -> bool:
+        """Контроль допуска: при превышении лимитов сразу отвечает 429/503"""
+        with span('admission'):
+            return self._check_admission(path, priority)
+    
+    def _check_admission(self, path, priority) -> bool:
+        if path in RATE_LIMITED_ROUTES:
+            # Ключ лимита - подписанный JWT или IP: user_id из тела клиент выбирает сам
+            rate_key = self._get_jwt_user() or self._client_ip()
+            wait = admission_controller.check_rate(rate_key)
+            if wait > 0:
+                self._send_json_response(
+                    {"success": False, "message": "Too many requests"}, 429,
+                    {"Retry-After": str(AdmissionController.retry_after_seconds(wait))}
+                )
+                return False
+        
+        if not admission_controller.acquire(priority):
+            self._send_json_response(
+                {"success": False, "message": "Server is busy, try again later"}, 503,
+                {"Retry-After": str(OVERLOAD_RETRY_AFTER)}
+            )
+            return False
+        
+        return True
+    
+    def do_HEAD(self):
+        """Обработка HEAD запросов (только статика)"""
+        path = urlparse(self.path).path
+        if path.startswith('/api/'):
+            self.send_error(405, "Method not allowed")
+            return
+        self._serve_static(path, head_only=True)
+    
+    def _serve_static(self, path, head_only=False):
+        """Отдать файл фронтенда или 404"""
+        if static_files is None or not static_files.serve(self, path, head_only):
+            self.send_error(404, "Endpoint not found")
+    
     def do_OPTIONS(self):
         """Обработка OPTIONS запросов для CORS"""
         self.send_response(200)
         self._add_cors_headers()
         self.end_headers()
     
+    def _begin_idempotent(self, path, request_data) -> bool:
+        """Проверить Idempotency-Key: повтор получает сохраненный ответ без выполнения"""
+        key = self.headers.get('Idempotency-Key') or request_data.get('idempotency_key')
+        user_id = self._get_user_from_auth(request_data)
+        if not key or not user_id:
+            return True
+        
+        key = str(key)[:128]
+        payload = {k: v for k, v in request_data.items() if k != 'idempotency_key'}
+        fingerprint = request_fingerprint(path, payload)
+        try:
+            stored = idempotency_store.begin(user_id, key, path, fingerprint)
+        except IdempotencyConflict as e:
+            self._send_json_response({"success": False, "message": str(e)}, 409)
+            return False
+        except sqlite3.OperationalError as e:
+            # База занята (database is locked): ключ не зарезервирован, клиент повторит
+            self._send_json_response({"success": False, "message": f"Storage is busy: {str(e)}"}, 503,
+                                     {"Retry-After": str(OVERLOAD_RETRY_AFTER)})
+            return False
+        except Exception as e:
+            self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
+            return False
+        
+        if stored:
+            status_code, response = stored
+            self._send_json_response(response, status_code, {"Idempotent-Replayed": "true"})
+            return False
+        
+        self._idempotency = (user_id, key, path, fingerprint)
+        return True
+    
+    def _abandon_idempotent(self):
+        """Снять резерв ключа, если обработчик так и не отправил ответ"""
+        if self._idempotency:
+            user_id, key, _, _ = self._idempotency
+            self._idempotency = None
+            idempotency_store.abandon(user_id, key)
+    
     def _add_cors_headers(self):
         """Добавить CORS заголовки"""
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization, Idempotency-Key, X-Request-ID, X-Admin-Token, X-Bot-Token')
+        self.send_header('Access-Control-Expose-Headers', 'X-Catalog-Version, X-Request-ID')
     
-    def _send_json_response(self, data: dict, status_code: int = 200):
+    def _send_json_response(self, data: dict, status_code: int = 200, headers: dict = None):
         """Отправить JSON ответ"""
-        self.send_response(status_code)
-        self.send_header('Content-type', 'application/json')
-        self._add_cors_headers()
-        self.end_headers()
-        self.wfile.write(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        if self._idempotency:
+            # Сохраняем итог для повторов; ошибки сервера клиент может повторить заново
+            user_id, key, endpoint, fingerprint = self._idempotency
+            self._idempotency = None
+            if status_code < 500:
+                idempotency_store.complete(user_id, key, endpoint, fingerprint, status_code, data)
+            else:
+                idempotency_store.abandon(user_id, key)
+        
+        if status_code >= 500:
+            # Вызывается из except обработчика: трассировка стека попадает в журнал
+            log.error("Ошибка обработки запроса: %s", data.get("message"), exc_info=sys.exc_info()[0] is not None)
+        
+        with span('respond'):
+            self.send_response(status_code)
+            self.send_header('Content-type', 'application/json')
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self._add_cors_headers()
+            self.end_headers()
+            self.wfile.write(json.dumps(data, ensure_ascii=False).encode('utf-8'))
     
-    def _get_user_from_auth(self, request_data: dict) -> int:
-        """Получить user_id из данных авторизации"""
-        # Проверяем JWT токен
+    def _get_jwt_user(self) -> int:
+        """Получить user_id из JWT токена в заголовке Authorization (None без валидного токена)"""
         auth_header = self.headers.get('Authorization')
         if auth_header and auth_header.startswith('Bearer '):
             token = auth_header[7:]
@@ -108,6 +376,35 @@ class GameAPIHandler(BaseHTTPRequestHandler):
                 return payload.get('user_id')
             except jwt.InvalidTokenError:
                 pass
+        return None
+    
+    def _is_admin_request(self) -> bool:
+        """Доступ к служебным эндпоинтам: X-Admin-Token или прямой запрос с localhost"""
+        token = self.headers.get('X-Admin-Token')
+        if ADMIN_TOKEN and token and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return True
+        # Запрос через прокси (X-Forwarded-For) пришел снаружи, хоть и с localhost
+        return self.client_address[0] in LOCAL_PEERS and not self.headers.get('X-Forwarded-For')
+    
+    def _is_bot_request(self) -> bool:
+        """Запрос бота: X-Bot-Token совпадает с BOT_TOKEN"""
+        token = self.headers.get('X-Bot-Token')
+        return bool(BOT_TOKEN and token and hmac.compare_digest(token.encode(), BOT_TOKEN.encode()))
+    
+    def _client_ip(self) -> str:
+        """IP клиента: за локальным прокси - первый адрес X-Forwarded-For"""
+        peer = self.client_address[0]
+        forwarded = self.headers.get('X-Forwarded-For') if peer in LOCAL_PEERS else None
+        if forwarded:
+            return forwarded.split(',')[0].strip() or peer
+        return peer
+    
+    def _get_user_from_auth(self, request_data: dict) -> int:
+        """Получить user_id из данных авторизации"""
+        # Проверяем JWT токен
+        user_id = self._get_jwt_user()
+        if user_id:
+            return user_id
         
         # Fallback на старый метод через Telegram WebApp данные
         if 'user_id' in request_data:
@@ -203,6 +500,117 @@ class GameAPIHandler(BaseHTTPRequestHandler):
         except Exception as e:
             self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
 
+    
+    def handle_get_balance(self, query_params):
+        """Получить баланс с учетом накопленного пассивного дохода"""
+        try:
+            if not self.verify_telegram_data(query_params):
+                self._send_json_response({"success": False, "message": "Unauthorized"}, 401)
+                return
+            
+            user_id = int(query_params.get('user_id', [0])[0])
+            if user_id == 0:
+                self._send_json_response({"success": False, "message": "Invalid user_id"}, 400)
+                return
+            
+            self._send_json_response({"success": True, "data": db_manager.get_balance(user_id)})
+            
+        except ValueError as e:
+            self._send_json_response({"success": False, "message": str(e)}, 400)
+        except Exception as e:
+            self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
+    
+    def handle_spend(self, request_data):
+        """Потратить монеты: пачка {"session", "spends": [{"seq", "amount"}]} или одна {"amount"}"""
+        try:
+            user_id = self._get_user_from_auth(request_data)
+            if not user_id:
+                self._send_json_response({"success": False, "message": "Unauthorized"}, 401)
+                return
+            
+            if 'spends' in request_data:
+                session = request_data.get('session')
+                if not isinstance(session, str) or not 0 < len(session) <= 64:
+                    self._send_json_response({"success": False, "message": "Invalid session"}, 400)
+                    return
+                spends = normalize_spends(request_data['spends'])
+            else:
+                # Одиночная трата без журнала клиента
+                session = None
+                spends = normalize_spends([{'seq': 1, 'amount': request_data.get('amount')}])
+            
+            result = db_manager.spend_coins(user_id, spends, session)
+            if "data" not in result:
+                status_code = 500  # ошибка БД: повтор с тем же ключом выполнится заново
+            else:
+                # В пачке отказы по части трат - обычный ответ, клиент сверяется по диапазонам
+                status_code = 200 if result["success"] or session else 400
+            self._send_json_response(result, status_code)
+            
+        except ValueError as e:
+            self._send_json_response({"success": False, "message": str(e)}, 400)
+        except Exception as e:
+            self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
+
+
+    def handle_get_transactions(self, query_params):
+        """Получить историю транзакций (limit, cursor, type, since, until)"""
+        try:
+            if not self.verify_telegram_data(query_params):
+                self._send_json_response({"success": False, "message": "Unauthorized"}, 401)
+                return
+            
+            user_id = int(query_params.get('user_id', [0])[0])
+            if user_id == 0:
+                self._send_json_response({"success": False, "message": "Invalid user_id"}, 400)
+                return
+            
+            limit = int(query_params.get('limit', [50])[0])
+            limit = min(max(limit, 1), 100)  # Ограничиваем от 1 до 100
+            cursor = query_params.get('cursor', [None])[0]
+            types = [t for value in query_params.get('type', []) for t in value.split(',') if t]
+            since = query_params.get('since', [None])[0]
+            until = query_params.get('until', [None])[0]
+            
+            history = db_manager.get_transactions(
+                user_id, limit, cursor, types or None,
+                float(since) if since else None,
+                float(until) if until else None
+            )
+            self._send_json_response({"success": True, "data": history})
+            
+        except ValueError as e:
+            self._send_json_response({"success": False, "message": str(e)}, 400)
+        except Exception as e:
+            self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
+
+
+    def handle_sync_state(self, query_params):
+        """Изменения состояния после версии since (без since - полный снимок)"""
+        try:
+            if not self.verify_telegram_data(query_params):
+                self._send_json_response({"success": False, "message": "Unauthorized"}, 401)
+                return
+            
+            user_id = int(query_params.get('user_id', [0])[0])
+            if user_id == 0:
+                self._send_json_response({"success": False, "message": "Invalid user_id"}, 400)
+                return
+            
+            since = query_params.get('since', [None])[0]
+            # Цены магазина зависят от каталога: по его версии клиент решает, перезапросить ли витрину
+            catalog_version = shop_catalog.version
+            changes = db_manager.get_state_changes(user_id, int(since) if since else None)
+            self._send_json_response(
+                {"success": True, "data": changes, "catalog_version": catalog_version},
+                headers={"X-Catalog-Version": catalog_version}
+            )
+            
+        except ValueError as e:
+            self._send_json_response({"success": False, "message": str(e)}, 400)
+        except Exception as e:
+            self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
+
 
     # === ЭНДПОИНТЫ МАГАЗИНА ===
     
@@ -218,8 +626,13 @@ class GameAPIHandler(BaseHTTPRequestHandler):
                 self._send_json_response({"success": False, "message": "Invalid user_id"}, 400)
                 return
             
+            # Версию берем до чтения: при перезагрузке клиент в худшем случае запросит каталог еще раз
+            catalog_version = shop_catalog.version
             shop_items = db_manager.get_shop_items(user_id)
-            self._send_json_response({"success": True, "data": shop_items})
+            self._send_json_response(
+                {"success": True, "data": shop_items, "catalog_version": catalog_version},
+                headers={"X-Catalog-Version": catalog_version}
+            )
             
         except Exception as e:
             self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
@@ -315,9 +728,15 @@ class GameAPIHandler(BaseHTTPRequestHandler):
                 self._send_json_response({"success": False, "message": "Invalid user_id"}, 400)
                 return
             
-            referral_stats = db_manager.get_referral_stats(user_id)
+            limit = int(query_params.get('limit', [50])[0])
+            limit = min(max(limit, 1), 100)  # Ограничиваем от 1 до 100
+            cursor = query_params.get('cursor', [None])[0]
+            
+            referral_stats = db_manager.get_referral_stats(user_id, limit, cursor)
             self._send_json_response({"success": True, "data": referral_stats})
             
+        except ValueError as e:
+            self._send_json_response({"success": False, "message": str(e)}, 400)
         except Exception as e:
             self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
     
@@ -338,17 +757,157 @@ class GameAPIHandler(BaseHTTPRequestHandler):
         except Exception as e:
             self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
 
+    # === ЭНДПОИНТЫ ДОСТИЖЕНИЙ ===
+    
+    def handle_get_achievements(self, query_params):
+        """Получить список достижений с прогрессом"""
+        try:
+            if not self.verify_telegram_data(query_params):
+                self._send_json_response({"success": False, "message": "Unauthorized"}, 401)
+                return
+            
+            user_id = int(query_params.get('user_id', [0])[0])
+            if user_id == 0:
+                self._send_json_response({"success": False, "message": "Invalid user_id"}, 400)
+                return
+            
+            achievements = db_manager.get_achievements(user_id)
+            self._send_json_response({"success": True, "data": achievements})
+            
+        except Exception as e:
+            self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
+    
+    def handle_claim_achievements(self, request_data):
+        """Забрать награду за достижение (без achievement_id - за все открытые)"""
+        try:
+            user_id = self._get_user_from_auth(request_data)
+            if not user_id:
+                self._send_json_response({"success": False, "message": "Unauthorized"}, 401)
+                return
+            
+            result = db_manager.claim_achievements(user_id, request_data.get('achievement_id'))
+            status_code = 200 if result["success"] else 400
+            self._send_json_response(result, status_code)
+            
+        except Exception as e:
+            self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
+
     # === ЭНДПОИНТ ЛИДЕРБОРДА ===
     
     def handle_get_leaderboard(self, query_params):
-        """Получить таблицу лидеров"""
+        """Получить таблицу лидеров (window: all, day, week, season)"""
         try:
             limit = int(query_params.get('limit', [10])[0])
             limit = min(max(limit, 1), 100)  # Ограничиваем от 1 до 100
+            window = query_params.get('window', ['all'])[0]
             
-            leaderboard = db_manager.get_leaderboard(limit)
+            if window == 'all':
+                leaderboard = db_manager.get_leaderboard(limit)
+            elif window in LEADERBOARD_WINDOWS:
+                leaderboard = db_manager.get_windowed_leaderboard(window, limit)
+            else:
+                self._send_json_response({"success": False, "message": "Invalid window"}, 400)
+                return
             self._send_json_response({"success": True, "data": leaderboard})
             
+        except ValueError as e:
+            self._send_json_response({"success": False, "message": str(e)}, 400)
+        except Exception as e:
+            self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
+
+    # === ЭНДПОИНТЫ БОТА ===
+    
+    def handle_bot_user(self, request_data):
+        """Создать или обновить пользователя из /start бота"""
+        try:
+            user_id = int(request_data.get('user_id') or 0)
+            if user_id == 0:
+                self._send_json_response({"success": False, "message": "Invalid user_id"}, 400)
+                return
+            
+            db_manager.create_or_update_user(user_id, request_data.get('telegram_data'))
+            self._send_json_response({"success": True})
+            
+        except (TypeError, ValueError) as e:
+            self._send_json_response({"success": False, "message": str(e)}, 400)
+        except Exception as e:
+            self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
+    
+    def handle_bot_referral(self, request_data):
+        """Привязать реферала по ссылке ref_<id> из /start бота"""
+        try:
+            referrer_id = int(request_data.get('referrer_id') or 0)
+            referred_id = int(request_data.get('referred_id') or 0)
+            if referrer_id == 0 or referred_id == 0:
+                self._send_json_response({"success": False, "message": "Invalid user_id"}, 400)
+                return
+            
+            linked = db_manager.add_referral(referrer_id, referred_id)
+            self._send_json_response({"success": True, "data": {"linked": linked}})
+            
+        except (TypeError, ValueError) as e:
+            self._send_json_response({"success": False, "message": str(e)}, 400)
+        except Exception as e:
+            self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
+    
+    def handle_bot_profile(self, query_params):
+        """Профиль для /balance бота"""
+        try:
+            user_id = int(query_params.get('user_id', [0])[0])
+            if user_id == 0:
+                self._send_json_response({"success": False, "message": "Invalid user_id"}, 400)
+                return
+            
+            self._send_json_response({"success": True, "data": db_manager.get_user_profile(user_id)})
+            
+        except ValueError as e:
+            self._send_json_response({"success": False, "message": str(e)}, 400)
+        except Exception as e:
+            self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
+
+    # === СЛУЖЕБНЫЕ ЭНДПОИНТЫ ===
+    
+    def handle_get_admission_stats(self, query_params):
+        """Получить счетчики контроля допуска"""
+        try:
+            self._send_json_response({"success": True, "data": admission_controller.stats()})
+            
+        except Exception as e:
+            self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
+
+    def handle_get_global_stats(self, query_params):
+        """Получить общую статистику игры (сумма по всем шардам)"""
+        try:
+            self._send_json_response({"success": True, "data": db_manager.get_global_stats()})
+            
+        except Exception as e:
+            self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
+
+    def handle_get_traces(self, query_params):
+        """Получить последние медленные трассы этого воркера (limit) и счетчики трассировки"""
+        try:
+            limit = int(query_params.get('limit', [20])[0])
+            limit = min(max(limit, 1), 100)  # Ограничиваем от 1 до 100
+            self._send_json_response({"success": True, "data": {
+                "stats": tracer.stats(),
+                "traces": tracer.recent(limit),
+            }})
+            
+        except ValueError as e:
+            self._send_json_response({"success": False, "message": str(e)}, 400)
+        except Exception as e:
+            self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
+
+    def handle_get_maintenance_status(self, query_params):
+        """Получить статус фонового обслуживания БД (последний запуск каждой задачи)"""
+        try:
+            if maintenance_scheduler and maintenance_scheduler.stats()["active"]:
+                status = maintenance_scheduler.stats()
+            else:
+                # Планировщик работает в другом воркере - читаем сохраненный им статус
+                status = db_maintenance.read_status() or {"active": False, "jobs": {}}
+            self._send_json_response({"success": True, "data": status})
+            
         except Exception as e:
             self._send_json_response({"success": False, "message": f"Server error: {str(e)}"}, 500)
 
@@ -382,11 +941,32 @@ class GameAPIHandler(BaseHTTPRequestHandler):
         # Для простоты пропускаем эту проверку в демо-версии
         return True
 
-def start_api_server(port=8080):
+def start_maintenance(slot: int = 0):
+    """Запустить фоновое обслуживание БД (в многопроцессном режиме - только в воркере 0)"""
+    if maintenance_scheduler and slot == 0:
+        maintenance_scheduler.start()
+
+class GameAPIServer(ThreadingHTTPServer):
+    """HTTP сервер API: поток на соединение, лимиты держит контроль допуска"""
+    daemon_threads = True
+    request_queue_size = 128
+
+def start_api_server(port=8080, workers=None):
     """Запуск API сервера"""
+    if workers is None:
+        workers = int(os.getenv("WEB_API_WORKERS", "1"))
+    if workers > 1 and not hasattr(os, 'fork'):
+        print("[WARN] Многопроцессный режим недоступен на этой платформе, запускаем один процесс")
+        workers = 1
+    if workers > 1 and not db_manager.supports_multiprocess:
+        print("[WARN] Выбранный движок БД держит состояние в памяти процесса, запускаем один процесс")
+        workers = 1
+    
     server_address = ('', port)
-    httpd = HTTPServer(server_address, GameAPIHandler)
+    httpd = GameAPIServer(server_address, GameAPIHandler)
     print(f"[INFO] API Server starting on port {port}")
+    if workers > 1:
+        print(f"[INFO] Воркеров: {workers}; лимиты контроля допуска действуют на каждый воркер")
     print(f"[INFO] Available endpoints:")
     print(f"")
     print(f"[AUTH] Авторизация:")
@@ -395,6 +975,10 @@ def start_api_server(port=8080):
     print(f"[USER] Пользователь:")
     print(f"   GET  /api/user/profile        - Получить профиль пользователя")
     print(f"   GET  /api/user/stats          - Статистика игрока")
+    print(f"   GET  /api/user/balance        - Баланс с учетом пассивного дохода")
+    print(f"   POST /api/user/spend          - Потратить монеты (пачка трат с номерами seq)")
+    print(f"   GET  /api/user/transactions   - История транзакций (limit, cursor, type, since, until)")
+    print(f"   GET  /api/user/sync           - Изменения состояния после версии (since)")
     print(f"")
     print(f"[GAME] Игровой процесс:")
     print(f"   GET  /api/shop/items          - Список доступных улучшений")
@@ -404,11 +988,42 @@ def start_api_server(port=8080):
     print(f"")
     print(f"[REF] Реферальная система:")
     print(f"   GET  /api/referral/link       - Получить реферальную ссылку")
-    print(f"   GET  /api/referral/stats      - Статистика рефералов")
+    print(f"   GET  /api/referral/stats      - Статистика рефералов и команды (limit, cursor)")
     print(f"   POST /api/referral/claim      - Получить награду за реферала")
     print(f"")
+    print(f"[ACH] Достижения:")
+    print(f"   GET  /api/achievements/list   - Достижения и прогресс игрока")
+    print(f"   POST /api/achievements/claim  - Забрать награду (achievement_id или все открытые)")
+    print(f"")
+    print(f"[TOP] Лидерборды:")
+    print(f"   GET  /api/leaderboard         - Таблица лидеров (window: all, day, week, season; limit)")
+    print(f"")
+    print(f"[SYS] Служебные:")
+    print(f"   GET  /api/system/admission    - Счетчики контроля допуска")
+    print(f"   GET  /api/system/stats        - Общая статистика игры")
+    print(f"   GET  /api/system/maintenance  - Статус фонового обслуживания БД")
+    print(f"   GET  /api/system/traces       - Медленные трассы запросов (limit)")
+    print(f"   (admission, maintenance, traces - только с localhost или заголовком X-Admin-Token)")
+    print(f"")
+    print(f"[BOT] Бот (заголовок X-Bot-Token):")
+    print(f"   POST /api/bot/user            - Создать или обновить пользователя")
+    print(f"   POST /api/bot/referral        - Привязать реферала")
+    print(f"   GET  /api/bot/profile         - Профиль для /balance")
+    print(f"")
+    if static_files:
+        print(f"[STATIC] Фронтенд раздается из {static_files.root}")
+        print(f"")
+    if traffic_recorder:
+        print(f"[TRAFFIC] Журнал трафика: {traffic_recorder.directory} (проигрывание: python replay.py run)")
+        print(f"")
     print(f"[TIP] Для POST запросов используйте JWT токен в заголовке Authorization: Bearer <token>")
-    httpd.serve_forever()
+    print(f"[TIP] Повторы покупок безопасны с заголовком Idempotency-Key: <уникальный ключ>")
+    
+    if workers > 1:
+        run_prefork(httpd, workers, admission_controller.wait_idle, on_worker_start=start_maintenance)
+    else:
+        start_maintenance()
+        httpd.serve_forever()
 
 if __name__ == "__main__":
     start_api_server()
@@ -0,0 +1,117 @@
+"""
+Многопроцессный режим API (pre-fork)
+Супервизор открывает слушающий сокет, форкает воркеры, перезапускает упавшие
+и корректно останавливает их по SIGTERM
+
+Состояние в памяти каждого воркера свое:
+- контроль допуска (корзины токенов и лимит одновременных запросов) действует
+  на воркер, то есть общий лимит равен значению из настроек, умноженному на число воркеров;
+- кэш ключей идемпотентности - только ускоритель, резерв ключа и сохраненные
+  ответы лежат в SQLite и видны всем воркерам.
+SQLite работает в режиме WAL, поэтому читатели воркеров не блокируют писателя.
+"""
+
+import logging
+import os
+import signal
+import threading
+import time
+
+# Сколько ждать завершения воркеров при остановке (сек)
+SHUTDOWN_TIMEOUT = 10.0
+
+# Минимальная пауза между перезапусками одного слота, чтобы не уйти в цикл форков
+RESTART_BACKOFF = 1.0
+
+
+def run_worker(httpd, drain):
+    """Цикл воркера: обслуживать запросы до SIGTERM, затем дождаться текущих"""
+    def handle_term(signum, frame):
+        # shutdown() нельзя вызывать из потока serve_forever
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, handle_term)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    try:
+        httpd.serve_forever()
+    finally:
+        drain(SHUTDOWN_TIMEOUT)
+        httpd.server_close()
+
+
+def run_prefork(httpd, workers: int, drain, on_worker_start=None):
+    """Супервизор: форкнуть воркеры на общем сокете и следить за ними
+
+    on_worker_start(slot) вызывается в каждом новом воркере (и после перезапуска).
+    """
+    children = {}  # pid -> номер слота
+    stopping = False
+
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            # Воркер унаследовал слушающий сокет от родителя
+            code = 0
+            try:
+                if on_worker_start:
+                    on_worker_start(slot)
+                run_worker(httpd, drain)
+            except Exception as e:
+                print(f"[ERROR] Воркер {slot} завершился с ошибкой: {e}")
+                code = 1
+            finally:
+                # os._exit не вызывает atexit: дописываем очередь журнала явно
+                logging.shutdown()
+                os._exit(code)
+        children[pid] = slot
+        return pid
+
+    def signal_children(sig):
+        for pid in list(children):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def handle_stop(signum, frame):
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        signal_children(signal.SIGTERM)
+        # Воркеры, не успевшие завершиться, добиваем по таймеру
+        signal.alarm(int(SHUTDOWN_TIMEOUT) + 5)
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+    signal.signal(signal.SIGALRM, lambda signum, frame: signal_children(signal.SIGKILL))
+
+    last_start = {}
+    for slot in range(workers):
+        spawn(slot)
+        last_start[slot] = time.monotonic()
+    print(f"[INFO] Запущено воркеров: {workers} (PID супервизора {os.getpid()})")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+
+        slot = children.pop(pid, None)
+        if slot is None or stopping:
+            continue
+
+        print(f"[WARN] Воркер {slot} (PID {pid}) завершился со статусом {status}, перезапуск")
+        delay = RESTART_BACKOFF - (time.monotonic() - last_start[slot])
+        if delay > 0:
+            time.sleep(delay)
+        if not stopping:
+            spawn(slot)
+            last_start[slot] = time.monotonic()
+
+    httpd.server_close()
+    print("[INFO] Все воркеры остановлены")
@@ -216,38 +216,194 @@
       // Делаем Telegram WebApp доступным глобально для Unity
       window.TelegramWebApp = tg;
       
+      // Журнал трат на клиенте: монеты списываются сразу, а на сервер траты уходят
+      // пачками с номерами seq; сервер подтверждает или отклоняет их диапазонами
+      var SPEND_FLUSH_DELAY = 300;   // мс ожидания следующих трат перед отправкой
+      var SPEND_BATCH_LIMIT = 100;   // трат в одном запросе (как на сервере)
+      var spendLedger = {
+        session: Date.now().toString(36) + Math.random().toString(36).slice(2, 10),
+        seq: 0,
+        serverBalance: null,  // последний баланс, подтвержденный сервером
+        passiveIncome: 0,
+        syncedAt: 0,          // время получения баланса (часы клиента, сек)
+        queue: [],            // траты, еще не отправленные
+        inFlight: [],         // отправленная пачка без ответа (после сбоя повторяется она же)
+        sending: false,       // запрос с пачкой inFlight еще не вернулся
+        timer: null,
+        retries: 0
+      };
+      
+      function apiUrl(path) {
+        var userId = tg.initDataUnsafe.user.id;
+        return window.location.origin + path + '?user_id=' + userId + '&auth_date=' + Date.now();
+      }
+      
+      function pendingSpends() {
+        return spendLedger.inFlight.concat(spendLedger.queue)
+          .reduce(function(sum, spend) { return sum + spend.amount; }, 0);
+      }
+      
+      // Баланс с учетом пассивного дохода после синхронизации и еще не подтвержденных трат
+      function projectedBalance() {
+        if (spendLedger.serverBalance === null) {
+          return null;
+        }
+        var elapsed = Math.max(Date.now() / 1000 - spendLedger.syncedAt, 0);
+        return spendLedger.serverBalance + Math.floor(spendLedger.passiveIncome * elapsed) - pendingSpends();
+      }
+      
+      function applyServerBalance(data) {
+        spendLedger.serverBalance = data.balance;
+        spendLedger.passiveIncome = data.passive_income || 0;
+        spendLedger.syncedAt = Date.now() / 1000;
+      }
+      
+      function balanceResult() {
+        return {success: true, data: {balance: projectedBalance(), passive_income: spendLedger.passiveIncome}};
+      }
+      
+      function syncBalance(callback) {
+        fetch(apiUrl('/api/user/balance'))
+          .then(response => response.json())
+          .then(function(data) {
+            if (data.success) {
+              applyServerBalance(data.data);
+              // Неотправленные траты уже учтены локально - вычитаем их из ответа
+              callback(balanceResult());
+            } else {
+              callback(data);
+            }
+          })
+          .catch(error => callback({success: false, error: error.message}));
+      }
+      
+      function scheduleSpendFlush(delay) {
+        if (!spendLedger.timer) {
+          spendLedger.timer = setTimeout(flushSpends, delay === undefined ? SPEND_FLUSH_DELAY : delay);
+        }
+      }
+      
+      function flushSpends(keepalive) {
+        spendLedger.timer = null;
+        if (spendLedger.sending) {
+          return;
+        }
+        if (!spendLedger.inFlight.length) {
+          if (!spendLedger.queue.length) {
+            return;
+          }
+          // Состав пачки фиксируется до ответа сервера: повтор отправляет ее же с тем же ключом
+          spendLedger.inFlight = spendLedger.queue.splice(0, SPEND_BATCH_LIMIT);
+        }
+        
+        var batch = spendLedger.inFlight;
+        spendLedger.sending = true;
+        fetch(window.location.origin + '/api/user/spend', {
+          method: 'POST',
+          keepalive: keepalive === true,
+          headers: {
+            'Content-Type': 'application/json',
+            // Повтор той же пачки после обрыва связи получит сохраненный ответ
+            'Idempotency-Key': spendLedger.session + ':' + batch[0].seq + '-' + batch[batch.length - 1].seq
+          },
+          body: JSON.stringify({
+            user_id: tg.initDataUnsafe.user.id,
+            session: spendLedger.session,
+            spends: batch
+          })
+        })
+          .then(function(response) {
+            return response.json().then(function(data) { return {status: response.status, data: data}; });
+          })
+          .then(function(result) {
+            if (result.status === 429 || result.status >= 500) {
+              throw new Error('HTTP ' + result.status);
+            }
+            spendLedger.sending = false;
+            spendLedger.inFlight = [];
+            spendLedger.retries = 0;
+            if (result.data.data) {
+              applyServerBalance(result.data.data);
+              if (result.data.data.rejected.length) {
+                // Монет не хватило: игра должна откатить эти траты и показать настоящий баланс
+                window.dispatchEvent(new CustomEvent('gameapi:spend-rejected', {
+                  detail: {rejected: result.data.data.rejected, balance: projectedBalance()}
+                }));
+              }
+            } else {
+              // Пачка не принята целиком (неверный запрос) - сверяем баланс с сервером
+              syncBalance(function() {});
+            }
+            if (spendLedger.queue.length) {
+              scheduleSpendFlush();
+            }
+          })
+          .catch(function() {
+            // Сеть или перегрузка: повторяем ту же пачку с растущей паузой, новые траты ждут в очереди
+            spendLedger.sending = false;
+            spendLedger.retries += 1;
+            scheduleSpendFlush(Math.min(1000 * Math.pow(2, spendLedger.retries), 30000));
+          });
+      }
+      
+      // Игру свернули или закрыли - отправляем накопленные траты сразу
+      document.addEventListener('visibilitychange', function() {
+        if (document.visibilityState === 'hidden') {
+          clearTimeout(spendLedger.timer);
+          flushSpends(true);
+        }
+      });
+      
       // Функции для работы с API
       window.GameAPI = {
-        // Получить баланс пользователя
+        // Получить баланс пользователя (с учетом еще не подтвержденных трат)
         getUserBalance: function(callback) {
           if (!tg.initDataUnsafe.user) {
             callback({success: false, error: "No user data"});
             return;
           }
           
-          var userId = tg.initDataUnsafe.user.id;
-          var apiUrl = window.location.origin + '/api/user/balance?user_id=' + userId + '&auth_date=' + Date.now();
-          
-          fetch(apiUrl)
-            .then(response => response.json())
-            .then(data => callback(data))
-            .catch(error => callback({success: false, error: error.message}));
+          syncBalance(callback);
         },
         
-        // Потратить монеты
+        // Потратить монеты: списываются сразу, сервер подтверждает пачкой
         spendCoins: function(amount, callback) {
           if (!tg.initDataUnsafe.user) {
             callback({success: false, error: "No user data"});
             return;
           }
           
-          var userId = tg.initDataUnsafe.user.id;
-          var apiUrl = window.location.origin + '/api/user/spend?user_id=' + userId + '&amount=' + amount + '&auth_date=' + Date.now();
+          amount = Math.floor(amount);
+          if (!(amount > 0)) {
+            callback({success: false, error: "Invalid amount"});
+            return;
+          }
+          
+          if (spendLedger.serverBalance === null) {
+            // Баланс еще не известен - сначала получаем его с сервера
+            syncBalance(function(result) {
+              if (!result.success) {
+                callback(result);
+                return;
+              }
+              window.GameAPI.spendCoins(amount, callback);
+            });
+            return;
+          }
+          
+          if (projectedBalance() < amount) {
+            callback({success: false, message: "Недостаточно монет", data: {balance: projectedBalance()}});
+            return;
+          }
+          
+          spendLedger.seq += 1;
+          spendLedger.queue.push({seq: spendLedger.seq, amount: amount});
+          scheduleSpendFlush();
           
-          fetch(apiUrl)
-            .then(response => response.json())
-            .then(data => callback(data))
-            .catch(error => callback({success: false, error: error.message}));
+          var result = balanceResult();
+          result.pending = true;
+          result.data.seq = spendLedger.seq;
+          callback(result);
         },
         
         // Показать кнопку покупки монет
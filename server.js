@@ -12,6 +12,7 @@ const publicRoot = path.join(__dirname, 'frontend');
 app.use('/api', createProxyMiddleware({
   target: 'http://localhost:8080',
   changeOrigin: true,
+  xfwd: true, // X-Forwarded-For lets the backend tell proxied requests from local ones
   logLevel: 'debug'
 }));
 
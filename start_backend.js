@@ -8,6 +8,7 @@ const pythonScript = path.join(backendPath, 'web_api.py');
 
 console.log('[BACKEND] Backend directory:', backendPath);
 console.log('[BACKEND] Python script:', pythonScript);
+console.log('[BACKEND] Workers:', process.env.WEB_API_WORKERS || 1);
 
 // Start the Python process
 const python = spawn('python', [pythonScript], {